@@ -1,7 +1,35 @@
 from scipy import signal
 import json
 import librosa as l
+import numpy as np
 from numpy import ndarray
+from metrics import timed
+from spectroStore import saveSpectrogram, storePath
+
+FEATURE_VERSION = 2  # version of the feature hashes of analyze (2: mfcc of the melspectrogram), see loader.writeFrontEnd
+SEGMENT_LENGTH = 256  # samples per frame of signal.spectrogram for a named window
+SEGMENT_STEP = SEGMENT_LENGTH - SEGMENT_LENGTH // 8  # its default overlap is an eighth of a frame
+_chromaBanks = {}  # (sr, n_fft, tuning) -> chroma filter bank, built once per process
+
+
+def _tuning(pitch: ndarray, magnitude: ndarray) -> float:
+    """
+    librosa.estimate_tuning of one clip from its piptrack output
+    """
+    voiced = pitch > 0
+    threshold = np.median(magnitude[voiced]) if voiced.any() else 0.0
+    return float(l.pitch_tuning(pitch[(magnitude >= threshold) & voiced], bins_per_octave=12))
+
+
+def _chromaFilters(sr: int, nFFT: int, tuning: float) -> ndarray:
+    """
+    Chroma filter bank of chroma_stft for a tuning, cached
+    """
+    key = (sr, nFFT, tuning)
+    if key not in _chromaBanks:
+        _chromaBanks[key] = l.filters.chroma(sr=sr, n_fft=nFFT, tuning=tuning, n_chroma=12)
+    return _chromaBanks[key]
+
 
 class spectrogram():
     """
@@ -20,15 +48,18 @@ class spectrogram():
         - sampleTime : holds the sampled time rates
         - colorMesh : holds the value (intenisty) of the frequency component
         - container : a dictionary used in the saved process
+        - parity : differences with the legacy features, filled by analyze(verify=True)
         """
         self.sampleFreqs = None
         self.sampleTime = None
         self.colorMesh = None
         self.features = None
         self.container = None
+        self.parity = None
 
     def __call__(self, songData: ndarray, songSR: int, window:str, fileName:str = None,
-                 path:str = None, compressed: bool = False, featureize:bool = False):
+                 path:str = None, compressed: bool = False, featureize:bool = False, storage: str = "json",
+                 dtype: str = "float32"):
         """
         Caller function for the class which maintains all it's implemented methods.
 
@@ -38,23 +69,29 @@ class spectrogram():
         - songSR : integer representing the sample rate
         - window : a str specifying the widow type used in creating the spectrogram
         - path : str if specified the file is saved in the given path
-        - fileName : if provided the spectrogram will be saved as a json file
-        - compressed : if True only the color mesh will be saved
+        - fileName : if provided the spectrogram will be saved in fileName.json (or fileName.spec, see storage)
+        - compressed : if True only the color mesh will be saved (json storage)
         - featurize : if True spectrogram`s main features will be extracted and saved if specified saving
+        - storage : "json" text dump (default), "npy" or "npz" binary store read back by spectroStore.storedSpectrogram
+        - dtype : "float32" or "float16" frames of a binary store
         """
-        self._spectrogram(songData, songSR, window)
         if featureize:
-            self.features= self.spectralFeatures(None, self.colorMesh, songSR,window)
+            self.analyze(songData, songSR, window)
+        else:
+            self._spectrogram(songData, songSR, window)
         print("spectrogram created")
 
         if fileName:
             if path is None:
-                self._saveFormat('', fileName, compressed=compressed, featurize=featureize)
+                self._saveFormat('', fileName, compressed=compressed, featurize=featureize, storage=storage,
+                                 dtype=dtype)
                 print("saved in main directory .. ")
             else:
-                self._saveFormat(path, fileName, compressed=compressed, featurize=featureize)
+                self._saveFormat(path, fileName, compressed=compressed, featurize=featureize, storage=storage,
+                                 dtype=dtype)
             print("spectrogram saved")
 
+    @timed("_spectrogram")
     def _spectrogram(self, songData: ndarray, songSampleRate:int=22050, windowType: str="hann")->tuple:
         """
         Creates a Spectrogram of the given data
@@ -75,17 +112,25 @@ class spectrogram():
                                                                                    fs=songSampleRate, window=windowType)
         return (self.sampleFreqs, self.sampleTime, self.colorMesh)
 
-    def _saveFormat(self, folder:str, filename:str, featurize : bool = False, compressed: bool = False):
+    def _saveFormat(self, folder:str, filename:str, featurize : bool = False, compressed: bool = False,
+                    storage: str = "json", dtype: str = "float32"):
         """
-        Save the spectrum in a specified filename.json
+        Save the spectrum in folder/filename.json, or in a binary store folder/filename.spec
 
         Parameters
         -----------
         - folder : a path to the file location
         - filename : the file name
-        - compressed : if True only the color mesh will be saved
+        - compressed : if True only the color mesh will be saved (json storage)
         - featurize : if True adds the main features of the spectrogram
+        - storage : "json" text lists, "npy" frames memory mapped when read, "npz" deflated chunks of frames
+        - dtype : "float32" or "float16" frames of a binary store (see spectroStore.saveSpectrogram)
         """
+        if storage != "json":
+            features = dict(zip(("mel", "mfcc", "chroma"), self.features)) if featurize else None
+            return saveSpectrogram(str(storePath(folder, filename)), self.sampleFreqs, self.sampleTime,
+                                   self.colorMesh, features, storage, dtype)
+
         # TODO : Refactor this part .. return function
         if compressed:
             self.container = {"color_mesh": self.colorMesh.tolist()}
@@ -94,11 +139,144 @@ class spectrogram():
                               "sample_time": self.sampleTime.tolist(),
                               "color_mesh": self.colorMesh.tolist()}
         if featurize:
-            self.container['features'] = self.features
+            self.container['features'] = [feature.tolist() for feature in self.features]
 
         with open(folder+filename+".json", 'w') as outfile:
             json.dump(self.container, outfile)
 
+    def analyze(self, songData: ndarray, songSR: int = 22050, windowType: str = "hann", verify: bool = False)->tuple:
+        """
+        Single pass feature pipeline, computes one power spectrum of the clip and derives
+        everything hashed from it:
+
+        - the spectrogram (colorMesh) itself
+        - melspectrogram from the spectrogram
+        - mfcc from that same melspectrogram instead of a new STFT of the waveform
+        - chroma_stft from the spectrogram
+
+        Parameters
+        -----------
+        - songData : a numpy array of the read wav file
+        - songSR : integer representing the sample rate
+        - windowType : a str specifying the widow type used in creating the spectrogram
+        - verify : if True the legacy spectralFeatures are computed too and their differences
+                   are stored in self.parity (see _parity)
+
+        Returns
+        -----------
+        - the color mesh and a tuple of the three features (mel, mfcc, chroma)
+        """
+        self._spectrogram(songData, songSR, windowType)
+        self.features = self.meshFeatures(self.colorMesh, songSR)
+
+        if verify:
+            self.parity = self._parity(songData, songSR, windowType)
+        return self.colorMesh, self.features
+
+    @timed("analyzeBatch")
+    def analyzeBatch(self, clips: ndarray, songSR: int = 22050, windowType: str = "hann", lengths=None)->tuple:
+        """
+        Batched analyze of many clips, one STFT, melspectrogram, mfcc and chroma_stft for the whole
+        stack instead of one call per clip, every clip gives the frames and features analyze gives it alone
+
+        Parameters
+        -----------
+        - clips : a 2-D numpy array, one clip per row, zero padded at the end to the longest one
+        - songSR : integer representing the sample rate of every clip
+        - windowType : a str specifying the widow type used in creating the spectrogram
+        - lengths : samples of every clip before padding, all the row if not given
+
+        Returns
+        -----------
+        - the color meshes (clips, bins, frames), a dictionary of the stacked "mel", "mfcc" and
+          "chroma" features and the frames of every clip, the frames past them come from the padding
+        """
+        clips = np.asarray(clips)
+        if clips.ndim != 2 or clips.shape[1] < SEGMENT_LENGTH:
+            raise ValueError("expected one clip of at least %s samples per row, got shape %s"
+                             % (SEGMENT_LENGTH, clips.shape))
+        lengths = np.full(len(clips), clips.shape[1]) if lengths is None else np.asarray(lengths)
+        frames = np.maximum((lengths - SEGMENT_LENGTH) // SEGMENT_STEP + 1, 1)
+        _, _, meshes = signal.spectrogram(clips, fs=songSR, window=windowType, axis=-1)
+
+        mel = l.feature.melspectrogram(S=meshes, sr=songSR)
+        # power_to_db clips at 80 dB below the maximum of its input, taken per clip and within its frames
+        db = l.power_to_db(mel, top_db=None)
+        peaks = np.array([clip[:, :count].max() for clip, count in zip(db, frames)], dtype=db.dtype)
+        mfcc = l.feature.mfcc(S=np.maximum(db, peaks[:, None, None] - 80.0), sr=songSR)
+
+        # the chroma filters depend on the tuning, estimated per clip from the peaks of one batched piptrack
+        pitches, magnitudes = l.piptrack(S=meshes, sr=songSR)
+        filters = np.stack([_chromaFilters(songSR, 2 * (meshes.shape[1] - 1),
+                                           _tuning(pitch[:, :count], magnitude[:, :count]))
+                            for pitch, magnitude, count in zip(pitches, magnitudes, frames)])
+        chroma = l.util.normalize(np.einsum("ncf,nft->nct", filters, meshes, optimize=True), norm=np.inf, axis=-2)
+        return meshes, {"mel": mel, "mfcc": mfcc, "chroma": chroma}, frames
+
+    def meshFeatures(self, S: ndarray, sr: int = 22050)->tuple:
+        """
+        Derives the hashed features from a spectrogram (or a slice of its frames)
+
+        Parameters
+        -----------
+        - S : spectrogram readings
+        - sr : sampling frequency default 22050
+
+        Returns
+        -----------
+        - a tuple of the melspectrogram, the mfcc of that melspectrogram and the chroma_stft
+        """
+        features = self.featuresOf(S, ("mel", "mfcc", "chroma"), sr)
+        return (features["mel"], features["mfcc"], features["chroma"])
+
+    @timed("featuresOf")
+    def featuresOf(self, S: ndarray, names, sr: int = 22050, computed: dict = None)->dict:
+        """
+        Derives only the requested features from a spectrogram, like meshFeatures
+
+        Parameters
+        -----------
+        - S : spectrogram readings
+        - names : names of the features among "mel", "mfcc" and "chroma"
+        - sr : sampling frequency default 22050
+        - computed : features already derived from S, reused (the mfcc needs the mel)
+
+        Returns
+        -----------
+        - a dictionary of feature name -> feature, holding the computed ones too
+        """
+        features = dict(computed or {})
+        for name in names:
+            if name in features:
+                continue
+            if name == "chroma":
+                features[name] = l.feature.chroma_stft(S=S, sr=sr)
+                continue
+            if "mel" not in features:
+                features["mel"] = l.feature.melspectrogram(S=S, sr=sr)
+            if name == "mfcc":
+                features[name] = l.feature.mfcc(S=l.power_to_db(features["mel"]), sr=sr)
+            elif name != "mel":
+                raise ValueError("unknown feature %s" % name)
+        return features
+
+    def _parity(self, songData: ndarray, songSR: int, windowType: str)->dict:
+        """
+        Compares the features of analyze with the ones of spectralFeatures.
+
+        mel and chroma are computed from the same spectrogram so their maximum absolute
+        difference should be 0, the legacy mfcc has its own STFT (other frame count) so
+        it is compared by the hamming distance of both hashes.
+        """
+        from helpers import createPerceptualHash, getHammingDistance
+
+        legacy = self.spectralFeatures(songData, self.colorMesh, songSR, windowType)
+        return {"melspectrogram": float(np.abs(legacy[0] - self.features[0]).max()),
+                "chroma_stft": float(np.abs(legacy[2] - self.features[2]).max()),
+                "mfcc_hash_distance": int(getHammingDistance(createPerceptualHash(legacy[1]),
+                                                             createPerceptualHash(self.features[1])))}
+
+    @timed("spectralFeatures")
     def spectralFeatures(self, song: "ndarray"= None, S: "ndarray" = None, sr: int = 22050, window:'str'='hann'):
         """
         Calculates the Spectral Centroid of a given data or the data instantiated in the class.
@@ -147,6 +325,3 @@ if __name__ == '__main__':
     spectrum(songdata, sampleRate,"hann", featureize=True)
     # print(spectrum.features
     # spectrogram()._spectralFeatures()
-
-
-
@@ -0,0 +1,226 @@
+from pathlib import Path
+import json
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import numpy as np
+from scipy import signal
+from scipy.io import wavfile
+import loader
+from updateDB import updateDB
+from Spectrogram import spectrogram
+from helpers import createPerceptualHash, hashAudio, hashAudioBatch, mixSongs
+from hashIndex import hashIndex, packRecord
+
+KINDS = ("tone", "noise", "chirp", "mixed")  # kinds of synthesized tracks, used in turn
+
+
+def synthesizeTrack(kind: str, seconds: float, rate: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Synthesizes one random track of the given kind
+
+    :param kind: one of KINDS
+    :param seconds: length of the track
+    :param rate: sample rate
+    :param rng: random generator
+    :return: int16 mono samples
+    """
+    t = np.arange(int(seconds * rate)) / rate
+    if kind == "tone":
+        f0 = rng.uniform(80, 1000)
+        notes = f0 * 2 ** (rng.integers(0, 12, int(seconds) + 1) / 12)[(t // 1).astype(int)]
+        track = sum(np.sin(2 * np.pi * h * np.cumsum(notes) / rate) / h for h in (1, 2, 3))
+    elif kind == "noise":
+        low, high = sorted(rng.uniform(100, rate / 2 - 100, 2))
+        track = signal.sosfilt(signal.butter(4, [low, high], "bandpass", fs=rate, output="sos"), rng.normal(size=len(t)))
+    elif kind == "chirp":
+        f0, f1 = rng.uniform(50, rate / 4, 2)
+        track = signal.chirp(t, f0, rng.uniform(1, 5), f1, method="logarithmic" if f0 < f1 else "linear")
+    else:
+        track = sum(synthesizeTrack(other, seconds, rate, rng) / 32767 for other in KINDS[:3])
+    track = track * (1 + 0.5 * np.sin(2 * np.pi * rng.uniform(0.1, 2) * t))
+    return (0.3 * 32767 * track / np.abs(track).max()).astype(np.int16)
+
+
+def synthesizeCorpus(folder: str, tracks: int = 20, seconds: float = 20, rate: int = 22050, seed: int = 0) -> list:
+    """
+    Writes a reproducible corpus of synthesized .wav tracks (tones, noise, chirps and mixes)
+
+    :param folder: output folder
+    :param tracks: number of tracks
+    :param seconds: length of every track
+    :param rate: sample rate
+    :param seed: seed of the random generator
+    :return: list of the written paths
+    """
+    rng = np.random.default_rng(seed)
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(tracks):
+        kind = KINDS[i % len(KINDS)]
+        path = Path(folder) / ("%s_%03d.wav" % (kind, i))
+        wavfile.write(path, rate, synthesizeTrack(kind, seconds, rate, rng))
+        paths.append(path)
+    return paths
+
+
+def _timed(function, *args, repeat: int = 3) -> tuple:
+    """
+    Calls a function repeat times and returns its last result and its median latency in ms
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append((time.perf_counter() - start) * 1000)
+    return result, float(np.median(times))
+
+
+def _peakRss() -> dict:
+    """
+    Peak resident memory (MB) of this process and of its finished children (e.g. ingest workers)
+    """
+    scale = 1 / 2**20 if platform.system() == "Darwin" else 1 / 2**10  # ru_maxrss is bytes on macOS, KB on linux
+    return {"self_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            "children_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+
+def _version() -> dict:
+    """
+    Versions the results are tracked against
+    """
+    import scipy
+    import librosa
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "scipy": scipy.__version__, "librosa": librosa.__version__}
+
+
+def _batchThroughput(clips: list, rate: int) -> dict:
+    """
+    Clips hashed per second one by one (hashAudio) and all at once (hashAudioBatch), and the
+    number of clips whose batched record differs
+    """
+    lengths = [len(clip) for clip in clips]
+    stacked = np.zeros((len(clips), max(lengths)), dtype=clips[0].dtype)
+    for row, clip in enumerate(clips):
+        stacked[row, :len(clip)] = clip
+    single, singleMs = _timed(lambda: [packRecord(*hashAudio(clip, rate)) for clip in clips], repeat=1)
+    batch, batchMs = _timed(hashAudioBatch, stacked, rate, lengths, repeat=1)
+    return {"clips": len(clips), "single_clips_per_s": len(clips) * 1000 / singleMs,
+            "batch_clips_per_s": len(clips) * 1000 / batchMs,
+            "different_records": int(np.count_nonzero((np.array(single) != batch["record"]).any(axis=1)))}
+
+
+def runBenchmark(tracks: int = 20, seconds: float = 20, rate: int = 22050, workers: int = 1, pairs: int = 20,
+                 weights: tuple = (0.5, 0.6, 0.7, 0.8, 0.9), k: int = 5, seed: int = 0, folder: str = None) -> dict:
+    """
+    Runs the whole benchmark on a synthesized corpus.
+
+    Implements the following :
+
+    - Synthesizes the corpus and builds its database with updateDB (ingest throughput)
+    - Times every stage of the pipeline on the corpus tracks
+    - Mixes random pairs of tracks like hashDemo.py and measures recall@k of the search
+
+    ============= ==========================================
+    **Arguments**
+    tracks        number of synthesized tracks.
+    seconds       length of every track.
+    rate          sample rate of the tracks.
+    workers       processes used by updateDB.
+    pairs         number of mixed pairs searched per weight.
+    weights       weights of the first song of every pair.
+    k             number of results searched.
+    seed          seed of the corpus and of the pairs.
+    folder        working folder, a temporary one if not given.
+    ============= ==========================================
+
+    :return: dictionary of the results
+    """
+    workFolder = tempfile.TemporaryDirectory() if folder is None else None
+    base = Path(workFolder.name if workFolder else folder)
+    results = {"version": _version(),
+               "parameters": {"tracks": tracks, "seconds": seconds, "rate": rate, "workers": workers,
+                              "pairs": pairs, "weights": list(weights), "k": k, "seed": seed}}
+
+    paths = synthesizeCorpus(str(base / "songs"), tracks, seconds, rate, seed)
+    (base / "db").mkdir(exist_ok=True)
+    start = time.perf_counter()
+    updateDB(str(base / "songs"), str(base / "db") + "/", "w", workers=workers)
+    ingest = time.perf_counter() - start
+    results["ingest"] = {"seconds": ingest, "files_per_s": tracks / ingest, "audio_s_per_s": tracks * seconds / ingest}
+
+    index = hashIndex.fromPath(str(base / "db" / "db.json"))
+    stages = {"decode": [], "_spectrogram": [], "spectralFeatures": [], "analyze": [],
+              "createPerceptualHash": [], "search": []}
+    for path in paths[:min(len(paths), 5)]:
+        (data, songRate), ms = _timed(loader.mp3ToData, path, 60000)
+        stages["decode"].append(ms)
+        (_, _, mesh), ms = _timed(spectrogram()._spectrogram, data, songRate)
+        stages["_spectrogram"].append(ms)
+        stages["spectralFeatures"].append(_timed(spectrogram().spectralFeatures, data, mesh, songRate)[1])
+        (mesh, features), ms = _timed(spectrogram().analyze, data, songRate)
+        stages["analyze"].append(ms)
+        hashes, ms = _timed(lambda: [createPerceptualHash(matrix) for matrix in (mesh,) + tuple(features)])
+        stages["createPerceptualHash"].append(ms / len(hashes))
+        stages["search"].append(_timed(index.search, packRecord(hashes[0], hashes[1:]), k)[1])
+    results["latency_ms"] = {stage: {"mean": float(np.mean(times)), "max": float(np.max(times))}
+                             for stage, times in stages.items()}
+
+    rng = np.random.default_rng(seed + 1)
+    decoded = {path.stem: loader.mp3ToData(path, 60000) for path in paths}
+    results["batch"] = _batchThroughput([data for data, _ in decoded.values()], rate)
+    recall = {}
+    queryTimes = []
+    for weight in weights:
+        hits = {"recall@1": 0, "recall@%s" % k: 0, "both@%s" % k: 0}
+        for _ in range(pairs):
+            first, second = rng.choice(len(paths), 2, replace=False)
+            names = paths[first].stem, paths[second].stem
+            start = time.perf_counter()
+            mix = mixSongs(decoded[names[0]][0], decoded[names[1]][0], w=weight)
+            spectroHash, featureHashes = hashAudio(mix, decoded[names[0]][1])
+            found = [song for song, _ in index.search(packRecord(spectroHash, featureHashes), k)]
+            queryTimes.append((time.perf_counter() - start) * 1000)
+            hits["recall@1"] += found[0] == names[0]
+            hits["recall@%s" % k] += names[0] in found
+            hits["both@%s" % k] += names[0] in found and names[1] in found
+        recall[str(weight)] = {name: value / pairs for name, value in hits.items()}
+    results["recall"] = recall
+    results["query_ms"] = {"mean": float(np.mean(queryTimes)), "p95": float(np.percentile(queryTimes, 95))}
+    results["peak_rss"] = _peakRss()
+
+    if workFolder:
+        workFolder.cleanup()
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import warnings
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description="Benchmark ingest, query latency and recall on a synthesized corpus")
+    parser.add_argument("--tracks", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--rate", type=int, default=22050)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--pairs", type=int, default=20)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark.json", help="json file the results are saved in")
+    args = parser.parse_args()
+
+    results = runBenchmark(args.tracks, args.seconds, args.rate, args.workers, args.pairs, k=args.k, seed=args.seed)
+    with open(args.out, "w") as outFile:
+        json.dump(results, outFile, indent=4)
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,190 @@
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+import loader
+from Spectrogram import spectrogram
+
+
+def makeKey(*parts) -> str:
+    """
+    Creates a content address from the given parts (digests, windows, parameters ..)
+
+    :param parts: any values with a stable repr
+    :return: hex sha1 of the parts
+    """
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+class lruCache():
+    """
+    Content addressed cache of numpy arrays implements the following :
+
+    - Holds tuples of arrays in memory, evicting the least recently used ones past a byte budget
+    - Optionally keeps every entry on disk as .npy files, reopened memory mapped after eviction
+    """
+    def __init__(self, byteBudget: int = 512 * 2**20, diskPath: str = None):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - byteBudget : maximum number of bytes held in memory
+        - diskPath : directory of the on-disk tier, memory only if not given
+        """
+        self.byteBudget = byteBudget
+        self.diskPath = Path(diskPath) if diskPath else None
+        self.entries = OrderedDict()  # key -> tuple of arrays, least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple:
+        """
+        Gets the arrays stored under the key
+
+        Parameters
+        -----------
+        - key : content address of the entry (see makeKey)
+
+        Returns
+        -----------
+        - the tuple of arrays or None if the key is not cached
+        """
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        value = self._readDisk(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._remember(key, value)
+        return value
+
+    def put(self, key: str, value: tuple) -> tuple:
+        """
+        Stores a tuple of arrays under the key
+
+        Parameters
+        -----------
+        - key : content address of the entry (see makeKey)
+        - value : tuple of numpy arrays
+        """
+        value = tuple(value)
+        self._remember(key, value)
+        if self.diskPath:
+            self._writeDisk(key, value)
+        return value
+
+    def _remember(self, key: str, value: tuple):
+        """
+        Inserts an entry in memory and evicts the least recently used ones over the budget
+        """
+        size = sum(array.nbytes for array in value)
+        with self._lock:
+            if key in self.entries:
+                self.bytes -= sum(array.nbytes for array in self.entries.pop(key))
+            if size > self.byteBudget:
+                return
+            self.entries[key] = value
+            self.bytes += size
+            while self.bytes > self.byteBudget:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= sum(array.nbytes for array in evicted)
+
+    def _writeDisk(self, key: str, value: tuple):
+        """
+        Saves the arrays of an entry in their own directory, renamed into place when complete
+        """
+        entryPath = self.diskPath / key
+        if entryPath.exists():
+            return
+        self.diskPath.mkdir(parents=True, exist_ok=True)
+        tempPath = Path(tempfile.mkdtemp(suffix=".tmp", prefix=key + ".", dir=self.diskPath))  # one per writer
+        for i, array in enumerate(value):
+            np.save(tempPath / ("%s.npy" % i), array)
+        try:
+            os.rename(tempPath, entryPath)
+        except OSError:
+            shutil.rmtree(tempPath, ignore_errors=True)  # written meanwhile by another thread or process
+
+    def _readDisk(self, key: str) -> tuple:
+        """
+        Opens the memory mapped arrays of an entry saved on disk
+        """
+        if not self.diskPath or not (self.diskPath / key).is_dir():
+            return None
+        files = sorted((self.diskPath / key).glob("*.npy"), key=lambda file: int(file.stem))
+        return tuple(np.load(file, mmap_mode="r") for file in files)
+
+
+defaultCache = lruCache(diskPath=os.environ.get("VOICE_CACHE_DIR"))  # shared by the application
+_digests = {}  # (path, size, mtime) -> file digest
+
+
+def sourceKey(filePath: str, offset: float = 0, duration: float = None) -> str:
+    """
+    Content address of a decoded window of a file, the file digest is only recomputed
+    when the file size or mtime changes
+
+    :param filePath: relative path of the file
+    :param offset: start of the window in seconds
+    :param duration: length of the window in seconds
+    :return: key of the decoded window
+    """
+    stat = os.stat(filePath)
+    fileId = (str(filePath), stat.st_size, stat.st_mtime)
+    if fileId not in _digests:
+        _digests[fileId] = loader.fileDigest(filePath)
+    return makeKey("pcm", _digests[fileId], offset, duration)
+
+
+def cachedDecode(filePath: str, fMilliSeconds: float = None, cache: lruCache = defaultCache,
+                 targetRate: int = None) -> tuple:
+    """
+    Loads an audio file like loader.loadCanonical, reusing a previous decode of the same content
+
+    :param filePath: relative path of the file
+    :param fMilliSeconds: number of milliseconds to load, if not it will load all the file
+    :param cache: the cache used
+    :param targetRate: canonical sample rate, the legacy decoding of loader.mp3ToData if None
+    :return: data of song, frame rate and the key of the decoded data
+    """
+    key = sourceKey(filePath, 0, fMilliSeconds)
+    if targetRate:
+        key = makeKey(key, "canonical", targetRate)
+    value = cache.get(key)
+    if value is None:
+        data, rate = loader.loadCanonical(filePath, fMilliSeconds, targetRate)
+        value = cache.put(key, (data, np.array(rate)))
+    return value[0], int(value[1]), key
+
+
+def cachedAnalysis(songData: np.ndarray, songSR: int, dataKey: str, windowType: str = "hann",
+                   cache: lruCache = defaultCache) -> tuple:
+    """
+    Runs spectrogram.analyze, reusing a previous result for the same data and parameters
+
+    :param songData: a numpy array of the audio
+    :param songSR: integer representing the sample rate
+    :param dataKey: content address of songData (see sourceKey and makeKey)
+    :param windowType: window used in creating the spectrogram
+    :param cache: the cache used
+    :return: the color mesh and a tuple of the three features (mel, mfcc, chroma)
+    """
+    key = makeKey("analysis", dataKey, songSR, windowType)
+    value = cache.get(key)
+    if value is None:
+        mesh, features = spectrogram().analyze(songData, songSR, windowType)
+        value = cache.put(key, (mesh,) + tuple(features))
+    return value[0], value[1:]
@@ -0,0 +1,213 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import json
+import time
+import numpy as np
+import loader
+from cache import cachedDecode
+from hashIndex import HASH_COLUMNS, hashIndex
+from mixing import mixAnalysis
+from scoring import FEATURES
+
+RANK_BUCKETS = (1, 2, 3, 5, 10)  # upper bounds of the reported rank buckets, the last one is open
+
+
+def featureSets() -> dict:
+    """
+    Columns compared by every evaluated combination: all of them, every feature alone and
+    all of them but one (what a feature adds to the others)
+
+    :return: dictionary of combination name -> list of columns
+    """
+    sets = {"all": list(range(HASH_COLUMNS))}
+    sets.update((name, [column]) for column, name in enumerate(FEATURES))
+    sets.update(("without_" + name, [other for other in range(HASH_COLUMNS) if other != column])
+                for column, name in enumerate(FEATURES))
+    return sets
+
+
+def _rank(total: np.ndarray, row: int) -> int:
+    """
+    Rank (1 = best) of a row in the order of hashIndex.search, by distance then row
+    """
+    return int(np.count_nonzero(total < total[row]) + np.count_nonzero(total[:row] == total[row]) + 1)
+
+
+_indexes = {}  # db path -> hashIndex, opened once per process
+
+
+def evaluatePair(dbPath: str, paths: tuple, rows: tuple, weights: list, fMilliSeconds: float = 60000,
+                 sharedTuning: bool = False) -> dict:
+    """
+    Mixes a pair of songs at every weight, hashes the mixes and ranks both songs in the database
+    for every combination of features, runs in the worker processes
+
+    :param dbPath: path of the json database, its binary index is memory mapped
+    :param paths: paths of the two audio files
+    :param rows: rows of the two songs in the index
+    :param weights: weights of the first song
+    :param fMilliSeconds: number of milliseconds loaded from every song
+    :param sharedTuning: estimate the chroma tuning once for the pair (see mixing.mixAnalysis)
+    :return: dictionary of the ranks of both songs per weight and combination and the time spent
+    """
+    if dbPath not in _indexes:
+        _indexes[dbPath] = hashIndex.fromPath(dbPath)
+    index = _indexes[dbPath]
+
+    start = time.perf_counter()
+    targetRate = loader.readFrontEnd(dbPath)  # both songs at the rate of the database, mixable whatever their sources
+    (data1, rate, _), (data2, _, _) = [cachedDecode(path, fMilliSeconds, targetRate=targetRate) for path in paths]
+    decode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    records = mixAnalysis(data1, data2, rate, sharedTuning=sharedTuning).records(weights)
+    hashing = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ranks = {}
+    for w, record in zip(weights, records):
+        distances = index.distances(record)
+        ranks[w] = {name: [_rank(distances[:, columns].sum(axis=1), row) for row in rows]
+                    for name, columns in featureSets().items()}
+    search = time.perf_counter() - start
+    return {"ranks": ranks, "timings_ms": {"decode": decode * 1000, "hash": hashing * 1000 / len(weights),
+                                           "search": search * 1000 / len(weights)}}
+
+
+def _songPaths(dbPath: str, songsPath: str = None) -> dict:
+    """
+    Audio file of every song, from the manifest written by updateDB or from a folder
+    """
+    manifest = Path(dbPath).with_name("manifest.json")
+    if songsPath is None and manifest.exists():
+        return {name: entry["path"] for name, entry in json.loads(manifest.read_text()).items()}
+    return {name: str(path) for name, path in loader.loadPath(songsPath or "Songs/")}
+
+
+def runEvaluation(dbPath: str = "Database/db.json", songsPath: str = None, pairs: int = 100,
+                  weights: tuple = (0.5, 0.6, 0.7, 0.8, 0.9), jobs: int = 1, seed: int = 0,
+                  fMilliSeconds: float = 60000, sharedTuning: bool = False) -> dict:
+    """
+    Evaluates the recognition of mixed songs over random pairs of the catalogue.
+
+    Implements the following :
+
+    - Samples random pairs of songs present both in the database and on disk
+    - Mixes every pair at every weight on the fly and ranks both songs in the database,
+      across a pool of processes
+    - Reports per weight and per combination of features the top-1 accuracy (the first song
+      ranked first), the top-2 accuracy (both songs in the first two), the rank distribution
+      of both songs and the time spent per query
+
+    ============= ==========================================
+    **Arguments**
+    dbPath        A string path to the json database.
+    songsPath     Folder of the songs, the paths of manifest.json if not given.
+    pairs         Number of sampled pairs.
+    weights       Weights of the first song of every pair.
+    jobs          Number of processes evaluating pairs.
+    seed          Seed of the sampled pairs.
+    fMilliSeconds Number of milliseconds loaded from every song.
+    sharedTuning  Estimate the chroma tuning once per pair (faster, see mixing.mixAnalysis).
+    ============= ==========================================
+
+    :return: dictionary of the results
+    """
+    index = hashIndex.fromPath(dbPath)
+    paths = _songPaths(dbPath, songsPath)
+    rows = {name: row for row, name in enumerate(index.names) if name in paths}
+    names = sorted(rows)
+    if len(names) < 2:
+        raise ValueError("at least two songs of %s must be found on disk" % dbPath)
+
+    rng = np.random.default_rng(seed)
+    sampled = [tuple(names[i] for i in rng.choice(len(names), 2, replace=False)) for _ in range(pairs)]
+    weights = [float(w) for w in weights]
+    sets = list(featureSets())
+    ranks = {w: {name: [] for name in sets} for w in weights}  # weight -> combination -> [(rank1, rank2)]
+    timings = {"decode": [], "hash": [], "search": []}
+    errors = []
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = {executor.submit(evaluatePair, dbPath, (paths[first], paths[second]),
+                                   (rows[first], rows[second]), weights, fMilliSeconds, sharedTuning): (first, second)
+                   for first, second in sampled}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                errors.append({"pair": futures[future], "error": repr(error)})
+                continue
+            for w, pairRanks in result["ranks"].items():
+                for name, pairRank in pairRanks.items():
+                    ranks[w][name].append(pairRank)
+            for stage, ms in result["timings_ms"].items():
+                timings[stage].append(ms)
+    elapsed = time.perf_counter() - start
+
+    report = {"parameters": {"db": dbPath, "songs": len(index), "pairs": pairs, "weights": weights,
+                             "seed": seed, "shared_tuning": sharedTuning},
+              "accuracy": {}, "ranks": {}, "errors": errors,
+              "timings_ms": {stage: float(np.mean(times)) if times else None for stage, times in timings.items()},
+              "seconds": elapsed}
+    for w in weights:
+        report["accuracy"][str(w)], report["ranks"][str(w)] = {}, {}
+        for name in sets:
+            pairRanks = np.array(ranks[w][name]).reshape(-1, 2)
+            if len(pairRanks) == 0:
+                continue
+            report["accuracy"][str(w)][name] = {
+                "top1": float(np.mean(pairRanks[:, 0] == 1)),
+                "top2": float(np.mean(np.max(pairRanks, axis=1) <= 2)),
+                "mean_rank": [float(mean) for mean in pairRanks.mean(axis=0)]}
+            report["ranks"][str(w)][name] = {"first": _buckets(pairRanks[:, 0]), "second": _buckets(pairRanks[:, 1])}
+    return report
+
+
+def _buckets(ranks: np.ndarray) -> dict:
+    """
+    Share of the ranks in every bucket of RANK_BUCKETS
+    """
+    buckets, low = {}, 1
+    for high in RANK_BUCKETS:
+        name = str(high) if high == low else "%s-%s" % (low, high)
+        buckets[name] = float(np.mean((ranks >= low) & (ranks <= high)))
+        low = high + 1
+    buckets[">%s" % RANK_BUCKETS[-1]] = float(np.mean(ranks > RANK_BUCKETS[-1]))
+    return buckets
+
+
+if __name__ == '__main__':
+    import argparse
+    import warnings
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description="Evaluate mixed song recognition over random pairs of the catalogue")
+    parser.add_argument("--db", default="Database/db.json", help="json database built by updateDB")
+    parser.add_argument("--songs", help="folder of the songs, the paths of manifest.json if not given")
+    parser.add_argument("--pairs", type=int, default=100)
+    parser.add_argument("--weights", type=float, nargs="+", default=[0.5, 0.6, 0.7, 0.8, 0.9])
+    parser.add_argument("--jobs", type=int, default=1, help="processes evaluating pairs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--seconds", type=float, default=60, help="seconds loaded from every song")
+    parser.add_argument("--shared-tuning", action="store_true", help="estimate the chroma tuning once per pair")
+    parser.add_argument("--out", help="json file the full report is saved in")
+    args = parser.parse_args()
+
+    report = runEvaluation(args.db, args.songs, args.pairs, args.weights, args.jobs, args.seed,
+                           args.seconds * 1000, args.shared_tuning)
+    if args.out:
+        with open(args.out, "w") as outFile:
+            json.dump(report, outFile, indent=4)
+
+    sets = list(featureSets())
+    print("%-8s" % "weight" + "".join("%22s" % name for name in sets))
+    for w, accuracy in report["accuracy"].items():
+        print("%-8s" % w + "".join("%22s" % ("%.2f / %.2f" % (accuracy[name]["top1"], accuracy[name]["top2"]))
+                                   for name in sets if name in accuracy))
+    print("top-1 / top-2 accuracy, %s pairs in %.1f s, ms per query : %s"
+          % (args.pairs, report["seconds"], json.dumps(report["timings_ms"])))
+    if report["errors"]:
+        print("%s pairs failed, see the report" % len(report["errors"]))
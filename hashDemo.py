@@ -1,4 +1,5 @@
 from helpers import *
+from Spectrogram import spectrogram
 from math import ceil
 
 hammingDifferences = []        # List contains the hamming distance of spectrogram hashes of all the songs and the mix
@@ -25,10 +26,7 @@ songs = [song1, song2, song3, song4, song5, song6]
 
 # Mix 2 songs -> Create Spectrogram -> Create Hash
 mixedSong = mixSongs(song1['data'], song2['data'], w=weight)
-sampleFrequency, sampleTime, colorMesh = signal.spectrogram(mixedSong, fs=song1['sRate'], window='hann')
-f1 = l.feature.melspectrogram(y= mixedSong, S=colorMesh, sr=song1['sRate'], window = 'hann')
-f2 = l.feature.mfcc(y= mixedSong.astype('float64'), sr=song1['sRate'])
-f3 = l.feature.chroma_stft(y= mixedSong, S=colorMesh, sr=song1['sRate'], window = 'hann')
+colorMesh, (f1, f2, f3) = spectrogram().analyze(mixedSong, song1['sRate'], 'hann')
 
 hashMix = createPerceptualHash(colorMesh)
 f1HashMix = createPerceptualHash(f1)
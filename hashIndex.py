@@ -0,0 +1,454 @@
+from pathlib import Path
+import os
+import struct
+import numpy as np
+from metrics import timed
+
+HASH_BITS = 256  # bits of every perceptual hash (hash_size=16)
+HASH_WORDS = HASH_BITS // 64  # uint64 words holding a single hash
+HASH_COLUMNS = 4  # spectrogram hash + mel, mfcc and chroma hashes
+RECORD_WORDS = HASH_WORDS * HASH_COLUMNS  # uint64 words in one song record
+
+_MAGIC = b"VRIX"
+_VERSION = 2
+# magic, version, number of records, words per record, then the byte offsets of the record,
+# duration, rate, name offset and name bytes sections and the size of the name bytes
+_HEADER = struct.Struct("<4sIQIQQQQQQ")
+_ALIGN = 64  # every section starts on a cache line
+_SCAN_ROWS = 1 << 15  # rows XORed per block while scanning
+_BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def packHash(hexHash: str) -> np.ndarray:
+    """
+    Packs a hex perceptual hash (output of createPerceptualHash) into uint64 words
+
+    :param hexHash: hex string of a 256 bit hash
+    :return: array of HASH_WORDS uint64 words
+    """
+    return np.frombuffer(bytes.fromhex(hexHash), dtype=">u8").astype(np.uint64)
+
+
+def packRecord(spectroHash: str, featureHashes: list) -> np.ndarray:
+    """
+    Packs the spectrogram hash and the three feature hashes of a song into one record
+
+    :param spectroHash: hex string of the spectrogram hash
+    :param featureHashes: list of the hex strings of the mel, mfcc and chroma hashes
+    :return: array of RECORD_WORDS uint64 words
+    """
+    return np.concatenate([packHash(h) for h in [spectroHash] + list(featureHashes)])
+
+
+def unpackHash(words: np.ndarray) -> str:
+    """
+    Converts packed uint64 words back to the hex string used in db.json
+
+    :param words: array of HASH_WORDS uint64 words
+    :return: hex string of the hash
+    """
+    return np.asarray(words, dtype=np.uint64).astype(">u8").tobytes().hex()
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """
+    Counts the set bits of every uint64 word
+
+    :param words: array of uint64 words
+    :return: array of the same shape holding the number of set bits of each word
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    byteCounts = _BYTE_POPCOUNT[np.ascontiguousarray(words).view(np.uint8)]
+    return byteCounts.reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def hammingDistances(matrix: np.ndarray, query: np.ndarray, columns=None) -> np.ndarray:
+    """
+    Calculates the hamming distance of each hash of every packed record to the query
+
+    :param matrix: uint64 matrix of packed records, shape (rows, RECORD_WORDS)
+    :param query: a packed record (see packRecord)
+    :param columns: hashes compared (0 spectrogram, 1 mel, 2 mfcc, 3 chroma), all of them if not given
+    :return: an int matrix of shape (rows, HASH_COLUMNS) or (rows, len(columns))
+    """
+    query = np.asarray(query, dtype=np.uint64)
+    words = None
+    if columns is not None:
+        words = (np.asarray(columns, dtype=np.intp)[:, None] * HASH_WORDS + np.arange(HASH_WORDS)).ravel()
+        query = query[words]
+    count = len(query) // HASH_WORDS
+    diff = np.empty((len(matrix), count), dtype=np.int32)
+    xorBuffer = np.empty((min(_SCAN_ROWS, len(matrix)), len(query)), dtype=np.uint64)
+    # scanning in blocks keeps the temporaries in cache instead of allocating N x 16 words per query
+    for first in range(0, len(matrix), _SCAN_ROWS):
+        block = matrix[first:first + _SCAN_ROWS]
+        if words is not None:
+            block = block[:, words]
+        xored = np.bitwise_xor(block, query, out=xorBuffer[:len(block)])
+        bits = popcount(xored).reshape(len(block), count, HASH_WORDS)
+        diff[first:first + len(block)] = bits.sum(axis=-1, dtype=np.int32)
+    return diff
+
+
+def similarity(totalDistance) -> np.ndarray:
+    """
+    Maps the summed hamming distance of the four hashes to a similarity percentage,
+    the same mapping __compareHash applies to the average distance
+
+    :param totalDistance: sum of the hamming distances of the four hashes
+    :return: similarity percentage
+    """
+    return np.abs(1 - (np.asarray(totalDistance) / HASH_COLUMNS) / (HASH_BITS - 1)) * 100
+
+
+def bestPositions(rows: np.ndarray, total: np.ndarray, k: int = None) -> np.ndarray:
+    """
+    Positions of the k smallest distances sorted by distance then row, the rows tied with
+    the k-th distance are taken by smallest row, so the result is the one of a full sort
+
+    :param rows: row of every candidate
+    :param total: distance of every candidate
+    :param k: number of positions, all of them if not given
+    :return: array of positions into rows and total
+    """
+    keep = np.arange(len(rows))
+    if k is not None and k <= 0:
+        return keep[:0]
+    if k is not None and k < len(rows):
+        keep = np.argpartition(total, k - 1)[:k]
+        kth = total[keep].max()
+        below = np.flatnonzero(total < kth)
+        tied = np.flatnonzero(total == kth)
+        keep = np.concatenate([below, tied[np.argsort(rows[tied], kind="stable")[:k - len(below)]]])
+    return keep[np.lexsort((rows[keep], total[keep]))]
+
+
+def _aligned(position: int) -> int:
+    return -(-position // _ALIGN) * _ALIGN
+
+
+class stringTable():
+    """
+    Read only list of strings kept as utf-8 bytes and their offsets, a string is only
+    decoded when it is accessed so a memory mapped table opens without reading it
+    """
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - offsets : int64 array of len(strings) + 1 byte offsets in data
+        - data : uint8 array of the concatenated utf-8 strings
+        """
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def fromList(cls, strings: list) -> "stringTable":
+        """
+        Encodes a list of strings into a table
+        """
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return cls(offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("string index out of range")
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class hashIndex():
+    """
+    Packed binary index of the database hashes implements the following :
+
+    - Holds one fixed width record (4 x 256 bits) per song in a uint64 matrix, along
+      with the duration and the sample rate columns of the songs
+    - Saves the columns and a string table of the names in a binary file that is opened
+      memory mapped, nothing is read until it is used and the pages are shared by processes
+    - Searches the whole matrix with a single vectorized XOR + popcount pass
+    """
+    def __init__(self, names: list, matrix: np.ndarray, durations: np.ndarray = None, rates: np.ndarray = None):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - names : list (or stringTable) of the song names, one per row
+        - matrix : uint64 matrix of shape (len(names), RECORD_WORDS)
+        - durations : duration in seconds of every song, NaN if unknown
+        - rates : sample rate of every song, 0 if unknown
+        """
+        self.names = names if isinstance(names, stringTable) else list(names)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.uint64).reshape(len(self.names), RECORD_WORDS)
+        self.durations = np.full(len(self.names), np.nan, dtype=np.float32) if durations is None else durations
+        self.rates = np.zeros(len(self.names), dtype=np.uint32) if rates is None else rates
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def fromJson(cls, file: str) -> "hashIndex":
+        """
+        Builds the index from a db.json created by updateDB
+
+        Parameters
+        -----------
+        - file : a string path to the json database
+        """
+        from updateDB import readJson
+
+        names, rows, durations, rates = [], [], [], []
+        for songName, songHashes in readJson(file):
+            names.append(songName)
+            rows.append(packRecord(songHashes["spectrohash"], songHashes["features"]))
+            durations.append(songHashes.get("duration", np.nan))
+            rates.append(songHashes.get("rate", 0))
+        matrix = np.vstack(rows) if rows else np.empty((0, RECORD_WORDS), dtype=np.uint64)
+        return cls(names, matrix, np.array(durations, dtype=np.float32), np.array(rates, dtype=np.uint32))
+
+    @classmethod
+    def load(cls, file: str) -> "hashIndex":
+        """
+        Opens an index saved with save(), every column is a read only view of the memory mapped file
+
+        Parameters
+        -----------
+        - file : a string path to the binary index
+        """
+        raw = np.memmap(file, dtype=np.uint8, mode="r")
+        if len(raw) < _HEADER.size:
+            raise ValueError("%s is not a supported hash index" % file)
+        magic, version, count, words, records, durations, rates, nameOffsets, names, nameBytes = \
+            _HEADER.unpack(raw[:_HEADER.size].tobytes())
+        if magic != _MAGIC or version != _VERSION or words != RECORD_WORDS:
+            raise ValueError("%s is not a supported hash index" % file)
+
+        def column(offset, dtype, length):
+            return raw[offset:offset + length * np.dtype(dtype).itemsize].view(dtype)
+
+        return cls(stringTable(column(nameOffsets, "<i8", count + 1), raw[names:names + nameBytes]),
+                   column(records, "<u8", count * words).reshape(count, words),
+                   column(durations, "<f4", count), column(rates, "<u4", count))
+
+    @classmethod
+    def fromPath(cls, dbPath: str) -> "hashIndex":
+        """
+        Opens the binary index saved next to a json database, (re)building it
+        when it is missing or older than the json file, a database hashed by an
+        older feature pipeline is refused (see loader.checkFeatureVersion)
+
+        Parameters
+        -----------
+        - dbPath : a string path to the json database (e.g Database/db.json)
+        """
+        from loader import checkFeatureVersion
+        checkFeatureVersion(dbPath)
+        jsonPath = Path(dbPath)
+        indexPath = jsonPath.with_suffix(".idx")
+        if indexPath.exists() and indexPath.stat().st_mtime >= jsonPath.stat().st_mtime:
+            try:
+                return cls.load(str(indexPath))
+            except ValueError:
+                pass  # written by an older version, converted again
+        index = cls.fromJson(str(jsonPath))
+        index.save(str(indexPath))
+        return index
+
+    def updated(self, records: dict, keep=None) -> "hashIndex":
+        """
+        Builds the next version of the index without converting the whole json database
+
+        Parameters
+        -----------
+        - records : db.json records (name -> {"spectrohash", "features", ...}) of the new or re-hashed songs
+        - keep : names of the songs still in the database, the other rows are dropped (all kept if not given)
+
+        Returns
+        -----------
+        - a new index, the unchanged rows keep their order and the records are appended
+        """
+        names = list(self.names)
+        rows = [row for row, name in enumerate(names) if name not in records and (keep is None or name in keep)]
+        added = list(records)
+        matrix = [packRecord(records[name]["spectrohash"], records[name]["features"]) for name in added]
+        return hashIndex([names[row] for row in rows] + added,
+                         np.concatenate([self.matrix[rows], np.array(matrix, dtype=np.uint64).reshape(-1, RECORD_WORDS)]),
+                         np.concatenate([self.durations[rows], np.array([records[name].get("duration", np.nan)
+                                                                         for name in added], dtype=np.float32)]),
+                         np.concatenate([self.rates[rows], np.array([records[name].get("rate", 0)
+                                                                     for name in added], dtype=np.uint32)]))
+
+    def save(self, file: str):
+        """
+        Saves the index as a header followed by the record, duration, rate and name columns.
+        The file is replaced atomically so processes that mapped the old one keep reading it.
+
+        Parameters
+        -----------
+        - file : a string path to the output file
+        """
+        names = self.names if isinstance(self.names, stringTable) else stringTable.fromList(self.names)
+        sections = [self.matrix.astype("<u8", copy=False), np.asarray(self.durations, dtype="<f4"),
+                    np.asarray(self.rates, dtype="<u4"), np.asarray(names.offsets, dtype="<i8"),
+                    np.asarray(names.data, dtype=np.uint8)]
+        offsets = []
+        position = _HEADER.size
+        for section in sections:
+            position = _aligned(position)
+            offsets.append(position)
+            position += section.nbytes
+
+        tempFile = "%s.%s.tmp" % (file, os.getpid())
+        with open(tempFile, "wb") as outFile:
+            outFile.write(_HEADER.pack(_MAGIC, _VERSION, len(self), RECORD_WORDS, *offsets, sections[-1].nbytes))
+            for offset, section in zip(offsets, sections):
+                outFile.write(b"\0" * (offset - outFile.tell()))
+                outFile.write(np.ascontiguousarray(section).tobytes())
+        os.replace(tempFile, file)
+
+    def distances(self, query: np.ndarray, start: int = 0, stop: int = None, columns=None) -> np.ndarray:
+        """
+        Calculates the hamming distance of each hash of every song to the query
+
+        Parameters
+        -----------
+        - query : a packed record (see packRecord)
+        - start, stop : range of rows compared, all rows if not given
+        - columns : hashes compared, all of them if not given (see hammingDistances)
+
+        Returns
+        -----------
+        - an int matrix of shape (stop - start, HASH_COLUMNS) or (stop - start, len(columns))
+        """
+        return hammingDistances(self.matrix[start:stop], query, columns)
+
+    def _best(self, rows: np.ndarray, total: np.ndarray, k: int = None) -> tuple:
+        """
+        Keeps the k rows of smallest distance sorted by distance then row
+        """
+        best = bestPositions(rows, total, k)
+        return rows[best], total[best]
+
+    def _results(self, rows: np.ndarray, total: np.ndarray) -> list:
+        """
+        Maps sorted rows to (songName, similarity percentage)
+        """
+        return [(self.names[row], float(score)) for row, score in zip(rows, similarity(total))]
+
+    @timed("search")
+    def search(self, query: np.ndarray, k: int = None) -> list:
+        """
+        Finds the k songs closest to the query
+
+        Parameters
+        -----------
+        - query : a packed record (see packRecord)
+        - k : number of results, all songs if not given
+
+        Returns
+        -----------
+        - a list of (songName, similarity percentage) sorted from best to worst match
+        """
+        total = self.distances(query).sum(axis=1)
+        return self._results(*self._best(np.arange(len(self)), total, k))
+
+    @timed("searchBatch")
+    def searchBatch(self, queries: np.ndarray, k: int = None, blockRows: int = 1 << 16) -> list:
+        """
+        Finds the k songs closest to every query in a single pass over the index, every block
+        of rows is compared with all the queries while it is in cache
+
+        Parameters
+        -----------
+        - queries : packed records (see packRecord) of shape (n, RECORD_WORDS)
+        - k : number of results per query, all songs if not given
+        - blockRows : number of rows compared with the queries at a time
+
+        Returns
+        -----------
+        - a list of the search() results of every query
+        """
+        return [self._results(rows, total) for rows, total in self.topRows(queries, k, blockRows)]
+
+    def topRows(self, queries: np.ndarray, k: int = None, blockRows: int = 1 << 16) -> list:
+        """
+        Rows and summed distances of the k songs closest to every query, see searchBatch
+
+        Parameters
+        -----------
+        - queries : packed records (see packRecord) of shape (n, RECORD_WORDS)
+        - k : number of results per query, all songs if not given
+        - blockRows : number of rows compared with the queries at a time
+
+        Returns
+        -----------
+        - a list of (rows, total distances) of every query sorted by distance then row
+        """
+        queries = np.asarray(queries, dtype=np.uint64).reshape(-1, RECORD_WORDS)
+        rows = [np.empty(0, dtype=np.intp) for _ in queries]
+        totals = [np.empty(0, dtype=np.int32) for _ in queries]
+        for start in range(0, len(self), blockRows):
+            stop = min(start + blockRows, len(self))
+            for i, query in enumerate(queries):
+                blockTotal = self.distances(query, start, stop).sum(axis=1)
+                rows[i], totals[i] = self._best(np.concatenate([rows[i], np.arange(start, stop)]),
+                                                np.concatenate([totals[i], blockTotal]), k)
+        return list(zip(rows, totals))
+
+    def searchBlocks(self, query: np.ndarray, k: int = None, blockRows: int = 1 << 16):
+        """
+        Searches the index block by block, reporting the best matches found so far
+
+        Parameters
+        -----------
+        - query : a packed record (see packRecord)
+        - k : number of results, all songs if not given
+        - blockRows : number of rows compared between two reports
+
+        Returns
+        -----------
+        - a generator of (fraction of the index searched, results so far), the last
+          results are the ones search() returns
+        """
+        rows = np.empty(0, dtype=np.intp)
+        total = np.empty(0, dtype=np.int32)
+        for start in range(0, max(len(self), 1), blockRows):
+            stop = min(start + blockRows, len(self))
+            blockTotal = self.distances(query, start, stop).sum(axis=1)
+            rows, total = self._best(np.concatenate([rows, np.arange(start, stop)]),
+                                     np.concatenate([total, blockTotal]), k)
+            yield (stop / len(self) if len(self) else 1.0), self._results(rows, total)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Convert a json database to the binary index and time a query")
+    parser.add_argument("dbPath", nargs="?", default="Database/db.json", help="json database built by updateDB")
+    parser.add_argument("--out", help="binary index written, db.idx next to the json file if not given")
+    args = parser.parse_args()
+
+    if args.out:
+        hashIndex.fromJson(args.dbPath).save(args.out)
+        index = hashIndex.load(args.out)
+    else:
+        index = hashIndex.fromPath(args.dbPath)
+    start = time.perf_counter()
+    results = index.search(index.matrix[0], 5)
+    print("searched %s songs in %.3f ms" % (len(index), (time.perf_counter() - start) * 1000))
+    print(results)
@@ -1,10 +1,13 @@
-from PIL import Image
-import imagehash
 from imagehash import hex_to_hash
 import numpy as np
-from scipy import signal
-from pydub import AudioSegment
 import librosa as l
+from phash import phash, toHex
+from metrics import timed
+from hashIndex import RECORD_WORDS
+
+# one row of hashAudioBatch, the 4 hashes (spectrogram, mel, mfcc, chroma) of a clip packed in one record
+BATCH_RESULT = np.dtype([("record", np.uint64, (RECORD_WORDS,)), ("frames", np.int32), ("seconds", np.float64)])
+BATCH_FRAMES = 2048  # spectrogram frames of the clips analyzed together by hashAudioBatch
 
 
 def loadAudioFile(filePath: str, fSeconds: float = None) -> dict:
@@ -15,13 +18,10 @@ def loadAudioFile(filePath: str, fSeconds: float = None) -> dict:
     :param fSeconds: number of seconds you want to load, if not it will load all the file
     :return: Dictionary contains songName, array of the data, sample rate, dataType of the array
     """
-    if fSeconds:
-        audioFile = AudioSegment.from_mp3(filePath)[:fSeconds]
-    else:
-        audioFile = AudioSegment.from_mp3(filePath)
+    from loader import mp3ToData
+
     songName = filePath.split('/')[-1].split('.mp3')[0]
-    songData = np.array(audioFile.get_array_of_samples())
-    sampleRate = audioFile.frame_rate
+    songData, sampleRate = mp3ToData(filePath, fSeconds)
     songDataType = songData.dtype
     songDictionary = {
         "name": songName,
@@ -64,14 +64,59 @@ def mixSongs(song1: np.ndarray, song2: np.ndarray, dType: str = 'int16', w: floa
     return (w*song1 + (1.0-w)*song2).astype(dType)
 
 
+@timed("createPerceptualHash")
 def createPerceptualHash(arrayData: "np.ndarray") -> str:
     """
     Creates a perceptual hash of the given data
     :param arrayData: an array contains the data to be hashed
     :return: a string describe the hashed array (could be converted to hex using hex_to_hash())
     """
-    dataInstance = Image.fromarray(arrayData)
-    return imagehash.phash(dataInstance, hash_size=16).__str__()
+    return toHex(phash([arrayData])[0])
+
+
+def hashAudio(songData: "np.ndarray", sampleRate: int) -> tuple:
+    """
+    Creates the spectrogram and the features of the given audio and hashes them
+    :param songData: data array of the audio
+    :param sampleRate: sample rate of the audio
+    :return: the spectrogram hash and a list of the mel, mfcc and chroma hashes
+    """
+    from Spectrogram import spectrogram
+
+    colorMesh, features = spectrogram().analyze(songData, sampleRate, 'hann')
+    hashes = [toHex(words) for words in phash((colorMesh,) + tuple(features))]
+    return hashes[0], hashes[1:]
+
+
+def hashAudioBatch(clips: "np.ndarray", sampleRate: int, lengths=None, batchFrames: int = BATCH_FRAMES) -> np.ndarray:
+    """
+    Hashes many clips at once like hashAudio hashes each of them (see spectrogram.analyzeBatch)
+    :param clips: 2-D array of one clip per row, zero padded at the end to the longest one
+    :param sampleRate: sample rate of the clips
+    :param lengths: samples of every clip before padding, all the row if not given
+    :param batchFrames: frames analyzed together, clips of similar lengths are grouped up to it
+    :return: structured array of one row per clip (see BATCH_RESULT), the record is packed like hashIndex.packRecord
+    """
+    from Spectrogram import spectrogram, SEGMENT_LENGTH, SEGMENT_STEP
+
+    clips = np.asarray(clips)
+    lengths = np.full(len(clips), clips.shape[1]) if lengths is None else np.asarray(lengths)
+    results = np.zeros(len(clips), dtype=BATCH_RESULT)
+    results["seconds"] = lengths / sampleRate
+
+    # sorted by length a group is padded to its own longest clip, and stays small enough to be cache friendly
+    order = np.argsort(lengths, kind="stable")
+    frames = np.maximum((lengths[order] - SEGMENT_LENGTH) // SEGMENT_STEP + 1, 1)
+    groups = np.split(order, np.flatnonzero(np.diff(np.cumsum(frames) // max(batchFrames, 1))) + 1)
+    for rows in groups:
+        meshes, features, counts = spectrogram().analyzeBatch(clips[rows, :lengths[rows].max()], sampleRate,
+                                                              'hann', lengths[rows])
+        matrices = []
+        for i, count in enumerate(counts):
+            matrices += [meshes[i, :, :count]] + [features[name][i, :, :count] for name in ("mel", "mfcc", "chroma")]
+        results["record"][rows] = phash(matrices).reshape(len(rows), -1)
+        results["frames"][rows] = counts
+    return results
 
 
 def getHammingDistance(hash1: str, hash2: str) -> int:
@@ -93,12 +138,8 @@ def loadSong(filePath: str, fSeconds: float = None) -> dict:
     :return: Dictionary contains songName, array of the data, sample rate, dataType of the array and the hashes
     """
     song = loadAudioFile(filePath, fSeconds)
-    sampleFreqs, sampleTime, colorMesh = signal.spectrogram(song['data'], fs=song['sRate'], window='hann')
-    features = _spectralFeatures(song=song['data'], S=colorMesh, sr=song['sRate'])
-    song['spectrogram_Hash'] = createPerceptualHash(colorMesh)
-    song['melspectrogram_Hash'] = createPerceptualHash(features[0])
-    song['mfcc_Hash'] = createPerceptualHash(features[1])
-    song['chroma_stft_Hash'] = createPerceptualHash(features[2])
+    song['spectrogram_Hash'], features = hashAudio(song['data'], song['sRate'])
+    song['melspectrogram_Hash'], song['mfcc_Hash'], song['chroma_stft_Hash'] = features
     return song
 
 
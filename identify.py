@@ -0,0 +1,172 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import json
+import sys
+import time
+import loader
+from Spectrogram import spectrogram
+from helpers import createPerceptualHash
+from hashIndex import hashIndex, packRecord
+from segments import segmentIndex
+from scoring import scoringProfile
+from metrics import defaultMetrics
+
+_segmentIndexes = {}  # index file -> segmentIndex, loaded once per process
+_profiled = {}  # (db path, profile file) -> (hashIndex, scoringProfile), loaded once per process
+
+
+def hashClip(path: str, fMilliSeconds: float = 60000, targetRate: int = None) -> dict:
+    """
+    Loads a clip and hashes it exactly like the search of voiceRecognizer
+
+    :param path: path of the audio clip
+    :param fMilliSeconds: number of milliseconds loaded from the start of the clip
+    :param targetRate: canonical sample rate of the database (see loader.readFrontEnd), None for legacy hashes
+    :return: dictionary of the clip path, its hashes and the time (ms) spent in every stage
+    """
+    timings = {}
+    start = time.perf_counter()
+    data, rate = loader.loadCanonical(path, fMilliSeconds, targetRate)
+    timings["decode"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    mesh, features = spectrogram().analyze(data, rate)
+    timings["analyze"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    spectroHash = createPerceptualHash(mesh)
+    featureHashes = [createPerceptualHash(feature) for feature in features]
+    timings["hash"] = (time.perf_counter() - start) * 1000
+    return {"clip": str(path), "spectrohash": spectroHash, "features": featureHashes, "timings_ms": timings}
+
+
+def segmentClip(path: str, indexFile: str, topK: int = 5, fMilliSeconds: float = 60000,
+                targetRate: int = None) -> dict:
+    """
+    Loads a clip and matches its windows against the window index built by updateDB --segments
+
+    :param path: path of the audio clip
+    :param indexFile: path of segments.npz
+    :param topK: number of matches reported
+    :param fMilliSeconds: number of milliseconds loaded from the start of the clip
+    :param targetRate: canonical sample rate of the database, None for legacy hashes
+    :return: dictionary of the clip path, its matches with their offsets and the time (ms) spent in every stage
+    """
+    if indexFile not in _segmentIndexes:
+        _segmentIndexes[indexFile] = segmentIndex.load(indexFile)
+    timings = {}
+    start = time.perf_counter()
+    data, rate, channels = loader.decodeWindow(path, 0, fMilliSeconds / 1000)
+    if targetRate:
+        (data, rate), channels = loader.canonical(data, rate, channels, targetRate), 1
+    timings["decode"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    matches = _segmentIndexes[indexFile].query(data, rate, channels, topK)
+    timings["search"] = (time.perf_counter() - start) * 1000
+    return {"clip": str(path), "timings_ms": timings,
+            "matches": [{"song": song, "similarity": score, "offset": offset} for song, score, offset in matches]}
+
+
+def profileClip(path: str, dbPath: str, profileFile: str, topK: int = 5, fMilliSeconds: float = 60000,
+                targetRate: int = None) -> dict:
+    """
+    Loads a clip and scores it with a scoring profile, only the features the profile needs are extracted
+
+    :param path: path of the audio clip
+    :param dbPath: path of the json database, its binary index is memory mapped
+    :param profileFile: path of the json scoring profile (see scoring.scoringProfile.fromFile)
+    :param topK: number of matches reported
+    :param fMilliSeconds: number of milliseconds loaded from the start of the clip
+    :param targetRate: canonical sample rate of the database, None for legacy hashes
+    :return: dictionary of the clip path, its matches, the stages run and the time (ms) spent in every stage
+    """
+    if (dbPath, profileFile) not in _profiled:
+        _profiled[dbPath, profileFile] = hashIndex.fromPath(dbPath), scoringProfile.fromFile(profileFile)
+    index, profile = _profiled[dbPath, profileFile]
+    timings = {}
+    start = time.perf_counter()
+    data, rate = loader.loadCanonical(path, fMilliSeconds, targetRate)
+    timings["decode"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    mesh = spectrogram()._spectrogram(data, rate)[2]
+    matches = profile.search(index, mesh, rate, topK)
+    timings["search"] = (time.perf_counter() - start) * 1000
+    return {"clip": str(path), "timings_ms": timings, "scoring": profile.lastStats,
+            "matches": [{"song": song, "similarity": score} for song, score in matches]}
+
+
+def identify(clips: list, dbPath: str = "Database/db.json", topK: int = 5, jobs: int = 1,
+             fMilliSeconds: float = 60000, segments: bool = False, profile: str = None):
+    """
+    Identifies many clips against the database in one process, the index is loaded once
+    and the clips are decoded and hashed across a pool of processes.
+
+    ============= ==========================================
+    **Arguments**
+    clips         list of paths of the audio clips.
+    dbPath        A string path to the json database.
+    topK          number of matches reported per clip.
+    jobs          number of processes hashing clips.
+    fMilliSeconds number of milliseconds loaded from every clip.
+    segments      If True short clips are matched by offset against segments.npz next to dbPath.
+    profile       Path of a json scoring profile, the clips are then scored in the worker processes.
+    ============= ==========================================
+
+    :return: generator of one result dictionary per clip in completion order
+    """
+    searched = segments or profile is not None  # the workers search too
+    index = None if searched else hashIndex.fromPath(dbPath)
+    rate = loader.readFrontEnd(dbPath)  # clips are hashed through the front end of the database
+    with ProcessPoolExecutor(jobs) as executor:
+        if segments:
+            indexFile = str(Path(dbPath).parent / "segments.npz")
+            futures = {executor.submit(segmentClip, clip, indexFile, topK, fMilliSeconds, rate): clip for clip in clips}
+        elif profile is not None:
+            futures = {executor.submit(profileClip, clip, dbPath, profile, topK, fMilliSeconds, rate): clip for clip in clips}
+        else:
+            futures = {executor.submit(hashClip, clip, fMilliSeconds, rate): clip for clip in clips}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                yield {"clip": str(futures[future]), "error": repr(error)}
+                continue
+            if not searched:
+                start = time.perf_counter()
+                matches = index.search(packRecord(result["spectrohash"], result["features"]), topK)
+                result["timings_ms"]["search"] = (time.perf_counter() - start) * 1000
+                result["matches"] = [{"song": song, "similarity": score} for song, score in matches]
+            for stage, ms in result["timings_ms"].items():  # measured in the worker processes, out of this registry
+                defaultMetrics.observe("clip_" + stage, ms / 1000)
+            yield result
+
+
+if __name__ == '__main__':
+    import argparse
+    import warnings
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description="Identify audio clips against the database, "
+                                                 "printing one JSON result per line")
+    parser.add_argument("clips", nargs="+", help="audio clips to identify")
+    parser.add_argument("--db", default="Database/db.json", help="json database built by updateDB")
+    parser.add_argument("--top-k", type=int, default=5, help="matches reported per clip")
+    parser.add_argument("--jobs", type=int, default=1, help="processes hashing clips")
+    parser.add_argument("--seconds", type=float, default=60, help="seconds loaded from every clip")
+    parser.add_argument("--segments", action="store_true",
+                        help="match short clips by offset against the window index (updateDB --segments)")
+    parser.add_argument("--profile", help="json scoring profile, only the features it weights are extracted")
+    parser.add_argument("--metrics", help="file the stage timings are written to in the Prometheus text format")
+    args = parser.parse_args()
+
+    for result in identify(args.clips, args.db, args.top_k, args.jobs, args.seconds * 1000, args.segments,
+                           args.profile):
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+    if args.metrics:
+        with open(args.metrics, "w") as outFile:
+            outFile.write(defaultMetrics.prometheus())
@@ -0,0 +1,163 @@
+from pathlib import Path
+import numpy as np
+from scipy.ndimage import maximum_filter
+
+PEAK_NEIGHBORHOOD = (5, 9)  # (frequency bins, time frames) a peak must dominate
+PEAK_PERCENTILE = 90  # peaks must also be louder than this percentile of the spectrogram
+PEAK_BLOCK_FRAMES = 64  # length (frames) of the blocks in which only the strongest peaks are kept
+PEAKS_PER_BLOCK = 32  # peaks kept per block, drops weak (noise) peaks that break the pairs
+FAN_OUT = 5  # targets paired with every anchor peak
+MAX_DELTA_FRAMES = 255  # largest time distance (frames) of a pair, fits the 8 bits of the hash
+MAX_DELTA_BINS = 63  # largest frequency distance (bins) of a pair
+
+
+def findPeaks(colorMesh: np.ndarray) -> tuple:
+    """
+    Finds the spectral peaks (constellation) of a spectrogram
+    :param colorMesh: spectrogram of shape (frequencies, times) as returned by spectrogram._spectrogram
+    :return: frequency bins and time frames of the peaks sorted by time
+    """
+    logMesh = np.log10(colorMesh + np.finfo(np.float64).tiny)
+    isPeak = (maximum_filter(logMesh, size=PEAK_NEIGHBORHOOD, mode="constant", cval=-np.inf) == logMesh)
+    isPeak &= logMesh > np.percentile(logMesh, PEAK_PERCENTILE)
+    freqs, times = np.nonzero(isPeak)
+
+    # rank the peaks of every time block by loudness and keep the strongest ones
+    blocks = times // PEAK_BLOCK_FRAMES
+    order = np.lexsort((-logMesh[freqs, times], blocks))
+    blocks = blocks[order]
+    rank = np.arange(len(order)) - np.searchsorted(blocks, blocks, side="left")
+    keep = order[rank < PEAKS_PER_BLOCK]
+
+    order = np.lexsort((freqs[keep], times[keep]))
+    return freqs[keep][order], times[keep][order]
+
+
+def fingerprint(colorMesh: np.ndarray) -> np.ndarray:
+    """
+    Pairs every peak with the next FAN_OUT peaks in its target zone and hashes the pairs
+    :param colorMesh: spectrogram of shape (frequencies, times)
+    :return: int64 array of shape (landmarks, 2) holding the pair hash and the anchor time frame
+    """
+    freqs, times = findPeaks(colorMesh)
+    freqs, times = freqs.astype(np.int64), times.astype(np.int64)
+    paired = np.zeros(len(freqs), dtype=np.int64)
+    landmarks = []
+    for step in range(1, 4 * FAN_OUT):
+        anchor = np.arange(len(freqs) - step)
+        target = anchor + step
+        deltaT = times[target] - times[anchor]
+        keep = (deltaT > 0) & (deltaT <= MAX_DELTA_FRAMES) & \
+               (np.abs(freqs[target] - freqs[anchor]) <= MAX_DELTA_BINS) & (paired[anchor] < FAN_OUT)
+        anchor, target = anchor[keep], target[keep]
+        paired[anchor] += 1
+        hashes = (freqs[anchor] << 16) | (freqs[target] << 8) | (times[target] - times[anchor])
+        landmarks.append(np.stack([hashes, times[anchor]], axis=1))
+    return np.concatenate(landmarks) if landmarks else np.empty((0, 2), dtype=np.int64)
+
+
+class landmarkIndex():
+    """
+    Inverted index of landmark hashes implements the following :
+
+    - Holds the (hash -> song id, time offset) postings of every song sorted by hash
+    - Matches a query by looking up its landmarks and voting, per song, on the time offset
+      between the song and the query, a true match piles its votes in one offset
+    """
+    def __init__(self, names: list, hashes: np.ndarray, songIds: np.ndarray, offsets: np.ndarray):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - names : list of the song names, indexed by song id
+        - hashes : landmark hashes of all songs
+        - songIds : song id of every landmark
+        - offsets : anchor time frame of every landmark in its song
+        """
+        order = np.argsort(hashes, kind="stable")
+        self.names = list(names)
+        self.hashes = np.asarray(hashes, dtype=np.int64)[order]
+        self.songIds = np.asarray(songIds, dtype=np.int32)[order]
+        self.offsets = np.asarray(offsets, dtype=np.int32)[order]
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def fromFolder(cls, folder: str) -> "landmarkIndex":
+        """
+        Builds the index from the per song landmark files written by updateDB (name.npy)
+
+        Parameters
+        -----------
+        - folder : folder of the landmark files
+        """
+        names, hashes, songIds, offsets = [], [], [], []
+        for songId, file in enumerate(sorted(Path(folder).glob("*.npy"))):
+            landmarks = np.load(file)
+            names.append(file.stem)
+            hashes.append(landmarks[:, 0])
+            offsets.append(landmarks[:, 1])
+            songIds.append(np.full(len(landmarks), songId))
+        if not names:
+            return cls([], np.empty(0), np.empty(0), np.empty(0))
+        return cls(names, np.concatenate(hashes), np.concatenate(songIds), np.concatenate(offsets))
+
+    @classmethod
+    def load(cls, file: str) -> "landmarkIndex":
+        """
+        Loads an index saved with save()
+
+        Parameters
+        -----------
+        - file : a string path to the .npz index
+        """
+        with np.load(file) as saved:
+            return cls([str(name) for name in saved["names"]], saved["hashes"], saved["songIds"], saved["offsets"])
+
+    def save(self, file: str):
+        """
+        Saves the postings and the song names in a .npz file
+
+        Parameters
+        -----------
+        - file : a string path to the output file
+        """
+        np.savez(file, names=np.array(self.names), hashes=self.hashes, songIds=self.songIds, offsets=self.offsets)
+
+    def query(self, colorMesh: np.ndarray, k: int = 10) -> list:
+        """
+        Finds the songs sharing the most time-consistent landmarks with a query spectrogram
+
+        Parameters
+        -----------
+        - colorMesh : spectrogram of the query, computed like the database ones
+        - k : number of results
+
+        Returns
+        -----------
+        - a list of (songName, percentage of the query landmarks matched, offset of the query
+          in the song in frames) sorted from best to worst match
+        """
+        landmarks = fingerprint(colorMesh)
+        if len(landmarks) == 0 or len(self.hashes) == 0:
+            return []
+        left = np.searchsorted(self.hashes, landmarks[:, 0], side="left")
+        right = np.searchsorted(self.hashes, landmarks[:, 0], side="right")
+        counts = right - left
+        if counts.sum() == 0:
+            return []
+
+        # expand every [left, right) posting range without a python loop
+        postings = np.repeat(left - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        songIds = self.songIds[postings].astype(np.int64)
+        deltas = self.offsets[postings] - np.repeat(landmarks[:, 1], counts)
+
+        pairs, votes = np.unique(np.stack([songIds, deltas], axis=1), axis=0, return_counts=True)
+        best = np.lexsort((pairs[:, 0], -votes))
+        pairs, votes = pairs[best], votes[best]
+        _, first = np.unique(pairs[:, 0], return_index=True)
+        first = np.sort(first)[:k]
+        return [(self.names[pairs[i, 0]], 100 * min(float(votes[i]) / len(landmarks), 1.0), int(pairs[i, 1]))
+                for i in first]
@@ -1,6 +1,20 @@
+from math import gcd
 from pathlib import Path
+import hashlib
+import json
+import subprocess
+import wave
 import numpy as np
+from scipy import signal
 from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+from pydub.utils import mediainfo_json
+from metrics import timed
+from Spectrogram import FEATURE_VERSION
+
+_PCM_FORMATS = {"int16": ("s16le", "pcm_s16le"), "float32": ("f32le", "pcm_f32le")}  # dtype -> ffmpeg format, codec
+CANONICAL_RATE = 11025  # suggested rate of the canonical front end, a quarter of 44.1 kHz
+FRONT_END_FILE = "frontend.json"  # canonical rate and feature version of a database, next to db.json
 
 
 def loadPath(folderPath: str) -> tuple:
@@ -13,31 +27,354 @@ def loadPath(folderPath: str) -> tuple:
     basePath = Path(folderPath)
     filesInPath = (item for item in basePath.iterdir() if item.is_file())
     for item in filesInPath:
-        yield (item.stem, item.relative_to(basePath.parent))
+        yield (item.stem, item)
+
+
+def fileDigest(filePath: str, blockSize: int = 1 << 20) -> str:
+    """
+    Hashes the content of a file
+
+    :param filePath: relative path of the file
+    :param blockSize: number of bytes read at a time
+    :return: hex sha1 digest of the file content
+    """
+    digest = hashlib.sha1()
+    with open(filePath, "rb") as inFile:
+        for block in iter(lambda: inFile.read(blockSize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _openWav(filePath: str):
+    """
+    Opens 16 bit PCM .wav files with the wave module so they are read without ffmpeg
+
+    :param filePath: relative path of the file
+    :return: an opened wave reader or None for any other file
+    """
+    if Path(filePath).suffix.lower() != ".wav":
+        return None
+    try:
+        wavFile = wave.open(str(filePath), "rb")
+    except (wave.Error, EOFError):
+        return None
+    if wavFile.getsampwidth() != 2:
+        wavFile.close()
+        return None
+    return wavFile
 
 
+def _wavSamples(frames: bytes, dtype: str) -> np.ndarray:
+    """
+    Converts raw 16 bit PCM frames to int16 or float32 samples like ffmpeg's s16le / f32le
+    """
+    samples = np.frombuffer(frames, dtype="<i2")
+    if dtype == "float32":
+        return samples.astype(np.float32) / 32768
+    return samples.astype(np.int16, copy=False)
+
+
+def audioInfo(filePath: str) -> tuple:
+    """
+    Reads the sample rate and number of channels of an audio file without decoding it
+
+    :param filePath: relative path of the file
+    :return: sample rate and number of channels
+    """
+    wavFile = _openWav(filePath)
+    if wavFile is not None:
+        with wavFile:
+            return wavFile.getframerate(), wavFile.getnchannels()
+    info = mediainfo_json(str(filePath))
+    stream = next(stream for stream in info["streams"] if stream["codec_type"] == "audio")
+    return int(stream["sample_rate"]), int(stream["channels"])
+
+
+def _decoder(filePath: str, offset: float, duration: float, dtype: str) -> subprocess.Popen:
+    """
+    Starts ffmpeg decoding only the requested window of the file to raw PCM on its stdout
+    """
+    pcmFormat, codec = _PCM_FORMATS[dtype]
+    command = [AudioSegment.converter, "-v", "error", "-nostdin"]
+    if offset:
+        command += ["-ss", str(offset)]
+    if duration:
+        command += ["-t", str(duration)]
+    command += ["-i", str(filePath), "-vn", "-f", pcmFormat, "-acodec", codec, "-"]
+    return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def _finish(decoder: subprocess.Popen, filePath: str, check: bool = True):
+    """
+    Waits for ffmpeg to exit and raises if it could not decode the file
+    """
+    decoder.stdout.close()
+    error = decoder.stderr.read()
+    decoder.stderr.close()
+    if decoder.wait() != 0 and check:
+        raise CouldntDecodeError("Decoding %s failed : %s" % (filePath, error.decode(errors="replace")))
+
+
+def streamAudio(filePath: str, offset: float = 0, duration: float = None, chunkFrames: int = 1 << 16,
+                dtype: str = "int16"):
+    """
+    Decodes a time window of an audio file chunk by chunk, only the window is decoded
+    and at most one chunk is held in memory
+
+    :param filePath: relative path of the file
+    :param offset: start of the window in seconds
+    :param duration: length of the window in seconds, until the end of the file if not given
+    :param chunkFrames: number of frames (samples per channel) yielded at a time
+    :param dtype: "int16" or "float32" samples
+    :return: generator of interleaved sample arrays, the last one may be shorter
+    """
+    wavFile = _openWav(filePath)
+    if wavFile is not None:
+        with wavFile:
+            rate = wavFile.getframerate()
+            wavFile.setpos(min(int(round(offset * rate)), wavFile.getnframes()))
+            remaining = int(round(duration * rate)) if duration else wavFile.getnframes()
+            while remaining > 0:
+                frames = wavFile.readframes(min(chunkFrames, remaining))
+                if not frames:
+                    break
+                remaining -= chunkFrames
+                yield _wavSamples(frames, dtype)
+        return
+
+    _, channels = audioInfo(filePath)
+    chunkBytes = chunkFrames * channels * np.dtype(dtype).itemsize
+    decoder = _decoder(filePath, offset, duration, dtype)
+    completed = False
+    try:
+        for chunk in iter(lambda: decoder.stdout.read(chunkBytes), b""):
+            yield np.frombuffer(chunk, dtype=dtype)
+        completed = True
+    finally:
+        if not completed:
+            # the caller stopped early, the rest of the window is never decoded
+            decoder.kill()
+        _finish(decoder, filePath, check=completed)
+
+
+def decodeWindow(filePath: str, offset: float = 0, duration: float = None, dtype: str = "int16") -> tuple:
+    """
+    Decodes a time window of an audio file straight into a single numpy array
+
+    :param filePath: relative path of the file
+    :param offset: start of the window in seconds
+    :param duration: length of the window in seconds, until the end of the file if not given
+    :param dtype: "int16" or "float32" samples
+    :return: interleaved samples of the window, sample rate and number of channels
+    """
+    wavFile = _openWav(filePath)
+    if wavFile is not None:
+        with wavFile:
+            rate, channels = wavFile.getframerate(), wavFile.getnchannels()
+            wavFile.setpos(min(int(round(offset * rate)), wavFile.getnframes()))
+            frames = wavFile.readframes(int(round(duration * rate)) if duration else wavFile.getnframes())
+        return _wavSamples(frames, dtype), rate, channels
+
+    rate, channels = audioInfo(filePath)
+    decoder = _decoder(filePath, offset, duration, dtype)
+    try:
+        if duration:
+            # the window size is known, ffmpeg writes directly into the output buffer
+            data = np.empty(int(round(duration * rate)) * channels, dtype=dtype)
+            buffer = memoryview(data).cast("B")
+            filled = 0
+            while filled < len(buffer):
+                read = decoder.stdout.readinto(buffer[filled:])
+                if not read:
+                    break
+                filled += read
+            data = data[:filled // data.itemsize]
+        else:
+            data = np.frombuffer(decoder.stdout.read(), dtype=dtype)
+    finally:
+        _finish(decoder, filePath)
+    return data, rate, channels
+
+
+@timed("mp3ToData")
 def mp3ToData(filePaths: str, fMilliSeconds: float = None) -> tuple:
     """
-    Loads MP3 audio file 
+    Loads MP3 audio file, decoding only the requested first milliseconds
 
     :param filePath: relative path of the file
     :param fSeconds: number of millie seconds you want to load, if not it will load all the file
     :return: data of song and frame rate
     """
-    if fMilliSeconds:
-        audioFile = AudioSegment.from_mp3(filePaths)[:fMilliSeconds]
-    else:
-        audioFile = AudioSegment.from_mp3(filePaths)
-    data = np.array(audioFile.get_array_of_samples())
-    rate = audioFile.frame_rate
-    print(data[0:100])
+    data, rate, _ = decodeWindow(filePaths, duration=fMilliSeconds / 1000 if fMilliSeconds else None)
     return data, rate
 
-# testing shit
-# Songs = loadPath("Songs/")
-# for song in Songs:
-# print(song)
 
-# data , rate = mp3ToData(Songs[0][1], 10000)
-# print(data)
-# print(rate)
+def downmix(data: np.ndarray, channels: int = 1) -> np.ndarray:
+    """
+    Averages the interleaved channels of the samples into mono float32, keeping the int16 amplitude scale
+
+    :param data: interleaved samples (like decodeWindow)
+    :param channels: number of interleaved channels
+    :return: float32 mono samples
+    """
+    data = np.asarray(data)
+    if channels == 1:
+        return data.astype(np.float32, copy=False)
+    frames = len(data) // channels
+    return data[:frames * channels].reshape(frames, channels).mean(axis=1, dtype=np.float32)
+
+
+def resample(data: np.ndarray, rate: int, targetRate: int) -> np.ndarray:
+    """
+    Resamples mono samples with a polyphase filter
+
+    :param data: mono samples
+    :param rate: sample rate of the samples
+    :param targetRate: sample rate of the output
+    :return: float32 samples at targetRate
+    """
+    divisor = gcd(int(rate), int(targetRate))
+    if rate == targetRate:
+        return np.asarray(data, dtype=np.float32)
+    return signal.resample_poly(data, targetRate // divisor, rate // divisor).astype(np.float32)
+
+
+class streamResampler():
+    """
+    Resamples a stream chunk by chunk, the output is the one of resample() on the whole stream
+    (up to rounding), only the input the next outputs depend on is kept
+    """
+    def __init__(self, rate: int, targetRate: int):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - rate : sample rate of the stream
+        - targetRate : sample rate of the output
+        """
+        divisor = gcd(int(rate), int(targetRate))
+        self.up, self.down = targetRate // divisor, rate // divisor
+        # input samples on each side an output depends on (resample_poly filters 10 * max(up, down) taps per side)
+        self.radius = -(-10 * max(self.up, self.down) // self.up) + 1
+        self.buffer = np.empty(0, dtype=np.float32)
+        self.start = 0  # input index of buffer[0], a multiple of down so the outputs stay aligned
+        self.received = 0  # input samples received
+        self.emitted = 0  # output samples returned
+
+    def push(self, samples: np.ndarray, final: bool = False) -> np.ndarray:
+        """
+        Adds mono samples and returns the output samples they complete
+
+        Parameters
+        -----------
+        - samples : mono samples following the previous ones
+        - final : True for the last chunk, the end of the stream is padded like resample() does
+
+        Returns
+        -----------
+        - float32 samples at the target rate
+        """
+        if self.up == self.down:
+            return np.asarray(samples, dtype=np.float32)
+        self.buffer = np.concatenate([self.buffer, np.asarray(samples, dtype=np.float32)])
+        self.received += len(samples)
+        if final:
+            stop = -(-self.received * self.up // self.down)
+        else:
+            stop = max((self.received - 1 - self.radius) * self.up // self.down + 1, self.emitted)
+        if stop <= self.emitted:
+            return np.empty(0, dtype=np.float32)
+        first = self.start * self.up // self.down
+        output = signal.resample_poly(self.buffer, self.up, self.down)[self.emitted - first:stop - first]
+        self.emitted = stop
+
+        keep = (self.emitted * self.down // self.up - self.radius) // self.down * self.down
+        if keep > self.start:
+            self.buffer = self.buffer[keep - self.start:]
+            self.start = keep
+        return output.astype(np.float32)
+
+
+def canonical(data: np.ndarray, rate: int, channels: int = 1, targetRate: int = CANONICAL_RATE) -> tuple:
+    """
+    Front end of the analysis, downmixes to mono and resamples to the canonical rate in float32
+
+    :param data: interleaved samples (like decodeWindow)
+    :param rate: sample rate of the samples
+    :param channels: number of interleaved channels
+    :param targetRate: canonical sample rate
+    :return: float32 mono samples at targetRate and targetRate
+    """
+    return resample(downmix(data, channels), rate, targetRate), targetRate
+
+
+def loadCanonical(filePath: str, fMilliSeconds: float = None, targetRate: int = None) -> tuple:
+    """
+    Loads an audio file through the canonical front end, or like mp3ToData if no rate is given
+
+    :param filePath: relative path of the file
+    :param fMilliSeconds: number of milliseconds to load, if not it will load all the file
+    :param targetRate: canonical sample rate, the legacy interleaved samples at the file rate if None
+    :return: data of song and its rate
+    """
+    if not targetRate:
+        return mp3ToData(filePath, fMilliSeconds)
+    data, rate, channels = decodeWindow(filePath, duration=fMilliSeconds / 1000 if fMilliSeconds else None)
+    return canonical(data, rate, channels, targetRate)
+
+
+def _frontEnd(dbPath: str) -> dict:
+    """
+    Contents of the front end record of a database, empty for a database written before it existed
+    """
+    file = Path(dbPath).parent / FRONT_END_FILE
+    if not file.exists():
+        return {}
+    with open(file) as inFile:
+        return json.load(inFile)
+
+
+def readFrontEnd(dbPath: str):
+    """
+    Canonical rate the database was hashed at (see updateDB)
+
+    :param dbPath: a string path to the json database
+    :return: the rate or None for a database of legacy (interleaved, file rate) hashes
+    """
+    return _frontEnd(dbPath).get("rate")
+
+
+def readFeatureVersion(dbPath: str) -> int:
+    """
+    Version of the feature pipeline the database was hashed with (see Spectrogram.FEATURE_VERSION)
+
+    :param dbPath: a string path to the json database
+    :return: the version, 1 for a database written before versions were recorded
+    """
+    return _frontEnd(dbPath).get("features", 1)
+
+
+def checkFeatureVersion(dbPath: str):
+    """
+    Refuses a database whose hashes the current feature pipeline can not be compared with
+
+    :param dbPath: a string path to the json database
+    """
+    version = readFeatureVersion(dbPath)
+    if version != FEATURE_VERSION:
+        raise ValueError("%s was hashed with the feature pipeline version %s, this one is version %s, "
+                         "rebuild it with python updateDB.py" % (dbPath, version, FEATURE_VERSION))
+
+
+def writeFrontEnd(dbPath: str, targetRate: int = None):
+    """
+    Records the canonical rate of the database and the version of its feature pipeline
+
+    :param dbPath: a string path to the json database
+    :param targetRate: canonical sample rate or None for legacy hashes
+    """
+    frontEnd = {"rate": int(targetRate), "mono": True, "dtype": "float32"} if targetRate else {"rate": None}
+    frontEnd["features"] = FEATURE_VERSION
+    with open(Path(dbPath).parent / FRONT_END_FILE, "w") as outFile:
+        json.dump(frontEnd, outFile, indent=4)
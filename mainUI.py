@@ -1,11 +1,20 @@
 import UI as ui
-from PyQt5 import QtWidgets, QtGui
+from PyQt5 import QtWidgets, QtGui, QtCore
 import logging
-from loader import mp3ToData
 from functools import partial
+from cache import cachedDecode, cachedAnalysis, makeKey
+from helpers import createPerceptualHash
+from hashIndex import hashIndex, packRecord
+from mihIndex import mihIndex
+from shards import shardedIndex
+from landmarks import landmarkIndex
+from pathlib import Path
+from workers import worker
+from mixing import mixAnalysis
+from scoring import scoringProfile
 from Spectrogram import spectrogram
-from helpers import mixSongs, createPerceptualHash, getHammingDistance, mapRanges
-from updateDB import readJson
+from metrics import defaultMetrics, timer
+import loader
 
 class voiceRecognizer(ui.Ui_MainWindow):
     """
@@ -22,6 +31,10 @@ class voiceRecognizer(ui.Ui_MainWindow):
         self.featureKey = "features"  # key used to get mel Hash
         self.audFiles = [None, None]  # List Containing both songs
         self.audRates = [None, None]  # List contains Songs Rates which must be equal
+        self.audKeys = [None, None]  # List contains the cache keys of both songs decoded data
+        self.mixKey = None  # Cache key of the Mix output
+        self.mixer = None  # STFTs of the loaded pair, any slider value is derived from them
+        self.mixerKeys = None  # Cache keys of the pair the mixer was computed for
         self.lineEdits = [self.aud1Text, self.aud2Text]
         self.testHash = None  # The Mix output resulted hash
         self.audMix = None  # The Mix output resulted Audio File
@@ -29,17 +42,45 @@ class voiceRecognizer(ui.Ui_MainWindow):
         self.results = []  # Holds the Results with each song
         self.songsPath = "Songs/"  # path to songs directory
         self.dbPath = "Database/db.json"  # path to database directory
-        self.spectrogram = spectrogram()._spectrogram  # Spectrogram Extraction function
-        self.extractFeatures = spectrogram().spectralFeatures  # Feature Extraction function
+        self.index = None  # Packed hash index of the database, loaded on the first search
+        self.searchBackend = "linear"  # "linear" scans every song, "mih" uses multi-index hashing,
+        # "sharded" scans the shards written by updateDB --shards in local processes
+        self.recognitionEngine = "phash"  # "phash" compares whole clip hashes, "landmark" votes on peak pairs
+        self.landmarks = None  # Landmark index of the database, loaded on the first landmark search
+        self.topK = 100  # Number of matches shown, all songs if None
+        # Features hashed and their weights, scoring.json next to the database if deployed
+        self.scoring = scoringProfile.fromFile(str(Path(self.dbPath).with_name("scoring.json")))
+        # Canonical rate the database was hashed at, the loaded songs are downmixed and resampled to it
+        # so songs of different rates can be mixed, None for a legacy database
+        self.frontEndRate = loader.readFrontEnd(self.dbPath)
+        self.analyze = cachedAnalysis  # Spectrogram and Feature Extraction function (cached by content)
+        self.metricsPath = "logs/metrics.prom"  # Stage timings exported after every search (Prometheus text)
         self.loadBtns = [self.audLoad1, self.audLoad2]  # loading buttons collected
         self.logger = logging.getLogger()  # Logger maintainer
         self.logger.setLevel(logging.DEBUG)
 
+        self.threadPool = QtCore.QThreadPool.globalInstance()  # Pool running loading and searching
+        self.task = None  # The running search worker, if any
+
+        # Cancel button shown under the search button while a search is running
+        self.cancelBtn = QtWidgets.QPushButton("Cancel", self.centralwidget)
+        self.verticalLayout_3.insertWidget(self.verticalLayout_3.indexOf(self.finderBtn) + 1, self.cancelBtn)
+        self.cancelBtn.hide()
+
+        # Recognition engine selector shown above the search button
+        self.engineBox = QtWidgets.QComboBox(self.centralwidget)
+        self.engineBox.addItem("Perceptual Hash", "phash")
+        self.engineBox.addItem("Landmarks", "landmark")
+        self.verticalLayout_3.insertWidget(self.verticalLayout_3.indexOf(self.finderBtn), self.engineBox)
+
         # CONNECTIONS
         for btn in self.loadBtns:
             btn.clicked.connect(partial(self.loadFile, btn.property("indx")))
  
         self.finderBtn.clicked.connect(self.__extract)
+        self.cancelBtn.clicked.connect(self.__cancel)
+        self.engineBox.currentIndexChanged.connect(
+            lambda indx: setattr(self, "recognitionEngine", self.engineBox.itemData(indx)))
 
         self.resultsTable.hide()
         self.label_2.hide()
@@ -51,7 +92,7 @@ class voiceRecognizer(ui.Ui_MainWindow):
         Responsible for the following :
 
         - Showing a dialog for choosing desired file
-        - Convert the loaded file into array and insert it in the system
+        - Convert the loaded file into array and insert it in the system on a pool thread
         - load only the first minute of any song
         """
         self.statusbar.showMessage("Loading Audio File %s"%indx)
@@ -66,77 +107,217 @@ class voiceRecognizer(ui.Ui_MainWindow):
             pass
         else:
             self.logger.debug("starting extraction of data")
-            audData, audRate = mp3ToData(audFile, 60000)
-            self.logger.debug("extraction successful")
-            self.audFiles[indx-1] = audData
-            self.audRates[indx-1] = audRate
-            self.lineEdits[indx-1].setText(audFile.split('/')[-1])
-            self.statusbar.showMessage("Loading Done")
-            self.logger.debug("Loading done")
+            self.loadBtns[indx-1].setEnabled(False)
+            loading = worker(lambda task: cachedDecode(audFile, 60000, targetRate=self.frontEndRate))
+            loading.signals.result.connect(partial(self.__loaded, indx, audFile))
+            loading.signals.error.connect(self.__failed)
+            loading.signals.finished.connect(partial(self.loadBtns[indx-1].setEnabled, True))
+            self.threadPool.start(loading)
+
+    def __loaded(self, indx, audFile, decoded):
+        """
+        Inserts a decoded file in the system once its loading worker finished
+        """
+        self.logger.debug("extraction successful")
+        self.audFiles[indx-1], self.audRates[indx-1], self.audKeys[indx-1] = decoded
+        self.lineEdits[indx-1].setText(audFile.split('/')[-1])
+        self.statusbar.showMessage("Loading Done")
+        self.logger.debug("Loading done")
 
     def __extract(self):
         """
         Responsible for the following :
 
-        - Read the slider value and mix the loaded songs if any with the selected ratio
-        - Extract the spectrogram of the resulted mix and it`s features
-        - hash the resulted extractions
+        - Read the slider value and select the loaded songs to mix with the selected ratio
+        - Start the search worker which mixes, extracts, hashes and compares off the GUI thread
         """
         print("Slider Value is %s"%self.ratioSlider.value())
         self.statusbar.showMessage("Finding Matches ...")
         self.logger.debug("starting searching process")
 
-        if (self.audFiles[0] is not None) and (self.audFiles[1] is not None):
-            self.logger.debug("loaded two different songs ")
-            self.audMix = mixSongs(self.audFiles[0], self.audFiles[1], w=self.ratioSlider.value()/100)
+        if self.audFiles[0] is None and self.audFiles[1] is None:
+            self.showMessage("Warning", "You need to at least load one Audio File",
+                             QtWidgets.QMessageBox.Ok, QtWidgets.QMessageBox.Warning)
+            self.statusbar.clearMessage()
+            return
+
+        self.task = worker(self.__search, list(self.audFiles), list(self.audKeys), self.audRates[0],
+                           self.ratioSlider.value())
+        self.task.signals.progress.connect(self.__progress)
+        self.task.signals.partial.connect(self.__showResults)
+        self.task.signals.result.connect(self.__showResults)
+        self.task.signals.error.connect(self.__failed)
+        self.task.signals.cancelled.connect(partial(self.statusbar.showMessage, "Search cancelled"))
+        self.task.signals.finished.connect(self.__searchFinished)
+        self.finderBtn.setEnabled(False)
+        self.cancelBtn.show()
+        self.threadPool.start(self.task)
+
+    def __search(self, task, audFiles, audKeys, audRate, ratio):
+        """
+        Responsible for the following, on a pool thread :
 
+        - Mix the loaded songs if any with the selected ratio
+        - Extract the spectrogram of the resulted mix and it`s features
+        - hash the resulted extractions and compare them with the database, only the features
+          of the scoring profile if it is not the plain one
+        """
+        profiled = self.recognitionEngine == "phash" and not self.scoring.plain
+        if (audFiles[0] is not None) and (audFiles[1] is not None):
+            self.logger.debug("loaded two different songs ")
+            task.progress(5, "Mixing ..")
+            self.mixKey = makeKey("mix", audKeys[0], audKeys[1], ratio)
+            if self.mixerKeys != (audKeys[0], audKeys[1]):
+                self.mixer, self.mixerKeys = mixAnalysis(audFiles[0], audFiles[1], audRate), (audKeys[0], audKeys[1])
+            self.logger.debug("starting Extraction")
+            task.progress(10, "Extracting features ..")
+            if profiled:
+                self.spectro = self.mixer.colorMesh(ratio/100)
+            else:
+                self.spectro, features = self.mixer.analyze(ratio/100)
         else:
             self.logger.debug("loaded only one song")
-            if self.audFiles[0] is not None : self.audMix = self.audFiles[0]
-            if self.audFiles[1] is not None: self.audMix = self.audFiles[1]
-            if self.audFiles[0] is None and self.audFiles[1] is None:
-                self.showMessage("Warning", "You need to at least load one Audio File",
-                                 QtWidgets.QMessageBox.Ok, QtWidgets.QMessageBox.Warning)
+            if audFiles[0] is not None : self.audMix, self.mixKey = audFiles[0], audKeys[0]
+            if audFiles[1] is not None: self.audMix, self.mixKey = audFiles[1], audKeys[1]
 
-        if self.audMix is not None:
             self.logger.debug("starting Extraction")
-
-            self.spectro = self.spectrogram(self.audMix, self.audRates[0])[-1]
-            self.testHash = createPerceptualHash(self.spectro)
-
-            for feature in self.extractFeatures(self.audMix, self.spectro, self.audRates[0]):
-                self.featureMixHash.append(createPerceptualHash(feature))
-
-            self.__compareHash()
-        self.statusbar.clearMessage()
-
-    def __compareHash(self):
+            task.progress(10, "Extracting features ..")
+            if profiled:
+                self.spectro = spectrogram()._spectrogram(self.audMix, audRate)[2]
+            else:
+                self.spectro, features = self.analyze(self.audMix, audRate, self.mixKey)
+
+        if profiled:
+            return self.__compareProfile(task, audRate)
+        if self.recognitionEngine == "landmark":
+            return self.__compareLandmarks(task)
+        task.progress(40, "Hashing ..")
+        self.testHash = createPerceptualHash(self.spectro)
+        self.featureMixHash = []
+
+        for feature in features:
+            self.featureMixHash.append(createPerceptualHash(feature))
+
+        return self.__compareHash(task)
+
+    def __compareHash(self, task):
         """
         Responsible for the following :
 
-        - Reading the database's saved hashes
+        - Loading the packed index of the database's saved hashes once
         - Compare the resulted hashesh with those saved in database
-        - Sorting the results and sending data to Table
+        - Sorting the results and streaming the best ones found so far to the Table
         """
         self.logger.debug("staring comparisons ... ")
-        self.statusbar.showMessage("Loading results .. ")
+        task.progress(50, "Loading results .. ")
+        self.__loadIndex()
+
+        query = packRecord(self.testHash, self.featureMixHash)
+        defaultMetrics.count("songs_compared", len(self.index))
+        with timer("compare"):
+            if self.searchBackend != "linear":
+                results = self.index.search(query, self.topK or 10)
+                if self.searchBackend == "mih":
+                    self.logger.debug("%s candidates verified" % self.index.lastCandidates)
+                return results
+
+            for done, results in self.index.searchBlocks(query, self.topK):
+                task.checkCancelled()
+                if done < 1:
+                    task.partial(results)
+                    task.progress(50 + 50 * done, "Searching ..")
+        return results
+
+    def __compareProfile(self, task, audRate):
+        """
+        Responsible for the following :
 
-        for songName, songHashes in readJson(self.dbPath):
-            self.spectroDiff = getHammingDistance(songHashes[self.spectroHashKey], self.testHash)
-            self.featureDiff = 0
+        - Extracting, hashing and comparing only the features of the scoring profile, stage by stage
+        - Skipping the other features when the first stage already separates the best candidate
+        """
+        self.logger.debug("staring profiled comparisons ... ")
+        task.progress(40, "Hashing and comparing ..")
+        self.__loadIndex()
+        index = self.index.index if self.searchBackend == "mih" else self.index
+        if self.searchBackend == "sharded":
+            index = hashIndex.fromPath(self.dbPath)  # the stages need the records, memory mapped
+        results = self.scoring.search(index, self.spectro, audRate, self.topK)
+        self.logger.debug("scoring profile : %s" % self.scoring.lastStats)
+        return results
+
+    def __loadIndex(self):
+        """
+        Loads the packed index of the database's saved hashes once
+        """
+        if self.index is None and self.searchBackend == "sharded":
+            self.index = shardedIndex.local(self.dbPath)
+            self.logger.debug("%s shards started" % len(self.index.shards))
+        if self.index is None:
+            self.index = hashIndex.fromPath(self.dbPath)
+            self.logger.debug("index loaded with %s songs" % len(self.index))
+            if self.searchBackend == "mih":
+                self.index = mihIndex(self.index)
+
+    def __compareLandmarks(self, task):
+        """
+        Responsible for the following :
 
-            for i, feature in enumerate(songHashes[self.featureKey]):
-                self.featureDiff += getHammingDistance(feature, self.featureMixHash[i])
+        - Loading the landmark index built by updateDB --landmarks once
+        - Matching the landmarks of the mix spectrogram by offset voting
+        """
+        self.logger.debug("staring landmark matching ... ")
+        task.progress(50, "Loading results .. ")
 
-            self.avg = (self.spectroDiff + self.featureDiff)/4
-            self.results.append((songName, (abs(1 - mapRanges(self.avg, 0, 255, 0, 1)))*100))
+        if self.landmarks is None:
+            self.landmarks = landmarkIndex.load(str(Path(self.dbPath).with_name("landmarks.npz")))
+            self.logger.debug("landmark index loaded with %s songs" % len(self.landmarks))
 
-        self.results.sort(key= lambda x: x[1], reverse=True)
+        return self.landmarks.query(self.spectro, self.topK or 10)
 
-        self.statusbar.clearMessage()
+    def __progress(self, percent, message):
+        """
+        Shows the progress reported by the search worker
+        """
+        self.statusbar.showMessage("%s %s%%" % (message, percent))
 
+    def __showResults(self, results):
+        """
+        Shows partial or final results of the search worker in the Table
+        """
+        self.results = list(results)
         self.__startTable()
 
+    def __failed(self, error):
+        """
+        Reports an error raised by a worker
+        """
+        self.logger.debug(error)
+        self.showMessage("Error", error.strip().splitlines()[-1],
+                         QtWidgets.QMessageBox.Ok, QtWidgets.QMessageBox.Critical)
+
+    def __cancel(self):
+        """
+        Cancels the running search, it stops at its next step
+        """
+        if self.task is not None:
+            self.logger.debug("cancelling search")
+            self.task.cancel()
+
+    def __searchFinished(self):
+        """
+        Restores the buttons once the search worker finished
+        """
+        self.task = None
+        self.cancelBtn.hide()
+        self.finderBtn.setEnabled(True)
+        if self.statusbar.currentMessage().startswith(("Loading results", "Searching")):
+            self.statusbar.clearMessage()
+        self.logger.debug("stage timings : %s" % defaultMetrics.summary())
+        try:
+            Path(self.metricsPath).write_text(defaultMetrics.prometheus())
+        except OSError as error:
+            self.logger.debug("metrics not exported : %r" % error)
+
     def __startTable(self):
         """
         Responsible for the following :
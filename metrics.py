@@ -0,0 +1,242 @@
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from multiprocessing.util import Finalize, register_after_fork
+from pathlib import Path
+import json
+import os
+import threading
+import time
+
+PREFIX = "voice"  # prefix of every exported metric name
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # histogram bounds in seconds
+TRACE_EVENTS = 100000  # events kept by a trace, the oldest ones are dropped past it
+
+
+class metricsRegistry():
+    """
+    Timings and counters of the recognition pipeline implements the following :
+
+    - Times the stages (decoding, spectrogram, features, hashing, comparing ..) with timer() blocks
+      or timed() functions into one histogram per stage, an exception counts as an error of the stage
+    - Counts arbitrary events (songs compared, cache hits ..) with count()
+    - Exports everything in the Prometheus text format, and optionally records every timed call
+      as a trace event (chrome://tracing or Perfetto JSON)
+
+    Every process has its own registry, timings measured in worker processes are reported back
+    by the callers with observe().
+    """
+    def __init__(self, buckets: tuple = BUCKETS, prefix: str = PREFIX):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - buckets : upper bounds (seconds) of the histogram buckets
+        - prefix : prefix of the exported metric names
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self.enabled = True  # timers and counters do nothing when False
+        self.histograms = {}  # stage -> [count per bucket + the +Inf one, sum of the seconds]
+        self.errors = {}  # stage -> number of calls that raised
+        self.counters = {}  # (name, sorted label items) -> value
+        self.trace = None  # deque of the trace events while tracing
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        """
+        Records one duration of a stage
+
+        Parameters
+        -----------
+        - stage : name of the stage
+        - seconds : duration
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram = self.histograms[stage]
+            histogram[0][bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+
+    def count(self, name: str, value: float = 1, **labels):
+        """
+        Increments a counter
+
+        Parameters
+        -----------
+        - name : name of the counter, exported as <prefix>_<name>_total
+        - value : increment
+        - labels : labels of the counter
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, stage: str):
+        """
+        Times the enclosed block as one call of the stage
+
+        Parameters
+        -----------
+        - stage : name of the stage
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            with self._lock:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.trace is not None:
+                self.trace.append({"name": stage, "ph": "X", "ts": (time.time() - elapsed) * 1e6,
+                                   "dur": elapsed * 1e6, "pid": os.getpid(), "tid": threading.get_ident()})
+        self.observe(stage, elapsed)
+
+    def timed(self, stage: str = None):
+        """
+        Decorator timing every call of a function (see timer)
+
+        Parameters
+        -----------
+        - stage : name of the stage, the name of the function if not given
+        """
+        def decorate(function):
+            name = stage or function.__name__
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def startTrace(self, maxEvents: int = TRACE_EVENTS):
+        """
+        Starts recording every timed call as a trace event
+
+        Parameters
+        -----------
+        - maxEvents : events kept, the oldest ones are dropped past it
+        """
+        self.trace = deque(maxlen=maxEvents)
+
+    def saveTrace(self, file: str):
+        """
+        Writes the recorded events in the trace event JSON format
+
+        Parameters
+        -----------
+        - file : a string path to the output file
+        """
+        with self._lock:
+            events = list(self.trace or [])
+        with open(file, "w") as outFile:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, outFile)
+
+    def summary(self) -> dict:
+        """
+        Number of calls, total and mean milliseconds and errors of every stage
+        """
+        with self._lock:
+            return {stage: {"calls": sum(counts), "total_ms": total * 1000,
+                            "mean_ms": total * 1000 / max(sum(counts), 1), "errors": self.errors.get(stage, 0)}
+                    for stage, (counts, total) in sorted(self.histograms.items())}
+
+    def prometheus(self) -> str:
+        """
+        Exports the histograms and the counters in the Prometheus text exposition format
+        """
+        name = "%s_stage_seconds" % self.prefix
+        lines = ["# HELP %s Time spent in every stage of the recognition pipeline" % name,
+                 "# TYPE %s histogram" % name]
+        with self._lock:
+            for stage, (counts, total) in sorted(self.histograms.items()):
+                label = 'stage="%s"' % _escape(stage)
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%s"} %s' % (name, label, _bound(bound), cumulative))
+                lines.append("%s_sum{%s} %r" % (name, label, total))
+                lines.append("%s_count{%s} %s" % (name, label, cumulative))
+
+            lines += ["# HELP %s_stage_errors_total Calls of a stage that raised" % self.prefix,
+                      "# TYPE %s_stage_errors_total counter" % self.prefix]
+            lines += ['%s_stage_errors_total{stage="%s"} %s' % (self.prefix, _escape(stage), count)
+                      for stage, count in sorted(self.errors.items())]
+
+            counters = {}
+            for (counter, labels), value in self.counters.items():
+                counters.setdefault(counter, []).append((labels, value))
+            for counter, values in sorted(counters.items()):
+                total = "%s_%s_total" % (self.prefix, counter)
+                lines.append("# TYPE %s counter" % total)
+                for labels, value in sorted(values):
+                    labelText = ",".join('%s="%s"' % (key, _escape(str(label))) for key, label in labels)
+                    lines.append("%s%s %r" % (total, "{%s}" % labelText if labelText else "", value))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """
+        Forgets every recorded timing, counter and trace event
+        """
+        with self._lock:
+            self.histograms, self.errors, self.counters = {}, {}, {}
+            if self.trace is not None:
+                self.trace.clear()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+defaultMetrics = metricsRegistry()  # registry of the process used by the instrumented modules
+
+
+def timer(stage: str):
+    """
+    Times a block in the default registry (see metricsRegistry.timer)
+    """
+    return defaultMetrics.timer(stage)
+
+
+def timed(stage: str = None):
+    """
+    Times every call of a function in the default registry (see metricsRegistry.timed)
+    """
+    return defaultMetrics.timed(stage)
+
+
+def _saveTraceAtExit(registry: metricsRegistry, file: Path):
+    """
+    Saves the trace of the process as <stem>.<pid>.json when it exits, multiprocessing workers
+    exit without atexit so it is registered as a multiprocessing finalizer
+    """
+    Finalize(None, lambda: registry.saveTrace(str(file.with_name(
+        "%s.%s%s" % (file.stem, os.getpid(), file.suffix or ".json")))), exitpriority=0)
+
+
+# VOICE_TRACE=trace.json records every timed call of the process and of its worker processes
+if os.environ.get("VOICE_TRACE"):
+    _traceFile = Path(os.environ["VOICE_TRACE"])
+    defaultMetrics.startTrace()
+    _saveTraceAtExit(defaultMetrics, _traceFile)
+    # a worker starts with an empty trace of its own
+    register_after_fork(defaultMetrics, lambda registry: (registry.trace.clear(),
+                                                          _saveTraceAtExit(registry, _traceFile)))
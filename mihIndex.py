@@ -0,0 +1,209 @@
+from itertools import combinations
+import numpy as np
+from metrics import timed
+from hashIndex import hashIndex, bestPositions, popcount, similarity, RECORD_WORDS
+
+_SUBSTRING_TYPES = {128: np.uint8, 64: np.uint16, 32: np.uint32}  # number of substrings -> word type
+
+
+class mihIndex():
+    """
+    Multi-index hashing over the packed database records implements the following :
+
+    - Splits every 1024 bit record (the four 256 bit hashes) into m disjoint substrings
+    - Keeps one sorted bucket table per substring mapping its value to the songs holding it
+    - Answers radius and top-k queries by probing the tables, by the pigeonhole principle
+      a record within distance r of the query matches at least one substring within r // m,
+      so only those candidates are verified against the full record
+    """
+    def __init__(self, index: hashIndex, substrings: int = 64):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - index : a hashIndex holding the packed records
+        - substrings : number of substrings (m) each record is split into (32, 64 or 128)
+        """
+        if substrings not in _SUBSTRING_TYPES:
+            raise ValueError("substrings must be one of %s" % sorted(_SUBSTRING_TYPES))
+        self.index = index
+        self.substrings = substrings
+        self.wordType = _SUBSTRING_TYPES[substrings]
+        self.substringBits = np.dtype(self.wordType).itemsize * 8
+        self.lastCandidates = 0  # number of records verified by the last query
+
+        keys = self._split(index.matrix)
+        self.order = np.argsort(keys, axis=0, kind="stable").T.copy()
+        self.buckets = np.take_along_axis(keys, self.order.T, axis=0).T.copy()
+        self._masks = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _split(self, records: np.ndarray) -> np.ndarray:
+        """
+        Views packed records as their m substrings
+
+        Parameters
+        -----------
+        - records : uint64 array of shape (..., RECORD_WORDS)
+        """
+        records = np.ascontiguousarray(records, dtype=np.uint64)
+        return records.view(self.wordType).reshape(records.shape[:-1] + (self.substrings,))
+
+    def _flipMasks(self, distance: int) -> np.ndarray:
+        """
+        Gets all the substring values having exactly the given number of set bits
+
+        Parameters
+        -----------
+        - distance : number of flipped bits
+        """
+        if distance not in self._masks:
+            masks = [sum(1 << bit for bit in bits) for bits in combinations(range(self.substringBits), distance)]
+            self._masks[distance] = np.array(masks, dtype=self.wordType)
+        return self._masks[distance]
+
+    def _probe(self, keys: np.ndarray, distance: int) -> np.ndarray:
+        """
+        Collects the rows sharing a substring at exactly the given distance from the query
+
+        Parameters
+        -----------
+        - keys : the m substrings of the query
+        - distance : hamming distance probed inside every substring
+        """
+        masks = self._flipMasks(distance)
+        found = []
+        for table in range(self.substrings):
+            probes = keys[table] ^ masks
+            left = np.searchsorted(self.buckets[table], probes, side="left")
+            right = np.searchsorted(self.buckets[table], probes, side="right")
+            for start, stop in zip(left[right > left], right[right > left]):
+                found.append(self.order[table, start:stop])
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.intp)
+
+    def _distance(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """
+        Calculates the full record distance of the given rows
+        """
+        return popcount(self.index.matrix[rows] ^ query).sum(axis=1, dtype=np.int32)
+
+    def _results(self, rows: np.ndarray, total: np.ndarray) -> list:
+        """
+        Sorts rows by distance (ties by row) and maps them to (songName, similarity percentage)
+        """
+        order = np.lexsort((rows, total))
+        rows, total = rows[order], total[order]
+        return [(self.index.names[row], float(score)) for row, score in zip(rows, similarity(total))]
+
+    def radiusSearch(self, query: np.ndarray, radius: int) -> list:
+        """
+        Finds all songs whose summed hash distance to the query is within the radius
+
+        Parameters
+        -----------
+        - query : a packed record (see hashIndex.packRecord)
+        - radius : maximum hamming distance over the whole record
+
+        Returns
+        -----------
+        - a list of (songName, similarity percentage) sorted from best to worst match
+        """
+        query = np.asarray(query, dtype=np.uint64)
+        keys = self._split(query)
+        rows = np.unique(np.concatenate([self._probe(keys, d) for d in range(radius // self.substrings + 1)]))
+        total = self._distance(rows, query)
+        self.lastCandidates = len(rows)
+        keep = total <= radius
+        return self._results(rows[keep], total[keep])
+
+    @timed("mihSearch")
+    def search(self, query: np.ndarray, k: int = 10, maxProbe: int = 2) -> list:
+        """
+        Finds the k songs closest to the query, probing growing substring distances until
+        no unseen song can beat the k-th result, falling back to a linear scan beyond maxProbe
+
+        Parameters
+        -----------
+        - query : a packed record (see hashIndex.packRecord)
+        - k : number of results
+        - maxProbe : largest substring distance probed before scanning linearly
+
+        Returns
+        -----------
+        - a list of (songName, similarity percentage) sorted from best to worst match
+        """
+        query = np.asarray(query, dtype=np.uint64)
+        keys = self._split(query)
+        k = min(k, len(self.index))
+        rows = np.empty(0, dtype=np.intp)
+        total = np.empty(0, dtype=np.int32)
+
+        for distance in range(maxProbe + 1):
+            newRows = np.setdiff1d(self._probe(keys, distance), rows, assume_unique=True)
+            rows = np.concatenate([rows, newRows])
+            total = np.concatenate([total, self._distance(newRows, query)])
+            # every unseen song differs in all m substrings by more than distance
+            if len(rows) >= k and np.partition(total, k - 1)[k - 1] < self.substrings * (distance + 1):
+                self.lastCandidates = len(rows)
+                best = bestPositions(rows, total, k)
+                return self._results(rows[best], total[best])
+
+        self.lastCandidates = len(self.index)
+        return self.index.search(query, k)
+
+
+def benchmark(songs: int = 1000000, queries: int = 100, noise: int = 24, k: int = 1, seed: int = 0) -> dict:
+    """
+    Compares the multi-index search with the linear scan on a random catalogue, each query
+    is a catalogue record with `noise` random bits flipped (a near duplicate of a song)
+
+    :param songs: number of records in the synthetic catalogue
+    :param queries: number of queries timed
+    :param noise: number of bits flipped in every query
+    :param k: number of results per query
+    :param seed: seed of the random generator
+    :return: dictionary of the mean latencies (ms), mean candidates and agreement of both searches
+    """
+    import time
+
+    rng = np.random.default_rng(seed)
+    matrix = rng.integers(0, np.iinfo(np.uint64).max, (songs, RECORD_WORDS), dtype=np.uint64, endpoint=True)
+    linear = hashIndex([str(i) for i in range(songs)], matrix)
+    start = time.perf_counter()
+    mih = mihIndex(linear)
+    buildTime = time.perf_counter() - start
+
+    linearTime, mihTime, candidates, agree = 0.0, 0.0, 0, 0
+    for row in rng.integers(0, songs, queries):
+        query = matrix[row].copy()
+        for bit in rng.choice(RECORD_WORDS * 64, noise, replace=False):
+            query[bit // 64] ^= np.uint64(1 << int(bit % 64))
+
+        start = time.perf_counter()
+        expected = linear.search(query, k)
+        linearTime += time.perf_counter() - start
+        start = time.perf_counter()
+        found = mih.search(query, k)
+        mihTime += time.perf_counter() - start
+        candidates += mih.lastCandidates
+        agree += found == expected
+
+    return {"songs": songs, "noise_bits": noise, "build_s": buildTime,
+            "linear_ms": linearTime / queries * 1000, "mih_ms": mihTime / queries * 1000,
+            "mih_candidates": candidates / queries, "agreement": agree / queries}
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Benchmark multi-index hashing against the linear scan")
+    parser.add_argument("--songs", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--noise", type=int, default=24)
+    parser.add_argument("-k", type=int, default=1)
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.songs, args.queries, args.noise, args.k), indent=4))
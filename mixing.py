@@ -0,0 +1,159 @@
+import numpy as np
+from scipy import signal
+import librosa as l
+from phash import phash
+from hashIndex import RECORD_WORDS
+
+
+class mixAnalysis():
+    """
+    Analysis of the mixes w * song1 + (1 - w) * song2 of two songs implements the following :
+
+    - Computes the complex STFT of each song once, the STFT being linear the spectrogram of
+      any mix is |w * Z1 + (1 - w) * Z2| ** 2 = w² P1 + (1 - w)² P2 + w (1 - w) C, three
+      multiply-adds instead of mixing the samples and computing a new STFT
+    - Derives the features of a mix from that spectrogram like spectrogram.analyze, the mel
+      spectrogram being linear in the spectrogram it is combined from the mel spectrograms of
+      the three terms as well
+    - Hashes and searches a whole sweep of weights, the index is read once per batch of weights
+
+    The chroma estimates the tuning of every mix like spectrogram.analyze, which is most of the
+    cost of a mix, sharedTuning estimates it once for the whole sweep instead.
+    """
+    def __init__(self, song1: np.ndarray, song2: np.ndarray, songSR: int = 22050, windowType: str = "hann",
+                 sharedTuning: bool = False):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - song1, song2 : data arrays of the songs, the longer one is cut to the length of the other
+        - songSR : sample rate of both songs
+        - windowType : window used in creating the spectrogram
+        - sharedTuning : if True the chroma of every mix uses the tuning estimated on the equal mix
+        """
+        length = min(len(song1), len(song2))
+        stfts = []
+        for song in (song1[:length], song2[:length]):
+            song = song[:, 0] if len(song.shape) == 2 else song  # like spectrogram._spectrogram
+            self.sampleFreqs, self.sampleTime, stft = signal.spectrogram(song, fs=songSR, window=windowType,
+                                                                         mode="complex")
+            stfts.append(stft)
+        # the one sided power spectral density doubles every bin but DC (and Nyquist for even lengths)
+        scale = np.full((len(self.sampleFreqs), 1), 2, dtype=stfts[0].real.dtype)
+        scale[0] = 1
+        if self.sampleFreqs[-1] == songSR / 2:
+            scale[-1] = 1
+        self.power1 = (stfts[0].real ** 2 + stfts[0].imag ** 2) * scale
+        self.power2 = (stfts[1].real ** 2 + stfts[1].imag ** 2) * scale
+        self.cross = 2 * (stfts[0] * stfts[1].conj()).real * scale
+        self.songSR = songSR
+        self.mels = [l.feature.melspectrogram(S=terms, sr=songSR) for terms in (self.power1, self.power2, self.cross)]
+        self.tuning = None
+        if sharedTuning:
+            self.tuning = l.estimate_tuning(S=self.colorMesh(0.5), sr=songSR,
+                                            n_fft=2 * (len(self.sampleFreqs) - 1))
+
+    def colorMesh(self, w: float) -> np.ndarray:
+        """
+        Spectrogram of the mix, as spectrogram._spectrogram(mixSongs(song1, song2, w=w)) would compute it
+
+        Parameters
+        -----------
+        - w : weight (percentage) of song1
+        """
+        return self._combine((self.power1, self.power2, self.cross), w)
+
+    @staticmethod
+    def _combine(terms: tuple, w: float) -> np.ndarray:
+        """
+        w² terms[0] + (1 - w)² terms[1] + w (1 - w) terms[2]
+        """
+        combined = terms[0] * (w * w)
+        combined += terms[1] * ((1 - w) * (1 - w))
+        combined += terms[2] * (w * (1 - w))
+        return np.maximum(combined, 0, out=combined)  # rounding must not make a power negative
+
+    def analyze(self, w: float) -> tuple:
+        """
+        Computes the spectrogram of the mix and the three features like spectrogram.analyze
+
+        Parameters
+        -----------
+        - w : weight (percentage) of song1
+
+        Returns
+        -----------
+        - the color mesh and a tuple of the three features (mel, mfcc, chroma)
+        """
+        mesh = self.colorMesh(w)
+        mel = self._combine(self.mels, w)
+        mfcc = l.feature.mfcc(S=l.power_to_db(mel), sr=self.songSR)
+        chroma = l.feature.chroma_stft(S=mesh, sr=self.songSR, tuning=self.tuning)
+        return mesh, (mel, mfcc, chroma)
+
+    def records(self, weights) -> np.ndarray:
+        """
+        Packed records (see hashIndex.packRecord) of the mixes of every weight
+
+        Parameters
+        -----------
+        - weights : weights (percentages) of song1
+        """
+        records = np.empty((len(weights), RECORD_WORDS), dtype=np.uint64)
+        for i, w in enumerate(weights):
+            mesh, features = self.analyze(w)
+            records[i] = phash((mesh,) + features).ravel()
+        return records
+
+    def sweep(self, index, weights=np.linspace(0, 1, 11), k: int = 10, batch: int = 8) -> list:
+        """
+        Searches the mixes of a set of weights in the database
+
+        Parameters
+        -----------
+        - index : the hashIndex searched
+        - weights : weights (percentages) of song1
+        - k : number of results per weight
+        - batch : number of weights whose spectrograms are held in memory at a time
+
+        Returns
+        -----------
+        - a list of (weight, list of (songName, similarity percentage)) in the order of weights
+        """
+        weights = list(weights)
+        results = []
+        for first in range(0, len(weights), batch):
+            chunk = weights[first:first + batch]
+            results += zip(chunk, index.searchBatch(self.records(chunk), k))
+        return [(float(w), matches) for w, matches in results]
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import warnings
+    from hashIndex import hashIndex
+    import loader
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description="Search the mixes of two songs over a sweep of weights, "
+                                                 "printing one JSON result per weight")
+    parser.add_argument("song1")
+    parser.add_argument("song2")
+    parser.add_argument("--db", default="Database/db.json", help="json database built by updateDB")
+    parser.add_argument("--weights", type=int, default=11, help="number of weights from 0 to 100%%")
+    parser.add_argument("--top-k", type=int, default=5, help="matches reported per weight")
+    parser.add_argument("--seconds", type=float, default=60, help="seconds loaded from every song")
+    parser.add_argument("--shared-tuning", action="store_true",
+                        help="estimate the chroma tuning once per pair instead of once per weight")
+    args = parser.parse_args()
+
+    index = hashIndex.fromPath(args.db)
+    targetRate = loader.readFrontEnd(args.db)
+    (data1, rate), (data2, _) = loader.loadCanonical(args.song1, args.seconds * 1000, targetRate), \
+        loader.loadCanonical(args.song2, args.seconds * 1000, targetRate)
+    mixer = mixAnalysis(data1, data2, rate, sharedTuning=args.shared_tuning)
+    for w, matches in mixer.sweep(index, np.linspace(0, 1, args.weights), args.top_k):
+        print(json.dumps({"weight": w, "matches": [{"song": song, "similarity": score} for song, score in matches]}))
@@ -0,0 +1,182 @@
+from functools import lru_cache
+import numpy as np
+import scipy.fftpack
+from metrics import timed
+
+PRECISION_BITS = 22  # fixed point precision of the 8 bit resampling of PIL (32 - 8 - 2)
+LANCZOS_SUPPORT = 3.0
+
+
+def _sinc(x: np.ndarray) -> np.ndarray:
+    x = x * np.pi
+    safe = np.where(x == 0.0, 1.0, x)
+    return np.where(x == 0.0, 1.0, np.sin(safe) / safe)
+
+
+@lru_cache(maxsize=64)
+def _lanczosWeights(inSize: int, outSize: int) -> np.ndarray:
+    """
+    Fixed point Lanczos weights PIL uses to resize an axis of an 8 bit image
+
+    :param inSize: length of the axis before resizing
+    :param outSize: length of the axis after resizing
+    :return: float64 matrix (inSize, outSize) of the integer weights, computed once per size
+    """
+    scale = float(inSize) / outSize
+    filterScale = max(scale, 1.0)
+    support = LANCZOS_SUPPORT * filterScale
+    centers = (np.arange(outSize) + 0.5) * scale
+    # same rounding of the bounds as PIL, the casts truncate toward zero like C
+    first = np.maximum((centers - support + 0.5).astype(np.int64), 0)
+    last = np.minimum((centers + support + 0.5).astype(np.int64), inSize)
+
+    x = np.arange(inSize)
+    inside = (x >= first[:, None]) & (x < last[:, None])
+    position = (x[None, :] - centers[:, None] + 0.5) * (1.0 / filterScale)
+    weights = np.where(inside & (position >= -3.0) & (position < 3.0),
+                       _sinc(position) * _sinc(position / 3), 0.0)
+    total = np.cumsum(weights, axis=1)[:, -1:]  # summed in order like PIL
+    weights = np.divide(weights, total, out=weights, where=total != 0.0)
+    scaled = weights * (1 << PRECISION_BITS)
+    weights = np.ascontiguousarray(np.trunc(np.where(weights < 0, scaled - 0.5, scaled + 0.5)).T)
+    weights.setflags(write=False)  # the pixel x weight sums stay exact integers in float64
+    return weights
+
+
+def _clip8(values: np.ndarray) -> np.ndarray:
+    """
+    Rounds the fixed point sums of a resampling pass back to 8 bit values
+    """
+    values += 1 << (PRECISION_BITS - 1)
+    values *= 1.0 / (1 << PRECISION_BITS)
+    np.floor(values, out=values)
+    return np.clip(values, 0, 255, out=values)
+
+
+def toPixels(matrices: np.ndarray) -> np.ndarray:
+    """
+    Converts float matrices to the gray levels of Image.fromarray(matrix).convert("L")
+
+    :param matrices: float array, the last two axes are the rows and the columns of the images
+    :return: float64 array of the integer gray levels (0 - 255)
+    """
+    levels = np.asarray(matrices, dtype=np.float32)  # Image.fromarray keeps floats as 32 bits
+    pixels = np.empty(levels.shape, dtype=np.float64)
+    np.clip(levels, 0, 255, out=pixels)
+    np.trunc(pixels, out=pixels)
+    if np.isnan(pixels.sum()):
+        np.nan_to_num(pixels, copy=False, nan=0.0)
+    return pixels
+
+
+def resize(pixels: np.ndarray, rows: int, columns: int) -> np.ndarray:
+    """
+    Resizes stacked 8 bit images exactly like PIL (Lanczos, horizontal then vertical pass)
+
+    :param pixels: gray levels of shape (..., height, width), see toPixels
+    :param rows: height of the resized images
+    :param columns: width of the resized images
+    :return: float64 array of the resized gray levels of shape (..., rows, columns)
+    """
+    height, width = pixels.shape[-2:]
+    stack = pixels.shape[:-2]
+    if width != columns:
+        pixels = _clip8(pixels.reshape(-1, width) @ _lanczosWeights(width, columns)).reshape(stack + (height, columns))
+    if height != rows:
+        pixels = np.moveaxis(pixels, -2, -1).reshape(-1, height)
+        pixels = _clip8(pixels @ _lanczosWeights(height, rows)).reshape(stack + (columns, rows))
+        pixels = np.moveaxis(pixels, -1, -2)
+    return pixels
+
+
+def _phashStack(matrices: np.ndarray, hashSize: int, highfreqFactor: int) -> np.ndarray:
+    """
+    Hashes a stack of equally shaped matrices
+    """
+    imageSize = hashSize * highfreqFactor
+    pixels = resize(toPixels(matrices), imageSize, imageSize)
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=-2), axis=-1)
+    lowFrequencies = dct[:, :hashSize, :hashSize].reshape(len(dct), -1)
+    bits = lowFrequencies > np.median(lowFrequencies, axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(">u8").astype(np.uint64)
+
+
+@timed("phash")
+def phash(matrices, hashSize: int = 16, highfreqFactor: int = 4) -> np.ndarray:
+    """
+    Perceptual hashes of float matrices, bit for bit the ones of imagehash.phash on
+    Image.fromarray(matrix) without going through PIL
+
+    :param matrices: a stack of matrices (array of shape (n, rows, columns)) or a list of
+                     matrices of any shapes, matrices of the same shape are hashed together
+    :param hashSize: hash_size of imagehash.phash, the hashes have hashSize ** 2 bits
+    :param highfreqFactor: highfreq_factor of imagehash.phash
+    :return: uint64 array of shape (n, hashSize ** 2 // 64), the words of every hash most significant first
+    """
+    if isinstance(matrices, np.ndarray) and matrices.ndim == 3:
+        return _phashStack(matrices, hashSize, highfreqFactor)
+    matrices = [np.asarray(matrix) for matrix in matrices]
+    hashes = np.zeros((len(matrices), hashSize * hashSize // 64), dtype=np.uint64)
+    shapes = {}
+    for i, matrix in enumerate(matrices):
+        shapes.setdefault(matrix.shape, []).append(i)
+    for shape, rows in shapes.items():
+        stack = matrices[rows[0]][None] if len(rows) == 1 else np.stack([matrices[i] for i in rows])
+        hashes[rows] = _phashStack(stack, hashSize, highfreqFactor)
+    return hashes
+
+
+def toHex(words: np.ndarray) -> str:
+    """
+    Formats the words of one hash like str(imagehash.ImageHash)
+    """
+    return np.asarray(words, dtype=np.uint64).astype(">u8").tobytes().hex()
+
+
+def phashParity(matrices, hashSize: int = 16, highfreqFactor: int = 4) -> np.ndarray:
+    """
+    Compares phash with imagehash.phash on the same matrices
+
+    :param matrices: a stack or a list of matrices (see phash)
+    :param hashSize: hash_size of imagehash.phash
+    :param highfreqFactor: highfreq_factor of imagehash.phash
+    :return: number of different bits of every matrix, all zeros when both agree
+    """
+    from PIL import Image
+    import imagehash
+
+    hashes = phash(matrices, hashSize, highfreqFactor)
+    different = []
+    for matrix, words in zip(matrices, hashes):
+        reference = imagehash.phash(Image.fromarray(np.asarray(matrix)), hash_size=hashSize,
+                                    highfreq_factor=highfreqFactor)
+        bits = np.unpackbits(words.astype(">u8").view(np.uint8)).astype(bool)
+        different.append(int(np.count_nonzero(reference.hash.flatten() != bits)))
+    return np.array(different)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from Spectrogram import spectrogram
+    from benchmark import KINDS, synthesizeTrack
+
+    parser = argparse.ArgumentParser(description="Check phash against imagehash on synthesized tracks and time both")
+    parser.add_argument("--tracks", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=60)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    matrices = []
+    for i in range(args.tracks):
+        mesh, features = spectrogram().analyze(synthesizeTrack(KINDS[i % len(KINDS)], args.seconds, 22050, rng), 22050)
+        matrices += [mesh] + list(features)
+
+    start = time.perf_counter()
+    phash(matrices)
+    native = time.perf_counter() - start
+    start = time.perf_counter()
+    different = phashParity(matrices)
+    reference = time.perf_counter() - start - native
+    print("%s matrices, %s with different bits (%s bits)" % (len(matrices), np.count_nonzero(different), different.sum()))
+    print("phash %.1f ms, imagehash %.1f ms" % (native * 1000, reference * 1000))
@@ -0,0 +1,138 @@
+from pathlib import Path
+import json
+import numpy as np
+from metrics import timed
+from Spectrogram import spectrogram
+from phash import phash
+from hashIndex import HASH_COLUMNS, HASH_WORDS, RECORD_WORDS, bestPositions, hammingDistances, similarity
+
+FEATURES = ("spectrogram", "mel", "mfcc", "chroma")  # hashed columns of a record, in order
+
+
+class scoringProfile():
+    """
+    Per deployment choice of the hashes a query is scored on implements the following :
+
+    - Extracts and hashes only the features of the profile, the mfcc being the most expensive one
+    - Fuses the hamming distances of those hashes with per feature weights instead of a plain /4
+    - Runs as a cascade when first is given, the cheap first features are compared on the whole
+      index and the other ones are only extracted if the best candidate is not already ahead of
+      the second by exitMargin bits, then only compared on the shortlist of the best candidates
+
+    The default profile (all features, equal weights, no cascade) scores like hashIndex.search.
+    """
+    def __init__(self, weights: dict = None, first: list = None, shortlist: int = 100, exitMargin: float = None):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - weights : feature name -> weight, a feature missing or weighted 0 is neither extracted nor compared,
+                    all the features weighted 1 if not given
+        - first : features compared in the first stage of the cascade, no cascade if not given
+        - shortlist : number of candidates of the first stage compared on the other features
+        - exitMargin : mean distance (bits per hash) the best candidate of the first stage must lead the
+                       second by for the query to stop there, it never stops early if None
+        """
+        weights = {name: 1.0 for name in FEATURES} if weights is None else dict(weights)
+        unknown = set(weights) - set(FEATURES)
+        if unknown:
+            raise ValueError("unknown features %s, expected some of %s" % (sorted(unknown), FEATURES))
+        self.weights = {name: float(weights[name]) for name in FEATURES if weights.get(name, 0) > 0}
+        if not self.weights:
+            raise ValueError("the profile must weight at least one feature")
+        self.features = list(self.weights)
+        self.first = [name for name in self.features if name in first] if first else None
+        if first and set(first) - set(self.first):
+            raise ValueError("first stage features %s are not weighted" % sorted(set(first) - set(self.first)))
+        self.shortlist = int(shortlist)
+        self.exitMargin = exitMargin
+        self.lastStats = {}  # stages run, candidates of the last stage and features extracted by the last query
+
+    @classmethod
+    def fromFile(cls, file: str) -> "scoringProfile":
+        """
+        Loads a profile from a json file of the initializer arguments, e.g
+        {"weights": {"spectrogram": 1, "mel": 1, "chroma": 0.5}, "first": ["spectrogram"], "exitMargin": 8}
+
+        Parameters
+        -----------
+        - file : a string path to the json file, the default profile if it does not exist
+        """
+        if file is None or not Path(file).exists():
+            return cls()
+        with open(file) as inFile:
+            return cls(**json.load(inFile))
+
+    @property
+    def plain(self) -> bool:
+        """
+        True if the profile scores like hashIndex.search, all the features equally weighted in one stage
+        """
+        return self.first is None and len(self.features) == HASH_COLUMNS and len(set(self.weights.values())) == 1
+
+    def _fuse(self, distances: np.ndarray, names: list) -> np.ndarray:
+        """
+        Weighted mean distance (bits per hash) of the compared hashes of every candidate
+        """
+        weights = np.array([self.weights[name] for name in names])
+        return distances @ weights / weights.sum()
+
+    def _hash(self, query: np.ndarray, mesh: np.ndarray, sr: int, names: list, computed: dict) -> dict:
+        """
+        Extracts the named features of the spectrogram and writes their hashes in the query record
+
+        Returns
+        -----------
+        - the features computed so far, reused by the next stage
+        """
+        computed = spectrogram().featuresOf(mesh, [name for name in names if name != "spectrogram"], sr, computed)
+        hashes = phash([mesh if name == "spectrogram" else computed[name] for name in names])
+        for name, words in zip(names, hashes):
+            column = FEATURES.index(name)
+            query[column * HASH_WORDS:(column + 1) * HASH_WORDS] = words
+        return computed
+
+    @timed("profileSearch")
+    def search(self, index, mesh: np.ndarray, sr: int = 22050, k: int = None) -> list:
+        """
+        Extracts, hashes and compares the features of the profile stage by stage
+
+        Parameters
+        -----------
+        - index : the hashIndex searched
+        - mesh : spectrogram of the query (see spectrogram._spectrogram), every feature is derived from it
+        - sr : sample rate of the query
+        - k : number of results, all the candidates of the last stage if not given
+
+        Returns
+        -----------
+        - a list of (songName, similarity percentage) sorted from best to worst match, limited to the
+          shortlist when the second stage ran
+        """
+        stages = [self.features]
+        if self.first:
+            stages = [self.first, [name for name in self.features if name not in self.first]]
+        query = np.zeros(RECORD_WORDS, dtype=np.uint64)
+        rows = np.arange(len(index))
+        distances = np.empty((len(rows), 0), dtype=np.int32)
+        compared, computed = [], {}
+        for stage, names in enumerate(stages):
+            if stage:
+                keep = bestPositions(rows, score, self.shortlist)
+                rows, distances, score = rows[keep], distances[keep], score[keep]
+                if self.exitMargin is not None and (len(rows) < 2 or score[1] - score[0] >= self.exitMargin):
+                    break
+            computed = self._hash(query, mesh, sr, names, computed)
+            matrix = index.matrix[rows] if stage else index.matrix
+            columns = [FEATURES.index(name) for name in names]
+            distances = np.concatenate([distances, hammingDistances(matrix, query, columns)], axis=1)
+            compared += names
+            score = self._fuse(distances, compared)
+        self.lastStats = {"stages": len(stages) if len(compared) == len(self.features) else 1,
+                          "candidates": len(rows), "extracted": list(compared)}
+
+        best = bestPositions(rows, score, k)
+        # the weighted mean per hash maps to a percentage like the plain total of the four hashes
+        return [(index.names[row], float(percentage))
+                for row, percentage in zip(rows[best], similarity(score[best] * HASH_COLUMNS))]
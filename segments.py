@@ -0,0 +1,203 @@
+from pathlib import Path
+import numpy as np
+from Spectrogram import spectrogram
+from phash import phash
+from hashIndex import RECORD_WORDS, hammingDistances, similarity
+
+WINDOW_SECONDS = 3  # length of every hashed window, the shortest clip that can be matched
+HOP_SECONDS = 1  # distance between the starts of two windows of a song
+QUERY_PHASES = 4  # shifts of the query windows tried within one hop, the clip rarely starts on a database window
+
+
+def segmentHashes(songData: np.ndarray, songSR: int, channels: int = 1, window: float = WINDOW_SECONDS,
+                  hop: float = HOP_SECONDS, phase: float = 0) -> np.ndarray:
+    """
+    Hashes the overlapping windows of a song, the spectrogram is computed once and sliced
+
+    :param songData: data array of the song (interleaved if stereo, like loader.decodeWindow)
+    :param songSR: sample rate of the song
+    :param channels: number of channels interleaved in songData
+    :param window: length of the windows in seconds
+    :param hop: distance between the starts of two windows in seconds
+    :param phase: start of the first window in seconds
+    :return: uint64 matrix of one packed record (see hashIndex.packRecord) per window
+    """
+    _, times, mesh = spectrogram()._spectrogram(songData, songSR)
+    return meshSegmentHashes(mesh, times / channels, songSR, window, hop, phase)
+
+
+def meshSegmentHashes(mesh: np.ndarray, times: np.ndarray, songSR: int, window: float = WINDOW_SECONDS,
+                      hop: float = HOP_SECONDS, phase: float = 0) -> np.ndarray:
+    """
+    Hashes the overlapping windows of an already computed spectrogram
+
+    :param mesh: spectrogram of the song (see spectrogram._spectrogram)
+    :param times: time of every frame in seconds from the start of the song
+    :param songSR: sample rate of the song
+    :param window: length of the windows in seconds
+    :param hop: distance between the starts of two windows in seconds
+    :param phase: start of the first window in seconds
+    :return: uint64 matrix of one packed record (see hashIndex.packRecord) per window
+    """
+    spectrum = spectrogram()
+    lastStart = max(times[-1] - window, phase) if len(times) else phase
+    matrices = []
+    for start in np.arange(phase, lastStart + hop / 2, hop):
+        frames = mesh[:, (times >= start) & (times < start + window)]
+        if frames.shape[1] == 0:
+            continue
+        matrices += [frames] + list(spectrum.meshFeatures(frames, songSR))
+    if not matrices:
+        return np.empty((0, RECORD_WORDS), dtype=np.uint64)
+    # all the windows are hashed in one batch, the record of a window is its 4 consecutive hashes
+    return phash(matrices).reshape(-1, RECORD_WORDS)
+
+
+class segmentIndex():
+    """
+    Index of the window hashes of every song implements the following :
+
+    - Holds the packed records of the overlapping windows of all songs in one matrix
+    - Matches a clip by hashing its own windows and sliding them along every song,
+      the alignment with the smallest summed distance gives the song and the time offset
+    """
+    def __init__(self, names: list, matrix: np.ndarray, songIds: np.ndarray,
+                 window: float = WINDOW_SECONDS, hop: float = HOP_SECONDS):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - names : list of the song names, indexed by song id
+        - matrix : uint64 records of the windows of all songs, song after song
+        - songIds : song id of every window
+        - window : length of the windows in seconds
+        - hop : distance between the starts of two windows in seconds
+        """
+        self.names = list(names)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.uint64).reshape(-1, RECORD_WORDS)
+        self.songIds = np.asarray(songIds, dtype=np.int32)
+        self.window = float(window)
+        self.hop = float(hop)
+        # index of every window within its own song
+        songStarts = np.searchsorted(self.songIds, np.arange(len(self.names)))
+        self.positions = np.arange(len(self.songIds)) - songStarts[self.songIds]
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def fromFolder(cls, folder: str, window: float = WINDOW_SECONDS, hop: float = HOP_SECONDS) -> "segmentIndex":
+        """
+        Builds the index from the per song window files written by updateDB (name.npy)
+
+        Parameters
+        -----------
+        - folder : folder of the window files
+        - window, hop : the windows the files were hashed with
+        """
+        names, records, songIds = [], [], []
+        for songId, file in enumerate(sorted(Path(folder).glob("*.npy"))):
+            songRecords = np.load(file)
+            names.append(file.stem)
+            records.append(songRecords)
+            songIds.append(np.full(len(songRecords), songId))
+        if not names:
+            return cls([], np.empty((0, RECORD_WORDS)), np.empty(0), window, hop)
+        return cls(names, np.concatenate(records), np.concatenate(songIds), window, hop)
+
+    @classmethod
+    def load(cls, file: str) -> "segmentIndex":
+        """
+        Loads an index saved with save()
+
+        Parameters
+        -----------
+        - file : a string path to the .npz index
+        """
+        with np.load(file) as saved:
+            return cls([str(name) for name in saved["names"]], saved["matrix"], saved["songIds"],
+                       float(saved["window"]), float(saved["hop"]))
+
+    def save(self, file: str):
+        """
+        Saves the window records, the song names and the window parameters in a .npz file
+
+        Parameters
+        -----------
+        - file : a string path to the output file
+        """
+        np.savez(file, names=np.array(self.names), matrix=self.matrix, songIds=self.songIds,
+                 window=self.window, hop=self.hop)
+
+    def _align(self, queryRecords: np.ndarray) -> tuple:
+        """
+        Sums the distances of the query windows along every alignment of the database windows
+
+        Returns
+        -----------
+        - first database window of every alignment and the mean total distance of its windows
+        """
+        count = len(queryRecords)
+        alignments = len(self.matrix) - count + 1
+        if count == 0 or alignments <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        total = np.zeros(alignments, dtype=np.int64)
+        for j, record in enumerate(queryRecords):
+            total += hammingDistances(self.matrix[j:j + alignments], record).sum(axis=1)
+        first = np.arange(alignments)
+        # an alignment must stay inside a single song
+        inside = self.songIds[first] == self.songIds[first + count - 1]
+        return first[inside], total[inside] / count
+
+    def query(self, songData: np.ndarray, songSR: int, channels: int = 1, k: int = 10) -> list:
+        """
+        Finds the songs and the time offsets whose windows best match the windows of a clip
+
+        Parameters
+        -----------
+        - songData : data array of the clip, at least one window long
+        - songSR : sample rate of the clip
+        - channels : number of channels interleaved in songData
+        - k : number of results
+
+        Returns
+        -----------
+        - a list of (songName, similarity percentage, offset of the clip in the song in seconds)
+          sorted from best to worst match
+        """
+        _, times, mesh = spectrogram()._spectrogram(songData, songSR)
+        return self.queryMesh(mesh, times / channels, songSR, k)
+
+    def queryMesh(self, mesh: np.ndarray, times: np.ndarray, songSR: int, k: int = 10) -> list:
+        """
+        Like query() for the already computed spectrogram of a clip
+
+        Parameters
+        -----------
+        - mesh : spectrogram of the clip (see spectrogram._spectrogram)
+        - times : time of every frame in seconds from the start of the clip
+        - songSR : sample rate of the clip
+        - k : number of results
+
+        Returns
+        -----------
+        - a list of (songName, similarity percentage, offset of the clip in the song in seconds)
+          sorted from best to worst match
+        """
+        rows, distances, offsets = [], [], []
+        for phase in np.arange(QUERY_PHASES) * self.hop / QUERY_PHASES:
+            first, distance = self._align(meshSegmentHashes(mesh, times, songSR, self.window, self.hop, phase))
+            rows.append(first)
+            distances.append(distance)
+            offsets.append(self.positions[first] * self.hop - phase)
+        rows, distances, offsets = np.concatenate(rows), np.concatenate(distances), np.concatenate(offsets)
+        if len(rows) == 0:
+            return []
+
+        songIds = self.songIds[rows]
+        best = np.lexsort((offsets, songIds, distances))
+        _, first = np.unique(songIds[best], return_index=True)
+        best = best[np.sort(first)][:k]
+        return [(self.names[songIds[i]], float(similarity(distances[i])), max(float(offsets[i]), 0.0))
+                for i in best]
@@ -0,0 +1,432 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from urllib.parse import parse_qs, quote, urlsplit
+import asyncio
+import http.client
+import json
+import os
+import socket
+import tempfile
+import time
+import numpy as np
+from identify import hashClip
+from loader import readFrontEnd
+from hashIndex import HASH_BITS, HASH_COLUMNS, packHash, packRecord
+from mihIndex import mihIndex
+from snapshots import snapshotHolder
+from metrics import defaultMetrics
+
+MAX_BODY = 64 * 2**20  # largest upload accepted (bytes)
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class requestError(Exception):
+    """
+    Raised while handling a request, answered with its status and message
+    """
+    def __init__(self, status: int, message: str):
+        super(requestError, self).__init__(message)
+        self.status = status
+
+
+def hashUpload(audio: bytes, fileName: str = "clip", fMilliSeconds: float = 60000, targetRate: int = None) -> dict:
+    """
+    Hashes an uploaded clip exactly like identify.hashClip, runs in the worker processes
+
+    :param audio: content of the audio file
+    :param fileName: name of the uploaded file, its suffix tells the decoder the format
+    :param fMilliSeconds: number of milliseconds loaded from the start of the clip
+    :param targetRate: canonical sample rate of the database, None for legacy hashes
+    :return: dictionary of the clip hashes and the time (ms) spent in every stage
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / Path(fileName).name
+        path.write_bytes(audio)
+        result = hashClip(str(path), fMilliSeconds, targetRate)
+    result["clip"] = fileName
+    return result
+
+
+class searchServer():
+    """
+    Local search service implements the following :
+
+    - Loads the packed index of the database once and keeps it in memory for every client
+    - Swaps in the new version of the index written by updateDB without stopping (see snapshots.py)
+    - Hashes uploaded clips on a pool of processes, like the search of voiceRecognizer
+    - Gathers the queries arriving together into batches searched in one pass over the index
+    - Answers over HTTP on a TCP port or a Unix socket with ranked JSON results
+
+    Routes
+    -----------
+    - GET /health : number of songs, index version, backend and served queries
+    - GET /metrics : timings of every stage and counters in the Prometheus text format
+    - POST /reload : loads the index again if updateDB changed it
+    - POST /search?k=10 : json {"spectrohash": hex, "features": [hex, hex, hex]} or {"queries": [...]}
+    - POST /identify?k=10&name=clip.mp3 : the audio file as body
+    - POST /shard?k=10 : json {"records": [hex of a whole packed record, ...]}, the rows, summed distances
+      and names of the best songs of the served index (a shard of shards.shardedIndex), k is all songs if not given
+    """
+    def __init__(self, dbPath: str = "Database/db.json", backend: str = "linear", workers: int = 2,
+                 maxBatch: int = 32, batchWindow: float = 0.005, fMilliSeconds: float = 60000,
+                 reloadInterval: float = None):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - dbPath : a string path to the json database, its binary index is opened (see hashIndex.fromPath)
+        - backend : "linear" scans every song, "mih" uses multi-index hashing
+        - workers : number of processes hashing uploaded clips
+        - maxBatch : largest number of queries searched together
+        - batchWindow : seconds a query waits for others to join its batch
+        - fMilliSeconds : number of milliseconds hashed from every uploaded clip
+        - reloadInterval : seconds between two checks for a new index version, only on /reload if not given
+        """
+        self.snapshots = snapshotHolder(dbPath, mihIndex if backend == "mih" else None)
+        self.dbPath = dbPath
+        self.backend = backend
+        self.reloadInterval = reloadInterval
+        self._stopWatch = None
+        self.workers = workers
+        self.maxBatch = maxBatch
+        self.batchWindow = batchWindow
+        self.fMilliSeconds = fMilliSeconds
+        self.served = 0
+        self.batches = 0
+        self.executor = None
+        self.queue = None
+        self._batcher = None
+
+    def _searchBatch(self, queries: np.ndarray, k: int) -> list:
+        """
+        Searches a batch of packed queries, on a thread of the event loop, the whole batch
+        runs on the version of the index current when it starts
+        """
+        current = self.snapshots.current()
+        if self.backend == "mih":
+            return [current.searcher.search(query, k) for query in queries]
+        return current.index.searchBatch(queries, k)
+
+    async def _runBatches(self):
+        """
+        Takes the waiting queries off the queue and searches them in batches
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batchWindow
+            while len(batch) < self.maxBatch:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+
+            k = max(k for _, k, _ in batch)
+            try:
+                results = await loop.run_in_executor(None, self._searchBatch,
+                                                     np.stack([query for query, _, _ in batch]), k)
+            except Exception:
+                # a failing batch is searched again query by query, only the failing ones get the error
+                await self._runAlone(batch)
+                continue
+            self.batches += 1
+            defaultMetrics.count("batches")
+            defaultMetrics.count("queries", len(batch))
+            for (_, k, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result[:k])
+
+    async def _runAlone(self, batch: list):
+        """
+        Searches the queries of a failed batch one at a time
+        """
+        loop = asyncio.get_running_loop()
+        for query, k, future in batch:
+            try:
+                result = (await loop.run_in_executor(None, self._searchBatch, query[None], k))[0]
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+                continue
+            self.batches += 1
+            defaultMetrics.count("batches")
+            defaultMetrics.count("queries")
+            if not future.done():
+                future.set_result(result)
+
+    async def search(self, query: np.ndarray, k: int = 10) -> list:
+        """
+        Searches a packed query with the others of its batch
+
+        Parameters
+        -----------
+        - query : a packed record (see hashIndex.packRecord)
+        - k : number of results
+
+        Returns
+        -----------
+        - a list of (songName, similarity percentage) sorted from best to worst match
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, k, future))
+        results = await future
+        self.served += 1
+        return results
+
+    async def identify(self, audio: bytes, fileName: str = "clip", k: int = 10) -> dict:
+        """
+        Hashes an uploaded clip on the worker processes and searches it
+
+        Parameters
+        -----------
+        - audio : content of the audio file
+        - fileName : name of the uploaded file
+        - k : number of results
+
+        Returns
+        -----------
+        - dictionary of the clip hashes, its matches and the time (ms) spent in every stage
+        """
+        loop = asyncio.get_running_loop()
+        rate = readFrontEnd(self.dbPath)  # read on every clip, a rebuilt database may change it
+        try:
+            result = await loop.run_in_executor(self.executor, hashUpload, audio, fileName, self.fMilliSeconds, rate)
+        except Exception as error:
+            raise requestError(400, "could not hash %s : %r" % (fileName, error))
+        start = time.perf_counter()
+        matches = await self.search(packRecord(result["spectrohash"], result["features"]), k)
+        result["timings_ms"]["search"] = (time.perf_counter() - start) * 1000
+        for stage, ms in result["timings_ms"].items():  # measured in the worker processes, out of this registry
+            defaultMetrics.observe("clip_" + stage, ms / 1000)
+        result["matches"] = _matches(matches)
+        return result
+
+    async def _route(self, method: str, target: str, body: bytes):
+        """
+        Answers a request, raising requestError for the invalid ones
+
+        Returns
+        -----------
+        - the json answer, or the text of the plain text routes
+        """
+        url = urlsplit(target)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            k = int(params.get("k", 10))
+        except ValueError:
+            raise requestError(400, "k must be an integer, got %r" % params["k"])
+        if k < 1:
+            raise requestError(400, "k must be at least 1, got %s" % k)
+
+        if method == "GET" and url.path == "/health":
+            current = self.snapshots.current()
+            return {"songs": len(current.index), "version": current.version, "backend": self.backend,
+                    "served": self.served, "batches": self.batches}
+        if method == "GET" and url.path == "/metrics":
+            return defaultMetrics.prometheus()
+        if method == "POST" and url.path == "/reload":
+            reloaded = await asyncio.get_running_loop().run_in_executor(None, self.snapshots.reload)
+            current = self.snapshots.current()
+            return {"reloaded": reloaded, "version": current.version, "songs": len(current.index)}
+        if method == "POST" and url.path == "/search":
+            try:
+                request = json.loads(body)
+                records = [packRecord(query["spectrohash"], query["features"])
+                           for query in request.get("queries", [request])]
+            except (ValueError, KeyError, TypeError) as error:
+                raise requestError(400, "invalid hashes : %r" % error)
+            for number, query in enumerate(request.get("queries", [request])):
+                hashes = [query["spectrohash"]] + list(query["features"])
+                if len(hashes) != HASH_COLUMNS or any(len(h) != HASH_BITS // 4 for h in hashes):
+                    raise requestError(400, "query %s needs a spectrohash and %s feature hashes of %s bits"
+                                       % (number, HASH_COLUMNS - 1, HASH_BITS))
+            results = await asyncio.gather(*[self.search(record, k) for record in records])
+            return {"results": [_matches(matches) for matches in results]}
+        if method == "POST" and url.path == "/shard":
+            try:
+                records = np.array([packHash(record) for record in json.loads(body)["records"]], dtype=np.uint64)
+            except (ValueError, KeyError, TypeError) as error:
+                raise requestError(400, "invalid records : %r" % error)
+            current = self.snapshots.current()
+            answers = await asyncio.get_running_loop().run_in_executor(
+                None, current.index.topRows, records, k if "k" in params else None)
+            return {"version": current.version,
+                    "results": [{"rows": rows.tolist(), "distances": total.tolist(),
+                                 "names": [current.index.names[row] for row in rows]} for rows, total in answers]}
+        if method == "POST" and url.path == "/identify":
+            if not body:
+                raise requestError(400, "the audio file is missing")
+            return await self.identify(body, params.get("name", "clip"), k)
+        raise requestError(404, "%s %s does not exist" % (method, url.path))
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Reads one HTTP request per connection and writes its json (or plain text) answer
+        """
+        try:
+            status, answer = 200, None
+            try:
+                method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    raise requestError(413, "uploads are limited to %s bytes" % MAX_BODY)
+                body = await reader.readexactly(length)
+                answer = await self._route(method, target, body)
+            except requestError as error:
+                status, answer = error.status, {"error": str(error)}
+            except (ValueError, asyncio.IncompleteReadError) as error:
+                status, answer = 400, {"error": "malformed request : %r" % error}
+            except Exception as error:
+                status, answer = 500, {"error": repr(error)}
+
+            contentType = "application/json"
+            if isinstance(answer, str):
+                content, contentType = answer.encode("utf-8"), "text/plain; version=0.0.4"
+            else:
+                content = json.dumps(answer).encode("utf-8")
+            writer.write(("HTTP/1.1 %s %s\r\nContent-Type: %s\r\nContent-Length: %s\r\n"
+                          "Connection: close\r\n\r\n" % (status, _REASONS[status], contentType, len(content))
+                          ).encode("latin-1"))
+            writer.write(content)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765, unixPath: str = None) -> asyncio.AbstractServer:
+        """
+        Starts the worker processes, the batching task and the listening server
+
+        Parameters
+        -----------
+        - host, port : address listened on when unixPath is not given
+        - unixPath : path of the Unix socket listened on
+        """
+        self.executor = ProcessPoolExecutor(self.workers)
+        self.queue = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self._runBatches())
+        if self.reloadInterval:
+            self._stopWatch = self.snapshots.watch(self.reloadInterval)
+        if unixPath:
+            if os.path.exists(unixPath):
+                os.unlink(unixPath)
+            return await asyncio.start_unix_server(self._handle, unixPath)
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def stop(self, server: asyncio.AbstractServer):
+        """
+        Stops listening, the batching task and the worker processes
+        """
+        server.close()
+        await server.wait_closed()
+        self._batcher.cancel()
+        if self._stopWatch:
+            self._stopWatch.set()
+        self.executor.shutdown()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765, unixPath: str = None):
+        """
+        Serves until cancelled (e.g. Ctrl+C)
+        """
+        server = await self.start(host, port, unixPath)
+        print("serving %s songs on %s" % (len(self.snapshots.current().index),
+                                          unixPath or "http://%s:%s" % (host, port)))
+        try:
+            await server.serve_forever()
+        finally:
+            await self.stop(server)
+
+
+def _matches(matches: list) -> list:
+    return [{"song": song, "similarity": score} for song, score in matches]
+
+
+class _unixConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix socket
+    """
+    def __init__(self, unixPath: str, timeout: float = None):
+        super(_unixConnection, self).__init__("localhost", timeout=timeout)
+        self.unixPath = unixPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unixPath)
+
+
+def request(method: str, target: str, body: bytes = None, host: str = "127.0.0.1", port: int = 8765,
+            unixPath: str = None, timeout: float = 300) -> tuple:
+    """
+    Local client of searchServer
+
+    :param method: "GET" or "POST"
+    :param target: route and query string, e.g "/identify?k=5&name=clip.mp3"
+    :param body: content of the request
+    :param host: host of the server
+    :param port: port of the server
+    :param unixPath: path of the Unix socket of the server, used instead of host and port
+    :param timeout: seconds waited for the answer
+    :return: http status and the decoded json answer (the text of the plain text routes)
+    """
+    connection = _unixConnection(unixPath, timeout) if unixPath else http.client.HTTPConnection(host, port, timeout)
+    try:
+        connection.request(method, target, body)
+        response = connection.getresponse()
+        content = response.read()
+        if response.getheader("Content-Type", "").startswith("text/plain"):
+            return response.status, content.decode("utf-8")
+        return response.status, json.loads(content)
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    import warnings
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description="Local search server keeping the database index in memory")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="serve on (or query) this Unix socket instead of host:port")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="load the index and serve searches")
+    serve.add_argument("--db", default="Database/db.json", help="json database built by updateDB")
+    serve.add_argument("--backend", choices=["linear", "mih"], default="linear")
+    serve.add_argument("--workers", type=int, default=2, help="processes hashing uploaded clips")
+    serve.add_argument("--max-batch", type=int, default=32, help="largest number of queries searched together")
+    serve.add_argument("--batch-ms", type=float, default=5, help="milliseconds a query waits for its batch")
+    serve.add_argument("--seconds", type=float, default=60, help="seconds hashed from every uploaded clip")
+    serve.add_argument("--reload-interval", type=float, default=10,
+                       help="seconds between two checks for an index updated by updateDB, 0 to only reload on /reload")
+
+    query = commands.add_parser("query", help="identify clips with a running server")
+    query.add_argument("clips", nargs="+", help="audio clips to identify")
+    query.add_argument("--top-k", type=int, default=5, help="matches reported per clip")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = searchServer(args.db, args.backend, args.workers, args.max_batch, args.batch_ms / 1000,
+                              args.seconds * 1000, args.reload_interval or None)
+        try:
+            asyncio.run(server.serve(args.host, args.port, args.unix))
+        except KeyboardInterrupt:
+            pass
+    else:
+        for clip in args.clips:
+            status, answer = request("POST", "/identify?k=%s&name=%s" % (args.top_k, quote(Path(clip).name)),
+                                     Path(clip).read_bytes(), args.host, args.port, args.unix)
+            print(json.dumps(answer))
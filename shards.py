@@ -0,0 +1,313 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import json
+import multiprocessing
+import threading
+import numpy as np
+from hashIndex import RECORD_WORDS, hashIndex, similarity, unpackHash
+from loader import checkFeatureVersion
+
+
+def shardPath(dbPath: str, shard: int, count: int) -> Path:
+    """
+    Binary index of one shard, next to the json database (db.json -> db.shard0-of-4.idx)
+
+    :param dbPath: a string path to the json database
+    :param shard: number of the shard
+    :param count: number of shards
+    :return: path of the shard index
+    """
+    return Path(dbPath).with_suffix(".shard%s-of-%s.idx" % (shard, count))
+
+
+def writeShards(dbPath: str, count: int, index: hashIndex = None) -> list:
+    """
+    Partitions the index of the database into count shards by song id, the song of row r
+    goes to shard r % count at row r // count, so r = shardRow * count + shard
+
+    ============= ==========================================
+    **Arguments**
+    dbPath        A string path to the json database, the shards are saved next to it.
+    count         Number of shards.
+    index         The index of the database, opened from dbPath if not given.
+    ============= ==========================================
+
+    :return: paths of the written shards, the shards of an other count are removed
+    """
+    index = hashIndex.fromPath(dbPath) if index is None else index
+    paths = []
+    for shard in range(count):
+        rows = np.arange(shard, len(index), count)
+        path = shardPath(dbPath, shard, count)
+        hashIndex([index.names[row] for row in rows], index.matrix[rows], index.durations[rows],
+                  index.rates[rows]).save(str(path))
+        paths.append(path)
+    dbPath = Path(dbPath)
+    for stale in dbPath.parent.glob(dbPath.stem + ".shard*-of-*.idx"):
+        if stale not in paths:
+            stale.unlink()
+    with open(dbPath.with_suffix(".shards.json"), "w") as outFile:
+        json.dump({"count": count, "songs": len(index), "shards": [path.name for path in paths],
+                   "index": _indexStamp(dbPath)}, outFile, indent=4)
+    return paths
+
+
+def _indexStamp(dbPath: Path):
+    """
+    Size and modification time of db.idx, the version of the index the shards were cut from
+    """
+    indexPath = Path(dbPath).with_suffix(".idx")
+    if not indexPath.exists():
+        return None
+    stat = indexPath.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def shardCount(dbPath: str):
+    """
+    Number of shards recorded in db.shards.json
+
+    :param dbPath: a string path to the json database
+    :return: the count or None if the database is not sharded
+    """
+    manifest = Path(dbPath).with_suffix(".shards.json")
+    if not manifest.exists():
+        return None
+    with open(manifest) as inFile:
+        return json.load(inFile)["count"]
+
+
+def _serveShard(connection, file: str):
+    """
+    Loop of a local shard process, answers the (queries, k) it receives until it receives None
+    """
+    index = hashIndex.load(file)
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        try:
+            queries, k = message
+            connection.send([(rows, total, [index.names[row] for row in rows])
+                             for rows, total in index.topRows(queries, k)])
+        except Exception as error:
+            connection.send(error)
+    connection.close()
+
+
+class localShard():
+    """
+    Shard served by a process of this machine, over a pipe
+    """
+    def __init__(self, file: str):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - file : a string path to the shard index (see shardPath)
+        """
+        self.name = str(file)
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serveShard, args=(child, str(file)), daemon=True)
+        self.process.start()
+        child.close()
+        self._lock = threading.Lock()  # one query in flight per pipe
+
+    def topRows(self, queries: np.ndarray, k: int = None) -> list:
+        """
+        Shard rows, summed distances and names of the k best songs of every query (see hashIndex.topRows)
+        """
+        with self._lock:
+            self.connection.send((queries, k))
+            answer = self.connection.recv()
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def close(self):
+        with self._lock:
+            self.connection.send(None)
+        self.process.join()
+
+
+class nodeShard():
+    """
+    Shard served by searchServer on a node, e.g python server.py --port 8801 serve --db db.shard0-of-4.idx
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, unixPath: str = None, timeout: float = 60):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - host, port : address of the node
+        - unixPath : path of the Unix socket of a local node, used instead of host and port
+        - timeout : seconds waited for the answer
+        """
+        self.name = unixPath or "%s:%s" % (host, port)
+        self.host, self.port, self.unixPath, self.timeout = host, port, unixPath, timeout
+
+    def topRows(self, queries: np.ndarray, k: int = None) -> list:
+        """
+        Shard rows, summed distances and names of the k best songs of every query (see hashIndex.topRows)
+        """
+        from server import request
+
+        body = json.dumps({"records": [unpackHash(query) for query in queries]}).encode("utf-8")
+        status, answer = request("POST", "/shard" + ("?k=%s" % k if k is not None else ""), body,
+                                 self.host, self.port, self.unixPath, self.timeout)
+        if status != 200:
+            raise RuntimeError("shard %s answered %s : %s" % (self.name, status, answer.get("error")))
+        return [(np.array(result["rows"], dtype=np.intp), np.array(result["distances"], dtype=np.int32),
+                 result["names"]) for result in answer["results"]]
+
+    def close(self):
+        pass
+
+
+class shardedIndex():
+    """
+    Coordinator of a sharded index implements the following :
+
+    - Fans a batch of queries out to every shard at once, each one scans only its songs
+    - Gathers the k best songs of every shard and merges them by distance then global song id,
+      the ranking (ties included) is the one hashIndex.search gives on the whole index
+    - Runs with local processes (local) or with searchServer nodes (nodes) alike
+    """
+    def __init__(self, shards: list, songs: int = None):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - shards : shard i holds the songs of the global rows i, i + len(shards), ... (see writeShards)
+        - songs : number of songs of all the shards, if known
+        """
+        self.shards = shards
+        self.songs = songs
+        self.executor = ThreadPoolExecutor(len(shards))
+
+    def __len__(self):
+        return self.songs or 0
+
+    @classmethod
+    def local(cls, dbPath: str) -> "shardedIndex":
+        """
+        Starts one process per shard written by writeShards (db.shards.json), refusing shards
+        cut from an other version of db.idx or of a database hashed by an older feature pipeline
+
+        Parameters
+        -----------
+        - dbPath : a string path to the json database
+        """
+        checkFeatureVersion(dbPath)
+        with open(Path(dbPath).with_suffix(".shards.json")) as inFile:
+            manifest = json.load(inFile)
+        stamp = _indexStamp(Path(dbPath))
+        if stamp is not None and manifest.get("index") != stamp:
+            raise ValueError("the shards of %s were cut from an older db.idx, rebuild them with "
+                             "python shards.py build --count %s" % (dbPath, manifest["count"]))
+        return cls([localShard(Path(dbPath).parent / file) for file in manifest["shards"]], manifest["songs"])
+
+    @classmethod
+    def nodes(cls, addresses: list) -> "shardedIndex":
+        """
+        Queries searchServer nodes, given in the order of their shards
+
+        Parameters
+        -----------
+        - addresses : "host:port" or Unix socket path of every node
+        """
+        shards = []
+        for address in addresses:
+            host, _, port = address.rpartition(":")
+            shards.append(nodeShard(host, int(port)) if port.isdigit() else nodeShard(unixPath=address))
+        return cls(shards)
+
+    def searchBatch(self, queries: np.ndarray, k: int = None) -> list:
+        """
+        Finds the k songs closest to every query across all the shards
+
+        Parameters
+        -----------
+        - queries : packed records (see hashIndex.packRecord) of shape (n, RECORD_WORDS)
+        - k : number of results per query, all songs if not given
+
+        Returns
+        -----------
+        - a list of the search() results of every query
+        """
+        queries = np.asarray(queries, dtype=np.uint64).reshape(-1, RECORD_WORDS)
+        futures = [self.executor.submit(shard.topRows, queries, k) for shard in self.shards]
+        answers = []
+        for shard, future in zip(self.shards, futures):
+            try:
+                answers.append(future.result())
+            except Exception as error:
+                raise RuntimeError("shard %s failed : %r" % (shard.name, error))
+
+        results = []
+        count = len(self.shards)
+        for i in range(len(queries)):
+            ids = np.concatenate([answer[i][0] * count + shard for shard, answer in enumerate(answers)])
+            totals = np.concatenate([answer[i][1] for answer in answers])
+            names = [name for answer in answers for name in answer[i][2]]
+            best = np.lexsort((ids, totals))[:k]
+            results.append([(names[j], float(score)) for j, score in zip(best, similarity(totals[best]))])
+        return results
+
+    def search(self, query: np.ndarray, k: int = None) -> list:
+        """
+        Finds the k songs closest to the query across all the shards, like hashIndex.search
+        """
+        return self.searchBatch(query, k)[0]
+
+    def close(self):
+        """
+        Stops the local shard processes
+        """
+        for shard in self.shards:
+            shard.close()
+        self.executor.shutdown()
+
+
+if __name__ == '__main__':
+    import argparse
+    import warnings
+    from identify import hashClip
+    from hashIndex import packRecord
+    from loader import readFrontEnd
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description="Build the shards of the database index or identify clips on them")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="partition db.idx into shards")
+    build.add_argument("--db", default="Database/db.json", help="json database built by updateDB")
+    build.add_argument("--count", type=int, required=True, help="number of shards")
+    query = commands.add_parser("query", help="identify clips on the shards, printing one JSON result per line")
+    query.add_argument("clips", nargs="+", help="audio clips to identify")
+    query.add_argument("--db", default="Database/db.json", help="json database whose shards are served locally")
+    query.add_argument("--nodes", nargs="+", help="host:port (or Unix socket) of the node of every shard, in order")
+    query.add_argument("--top-k", type=int, default=5, help="matches reported per clip")
+    query.add_argument("--check", action="store_true", help="compare with the ranking of the whole index")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        for path in writeShards(args.db, args.count):
+            print(path)
+    else:
+        sharded = shardedIndex.nodes(args.nodes) if args.nodes else shardedIndex.local(args.db)
+        rate = readFrontEnd(args.db)  # clips are hashed through the front end of the database
+        try:
+            for clip in args.clips:
+                result = hashClip(clip, targetRate=rate)
+                record = packRecord(result["spectrohash"], result["features"])
+                matches = sharded.search(record, args.top_k)
+                answer = {"clip": clip, "matches": [{"song": song, "similarity": score} for song, score in matches]}
+                if args.check:
+                    answer["same_as_whole_index"] = matches == hashIndex.fromPath(args.db).search(record, args.top_k)
+                print(json.dumps(answer))
+        finally:
+            sharded.close()
@@ -0,0 +1,123 @@
+from pathlib import Path
+import threading
+import time
+import weakref
+from hashIndex import hashIndex
+
+
+class snapshot():
+    """
+    One loaded version of the index, immutable once published
+
+    - version : number of the version, increasing with every swap
+    - index : the hashIndex of the version
+    - searcher : object answering the searches (the index itself or a mihIndex over it)
+    - stamp : modification time of the index file the version was loaded from
+    """
+    def __init__(self, version: int, index: hashIndex, searcher=None, stamp: float = None):
+        self.version = version
+        self.index = index
+        self.searcher = index if searcher is None else searcher
+        self.stamp = stamp
+        self.loadedAt = time.time()
+
+
+class snapshotHolder():
+    """
+    Serves searches from the current snapshot of the index implements the following :
+
+    - Readers take current() once per query and keep using it, taking it never blocks
+    - A new version is loaded aside and published by replacing a single reference, queries
+      already running finish on the version they took
+    - A replaced version is released (its memory mapped file unmapped) as soon as the last
+      query holding it drops it, the released versions are reported in self.released
+    """
+    def __init__(self, dbPath: str, makeSearcher=None):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - dbPath : a string path to the json database, its binary index db.idx is the one served
+        - makeSearcher : function building the searcher of an index (e.g mihIndex), the index itself if not given
+        """
+        self.dbPath = Path(dbPath)
+        self.indexPath = self.dbPath.with_suffix(".idx")
+        self.makeSearcher = makeSearcher
+        self.released = []  # versions no longer referenced by any query
+        self._reloading = threading.Lock()  # only taken by writers, two reloads never build at once
+        self._current = None
+        self.reload(force=True)
+
+    def current(self) -> snapshot:
+        """
+        The snapshot to run a query on, keep it for the whole query
+        """
+        return self._current
+
+    def _stamp(self) -> float:
+        return self.indexPath.stat().st_mtime if self.indexPath.exists() else None
+
+    def swap(self, index: hashIndex, stamp: float = None) -> snapshot:
+        """
+        Publishes an already loaded index as the new current version
+
+        Parameters
+        -----------
+        - index : the new index
+        - stamp : modification time of its file, if loaded from one
+
+        Returns
+        -----------
+        - the published snapshot
+        """
+        old = self._current
+        searcher = self.makeSearcher(index) if self.makeSearcher else None
+        new = snapshot(old.version + 1 if old else 1, index, searcher, stamp)
+        self._current = new  # a single reference assignment, atomic for the readers
+        weakref.finalize(index, self.released.append, new.version)
+        return new
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Loads db.idx again if it changed since the current version (written by updateDB)
+
+        Parameters
+        -----------
+        - force : load it even if it did not change
+
+        Returns
+        -----------
+        - True if a new version was published
+        """
+        with self._reloading:
+            stamp = self._stamp()  # taken before loading, a db.idx replaced meanwhile is loaded at the next check
+            if not force and self._current is not None and stamp == self._current.stamp:
+                return False
+            index = hashIndex.fromPath(str(self.dbPath))
+            self.swap(index, stamp)
+            return True
+
+    def watch(self, interval: float = 5.0) -> threading.Event:
+        """
+        Reloads the index in a background thread whenever updateDB writes a new version
+
+        Parameters
+        -----------
+        - interval : seconds between two checks
+
+        Returns
+        -----------
+        - an event stopping the thread when set
+        """
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.reload()
+                except (OSError, ValueError):
+                    pass  # written meanwhile, tried again at the next check
+
+        threading.Thread(target=run, daemon=True).start()
+        return stop
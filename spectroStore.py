@@ -0,0 +1,181 @@
+from pathlib import Path
+import json
+import zipfile
+import numpy as np
+
+STORE_VERSION = 1  # layout version of a saved spectrogram folder
+CHUNK_FRAMES = 4096  # frames per chunk of a compressed store, the unit a time range is decompressed by
+STORAGES = ("npy", "npz")  # memory mapped frames or deflated chunks of frames
+DTYPES = ("float32", "float16")
+
+
+def storePath(folder: str, fileName: str) -> Path:
+    """
+    Folder of a saved spectrogram, e.g folder/name.spec
+
+    :param folder: a path to the file location
+    :param fileName: the file name
+    :return: path of the store
+    """
+    return Path(folder + fileName + ".spec")
+
+
+def saveSpectrogram(path: str, freqs: np.ndarray, times: np.ndarray, mesh: np.ndarray, features: dict = None,
+                    storage: str = "npy", dtype: str = "float32", chunkFrames: int = CHUNK_FRAMES) -> Path:
+    """
+    Saves a spectrogram in a folder of binary arrays, frame after frame so any time range is read alone
+
+    ============= ==========================================
+    **Arguments**
+    path          A string path to the store folder (see storePath), replaced if it exists.
+    freqs         Sample frequencies of the spectrogram.
+    times         Time of every frame in seconds.
+    mesh          The color mesh, one column per frame (see spectrogram._spectrogram).
+    features      Name -> feature with one column per frame (mel, mfcc, chroma ..), saved in float32 in features.npz.
+    storage       "npy" one frames x bins array memory mapped by the loader, "npz" deflated chunks of
+                  chunkFrames frames, smaller but decompressed chunk by chunk.
+    dtype         "float32" or "float16", a float16 mesh is scaled by a power of two to fit its range.
+    chunkFrames   Frames per chunk of a npz store.
+    ============= ==========================================
+
+    :return: path of the store
+    """
+    if storage not in STORAGES:
+        raise ValueError("unknown storage %r, expected one of %s" % (storage, STORAGES))
+    if dtype not in DTYPES:
+        raise ValueError("unknown dtype %r, expected one of %s" % (dtype, DTYPES))
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    for old in path.iterdir():
+        old.unlink()
+
+    scale = 1.0
+    peak = float(np.max(mesh)) if mesh.size else 0.0
+    if dtype == "float16" and peak > 0:
+        # exact power of two, float16 rounding stays the only error and the loader undoes it exactly
+        scale = float(2.0 ** np.ceil(np.log2(peak / float(np.finfo(np.float16).max))))
+    np.save(path / "freqs.npy", np.asarray(freqs))
+    np.save(path / "times.npy", np.asarray(times))
+
+    frames = len(times)
+    if storage == "npy":
+        stored = np.lib.format.open_memmap(path / "mesh.npy", "w+", dtype, (frames, mesh.shape[0]))
+        for first in range(0, frames, chunkFrames):
+            stored[first:first + chunkFrames] = (mesh[:, first:first + chunkFrames] / scale).T
+        stored.flush()
+        del stored
+    else:
+        with zipfile.ZipFile(path / "mesh.npz", "w", zipfile.ZIP_DEFLATED) as archive:
+            for chunk, first in enumerate(range(0, frames, chunkFrames)):
+                with archive.open("%05d.npy" % chunk, "w", force_zip64=True) as member:
+                    np.lib.format.write_array(member, np.ascontiguousarray(
+                        (mesh[:, first:first + chunkFrames] / scale).T.astype(dtype)))
+
+    if features:
+        np.savez(path / "features.npz", **{name: np.asarray(feature, dtype=np.float32)
+                                           for name, feature in features.items()})
+    with open(path / "meta.json", "w") as outFile:
+        json.dump({"version": STORE_VERSION, "storage": storage, "dtype": dtype, "scale": scale,
+                   "frames": frames, "bins": int(mesh.shape[0]), "chunk_frames": chunkFrames,
+                   "features": list(features or ())}, outFile, indent=4)
+    return path
+
+
+class storedSpectrogram():
+    """
+    Lazy reader of a spectrogram saved with saveSpectrogram implements the following :
+
+    - Opens only the small arrays (frequencies, frame times) and the layout up front
+    - Reads a time range of the mesh without loading the rest, through a memory map ("npy")
+      or by decompressing only the chunks the range overlaps ("npz")
+    - Returns float32 frames in the layout of spectrogram._spectrogram (one column per frame)
+    """
+    def __init__(self, path: str):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - path : a string path to the store folder (see storePath)
+        """
+        self.path = Path(path)
+        with open(self.path / "meta.json") as inFile:
+            self.meta = json.load(inFile)
+        if self.meta["version"] != STORE_VERSION:
+            raise ValueError("%s has layout version %s, expected %s" % (path, self.meta["version"], STORE_VERSION))
+        self.freqs = np.load(self.path / "freqs.npy")
+        self.times = np.load(self.path / "times.npy")
+        self.scale = self.meta["scale"]
+        self._mesh = None  # memory map of a npy store
+        self._archive = None  # open npz store
+
+    def __len__(self):
+        return self.meta["frames"]
+
+    @property
+    def duration(self) -> float:
+        """
+        Time of the last frame in seconds
+        """
+        return float(self.times[-1]) if len(self.times) else 0.0
+
+    def frameRange(self, start: float = 0, stop: float = None) -> tuple:
+        """
+        First and past the last frame whose time is within [start, stop) seconds
+        """
+        first = int(np.searchsorted(self.times, start, side="left"))
+        last = len(self.times) if stop is None else int(np.searchsorted(self.times, stop, side="left"))
+        return first, max(first, last)
+
+    def frames(self, first: int, last: int) -> np.ndarray:
+        """
+        Mesh of the frames first to last - 1, as float32 with one column per frame
+        """
+        if self.meta["storage"] == "npy":
+            if self._mesh is None:
+                self._mesh = np.load(self.path / "mesh.npy", mmap_mode="r")
+            rows = self._mesh[first:last]
+        else:
+            if self._archive is None:
+                self._archive = np.load(self.path / "mesh.npz")
+            size = self.meta["chunk_frames"]
+            chunks = range(first // size, (last - 1) // size + 1) if last > first else ()
+            rows = np.concatenate([self._archive["%05d" % chunk] for chunk in chunks]
+                                  or [np.empty((0, self.meta["bins"]), dtype=self.meta["dtype"])])
+            rows = rows[first - chunks[0] * size:last - chunks[0] * size] if chunks else rows
+        mesh = rows.T.astype(np.float32)
+        if self.scale != 1:
+            mesh *= self.scale
+        return mesh
+
+    def read(self, start: float = 0, stop: float = None) -> tuple:
+        """
+        Reads the frames of a time range
+
+        Parameters
+        -----------
+        - start : seconds from the start of the song
+        - stop : seconds from the start of the song, the end if not given
+
+        Returns
+        -----------
+        - the frequencies, the times of the frames read and their mesh, like spectrogram._spectrogram
+        """
+        first, last = self.frameRange(start, stop)
+        return self.freqs, self.times[first:last], self.frames(first, last)
+
+    def features(self, start: float = 0, stop: float = None) -> dict:
+        """
+        Saved features (name -> feature) restricted to the frames of a time range
+        """
+        first, last = self.frameRange(start, stop)
+        with np.load(self.path / "features.npz") as saved:
+            return {name: saved[name][:, first:last].astype(np.float32) for name in self.meta["features"]}
+
+    def close(self):
+        """
+        Releases the memory map or the archive
+        """
+        if self._archive is not None:
+            self._archive.close()
+        self._mesh, self._archive = None, None
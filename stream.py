@@ -0,0 +1,340 @@
+from pathlib import Path
+import struct
+import time
+import numpy as np
+from scipy import signal
+from Spectrogram import SEGMENT_LENGTH, SEGMENT_STEP, spectrogram
+from phash import phash
+from hashIndex import RECORD_WORDS
+from segments import WINDOW_SECONDS
+from metrics import timer
+from loader import downmix, streamResampler
+
+_WAV_FORMATS = {(1, 16): "int16", (3, 32): "float32"}  # (format tag, bits per sample) -> dtype
+
+
+class spectrogramStream():
+    """
+    Incremental spectrogram._spectrogram of an endless stream of samples implements the following :
+
+    - Computes only the frames completed by every new chunk, a frame of signal.spectrogram only
+      depends on its own samples so they are equal to the frames of the whole stream at once
+    - Keeps the last keepSeconds of frames in a ring buffer and less than two frames of samples,
+      the memory does not grow with the length of the stream
+    """
+    def __init__(self, songSR: int, channels: int = 1, windowType: str = "hann", keepSeconds: float = 30):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - songSR : sample rate of the stream
+        - channels : number of channels interleaved in the stream, hashed interleaved like updateDB does
+        - windowType : window used in creating the spectrogram
+        - keepSeconds : seconds of frames kept
+        """
+        self.songSR = songSR
+        self.channels = channels
+        self.windowType = windowType
+        self.pending = np.empty(0, dtype=np.int16)  # samples of the frames not computed yet, in the stream dtype
+        self.capacity = int(keepSeconds * songSR * channels / SEGMENT_STEP) + 1
+        self.frames = None  # ring buffer of the frames, in the precision signal.spectrogram gives the stream dtype
+        self.frameCount = 0  # frames computed since the start of the stream
+
+    @property
+    def seconds(self) -> float:
+        """
+        Seconds of the stream covered by the computed frames
+        """
+        return self.frameCount * SEGMENT_STEP / (self.songSR * self.channels)
+
+    def push(self, samples: np.ndarray) -> int:
+        """
+        Adds a chunk of samples and computes the frames it completes
+
+        Parameters
+        -----------
+        - samples : interleaved samples following the previous chunk
+
+        Returns
+        -----------
+        - the number of new frames
+        """
+        # the samples keep their dtype, signal.spectrogram computes int16 in single precision like for a file
+        samples = np.concatenate([self.pending, samples])
+        count = (len(samples) - SEGMENT_LENGTH) // SEGMENT_STEP + 1 if len(samples) >= SEGMENT_LENGTH else 0
+        if count == 0:
+            self.pending = samples
+            return 0
+        _, _, frames = signal.spectrogram(samples[:(count - 1) * SEGMENT_STEP + SEGMENT_LENGTH], fs=self.songSR,
+                                          window=self.windowType)
+        if self.frames is None:
+            self.frames = np.zeros((len(frames), self.capacity), dtype=frames.dtype)
+        frames = frames[:, -self.capacity:]
+        self.frames[:, (self.frameCount + count - len(frames.T) + np.arange(len(frames.T))) % self.capacity] = frames
+        self.frameCount += count
+        self.pending = samples[count * SEGMENT_STEP:]
+        return count
+
+    def mesh(self, seconds: float) -> tuple:
+        """
+        Spectrogram of the last seconds of the stream, as spectrogram._spectrogram computes it
+        for those samples alone
+
+        Parameters
+        -----------
+        - seconds : length of the returned window, at most keepSeconds
+
+        Returns
+        -----------
+        - the time of every frame from the start of the window, the frames and the start of the
+          window in seconds from the start of the stream
+        """
+        count = min(int(seconds * self.songSR * self.channels / SEGMENT_STEP), self.frameCount, self.capacity)
+        first = self.frameCount - count
+        if self.frames is None:
+            return np.empty(0), np.empty((SEGMENT_LENGTH // 2 + 1, 0)), 0.0
+        mesh = self.frames[:, np.arange(first, self.frameCount) % self.capacity]
+        times = (np.arange(count) * SEGMENT_STEP + SEGMENT_LENGTH / 2) / self.songSR / self.channels
+        return times, mesh, first * SEGMENT_STEP / (self.songSR * self.channels)
+
+
+class streamRecognizer():
+    """
+    Continuous recognition of a live stream implements the following :
+
+    - Feeds the samples to a spectrogramStream as they arrive
+    - Every `every` seconds of stream, matches the last `span` seconds against the window index
+      (segments.segmentIndex, with the offset in the song) or the clip hashes (hashIndex)
+    - Downmixes and resamples the stream chunk by chunk to the canonical rate of the database if it has one
+    - The latency of a report is bounded by `every` plus the time of one match on `span` seconds
+    """
+    def __init__(self, index, songSR: int, channels: int = 1, span: float = 10, every: float = 2, k: int = 5,
+                 windowType: str = "hann", targetRate: int = None):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - index : a segmentIndex or a hashIndex
+        - songSR : sample rate of the stream
+        - channels : number of channels interleaved in the stream
+        - span : seconds of stream matched by every report
+        - every : seconds of stream between two reports
+        - k : number of matches per report
+        - windowType : window used in creating the spectrogram
+        - targetRate : canonical sample rate of the database (see loader.readFrontEnd), None for legacy hashes
+        """
+        self.index = index
+        self.channels = channels
+        self.resampler = streamResampler(songSR, targetRate) if targetRate else None
+        self.partial = np.empty(0, dtype=np.int16)  # samples of a frame cut between two chunks, front end only
+        if targetRate:
+            songSR, channels = targetRate, 1
+        self.spectrum = spectrogramStream(songSR, channels, windowType, keepSeconds=span)
+        self.span = span
+        self.every = every
+        self.k = k
+        self.minimum = getattr(index, "window", WINDOW_SECONDS)  # shortest span matched
+        self.nextReport = max(every, self.minimum)
+
+    def feed(self, samples: np.ndarray) -> list:
+        """
+        Adds a chunk of the stream
+
+        Parameters
+        -----------
+        - samples : interleaved samples following the previous chunk
+
+        Returns
+        -----------
+        - the report due with this chunk if any, in a list
+        """
+        if self.resampler is not None:
+            samples = np.concatenate([self.partial, samples])
+            usable = len(samples) - len(samples) % self.channels
+            self.partial = samples[usable:]
+            samples = self.resampler.push(downmix(samples[:usable], self.channels))
+        self.spectrum.push(samples)
+        if self.spectrum.seconds < self.nextReport:
+            return []
+        report = self.report()
+        # a stream read faster than it is matched skips the late reports instead of queuing them
+        self.nextReport = max(self.nextReport + self.every, self.spectrum.seconds)
+        return [report]
+
+    def report(self) -> dict:
+        """
+        Matches the last span seconds of the stream
+
+        Returns
+        -----------
+        - dictionary of the stream time, the start of the matched span, the matches and the
+          milliseconds spent matching
+        """
+        start = time.perf_counter()
+        with timer("streamReport"):
+            times, mesh, spanStart = self.spectrum.mesh(self.span)
+            songSR = self.spectrum.songSR
+            if hasattr(self.index, "queryMesh"):
+                matches = [{"song": song, "similarity": score, "offset": offset}
+                           for song, score, offset in self.index.queryMesh(mesh, times, songSR, self.k)]
+            else:
+                record = phash((mesh,) + spectrogram().meshFeatures(mesh, songSR)).reshape(RECORD_WORDS)
+                matches = [{"song": song, "similarity": score} for song, score in self.index.search(record, self.k)]
+        return {"time": self.spectrum.seconds, "span_start": spanStart, "matches": matches,
+                "compute_ms": (time.perf_counter() - start) * 1000}
+
+
+def rawChunks(inFile, dtype: str = "int16", chunkSamples: int = 1 << 14):
+    """
+    Reads raw interleaved PCM from a binary file object (stdin, a pipe ..) until its end
+
+    :param inFile: binary file object
+    :param dtype: "int16" or "float32" samples, float32 ones in [-1, 1] are scaled to the int16 amplitude
+                  the database was hashed at
+    :param chunkSamples: samples read at a time
+    :return: generator of sample arrays
+    """
+    itemSize = np.dtype(dtype).itemsize
+    rest = b""
+    while True:
+        data = inFile.read(chunkSamples * itemSize)
+        if not data:
+            return
+        data = rest + data
+        usable = len(data) - len(data) % itemSize  # a pipe can cut a sample in two
+        rest = data[usable:]
+        if usable:
+            samples = np.frombuffer(data[:usable], dtype=dtype)
+            yield samples * np.float32(32768) if samples.dtype == np.float32 else samples
+
+
+def _wavLayout(inFile) -> tuple:
+    """
+    Parses the header of a WAV file, its data chunk may still be growing
+
+    :return: sample rate, number of channels, dtype and byte offset of the samples
+    """
+    riff, _, wave = struct.unpack("<4sI4s", inFile.read(12))
+    if riff != b"RIFF" or wave != b"WAVE":
+        raise ValueError("not a WAV file")
+    layout = None
+    while True:
+        header = inFile.read(8)
+        if len(header) < 8:
+            raise ValueError("the WAV file has no data chunk yet")
+        chunk, size = struct.unpack("<4sI", header)
+        if chunk == b"fmt ":
+            formatTag, channels, rate, _, _, bits = struct.unpack("<HHIIHH", inFile.read(16))
+            inFile.seek(size - 16 + size % 2, 1)
+            if (formatTag, bits) not in _WAV_FORMATS:
+                raise ValueError("only 16 bit PCM and 32 bit float WAV files are streamed")
+            layout = rate, channels, _WAV_FORMATS[formatTag, bits]
+        elif chunk == b"data":
+            if layout is None:
+                raise ValueError("the WAV file has no fmt chunk")
+            return layout + (inFile.tell(),)
+        else:
+            inFile.seek(size + size % 2, 1)
+
+
+def followWav(path: str, chunkSamples: int = 1 << 14, poll: float = 0.2, idle: float = 5.0):
+    """
+    Reads a WAV file while it is being written, like tail -f
+
+    :param path: path of the WAV file
+    :param chunkSamples: samples read at a time
+    :param poll: seconds waited before reading again once the end is reached
+    :param idle: seconds without new samples after which the stream is over
+    :return: sample rate, number of channels and a generator of sample arrays
+    """
+    inFile = open(path, "rb")
+    rate, channels, dtype, _ = _wavLayout(inFile)
+
+    def chunks():
+        with inFile:
+            waited = 0.0
+            while waited < idle:
+                found = False
+                for samples in rawChunks(inFile, dtype, chunkSamples):
+                    found = True
+                    yield samples
+                if found:
+                    waited = 0.0
+                else:
+                    time.sleep(poll)
+                    waited += poll
+    return rate, channels, chunks()
+
+
+def paced(chunks, songSR: int, channels: int = 1, speed: float = 1.0):
+    """
+    Yields the chunks no faster than speed times real time, to replay a file like a live stream
+
+    :param chunks: iterable of sample arrays
+    :param songSR: sample rate of the samples
+    :param channels: number of channels interleaved in the samples
+    :param speed: 1 for real time, 2 for twice as fast, 0 for as fast as possible
+    """
+    start, played = time.perf_counter(), 0.0
+    for samples in chunks:
+        if speed:
+            wait = start + played / speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        played += len(samples) / (songSR * channels)
+        yield samples
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import sys
+    import warnings
+    import loader
+    from hashIndex import hashIndex
+    from segments import segmentIndex
+
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description="Recognize a live stream continuously, printing one JSON report "
+                                                 "per line, e.g ffmpeg -i feed -f s16le - | python stream.py - "
+                                                 "--rate 44100 --channels 2")
+    parser.add_argument("source", help="- for raw PCM on stdin, or an audio file (a WAV being written with --follow)")
+    parser.add_argument("--db", default="Database/db.json", help="json database built by updateDB")
+    parser.add_argument("--engine", choices=["segments", "phash"], default="segments",
+                        help="window index (updateDB --segments) or clip hashes of the database")
+    parser.add_argument("--rate", type=int, default=44100, help="sample rate of raw PCM")
+    parser.add_argument("--channels", type=int, default=1, help="channels interleaved in raw PCM")
+    parser.add_argument("--format", choices=["int16", "float32"], default="int16", help="samples of raw PCM")
+    parser.add_argument("--follow", action="store_true", help="read a WAV file while it is being written")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="replay a file at this multiple of real time, 0 for as fast as possible")
+    parser.add_argument("--span", type=float, default=10, help="seconds of stream matched by every report")
+    parser.add_argument("--every", type=float, default=2, help="seconds of stream between two reports")
+    parser.add_argument("--top-k", type=int, default=3, help="matches per report")
+    args = parser.parse_args()
+
+    if args.engine == "segments":
+        index = segmentIndex.load(str(Path(args.db).parent / "segments.npz"))
+    else:
+        index = hashIndex.fromPath(args.db)
+
+    if args.source == "-":
+        rate, channels, chunks = args.rate, args.channels, rawChunks(sys.stdin.buffer, args.format)
+    elif args.follow:
+        rate, channels, chunks = followWav(args.source)
+    else:
+        rate, channels = loader.audioInfo(args.source)
+        chunks = paced(loader.streamAudio(args.source, chunkFrames=1 << 13), rate, channels, args.speed)
+
+    recognizer = streamRecognizer(index, rate, channels, args.span, args.every, args.top_k,
+                                  targetRate=loader.readFrontEnd(args.db))
+    try:
+        for samples in chunks:
+            for report in recognizer.feed(samples):
+                sys.stdout.write(json.dumps(report) + "\n")
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,54 @@
+import sys
+import warnings
+from pathlib import Path
+import numpy as np
+import pytest
+
+# the modules of the repository are flat files at its root
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+warnings.filterwarnings("ignore")
+
+from hashIndex import RECORD_WORDS, hashIndex, unpackHash  # noqa: E402
+
+
+def randomRecords(count: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Random packed records (see hashIndex.packRecord)
+    """
+    return rng.integers(0, 2**64, size=(count, RECORD_WORDS), dtype=np.uint64)
+
+
+def flipBits(record: np.ndarray, bits: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Copy of a record with `bits` random bits flipped
+    """
+    flipped = np.unpackbits(record.view(np.uint8))
+    positions = rng.choice(len(flipped), bits, replace=False)
+    flipped[positions] ^= 1
+    return np.packbits(flipped).view(np.uint64)
+
+
+@pytest.fixture
+def catalogue():
+    """
+    A hashIndex of 500 random songs, every tenth song duplicated under another name so there are ties
+    """
+    rng = np.random.default_rng(0)
+    matrix = randomRecords(500, rng)
+    matrix[1::10] = matrix[::10]
+    names = ["song_%03d" % row for row in range(len(matrix))]
+    return hashIndex(names, matrix, np.full(len(matrix), 60.0), np.full(len(matrix), 22050))
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(1)
+
+
+def hexRecord(record: np.ndarray) -> tuple:
+    """
+    The spectrogram hash and the feature hashes of a packed record, as db.json stores them
+    """
+    words = len(record) // 4
+    hashes = [unpackHash(record[i * words:(i + 1) * words]) for i in range(4)]
+    return hashes[0], hashes[1:]
@@ -0,0 +1,95 @@
+import json
+import numpy as np
+import pytest
+from conftest import flipBits, hexRecord, randomRecords
+from helpers import getHammingDistance
+from hashIndex import bestPositions, hashIndex, packRecord, similarity
+from mihIndex import mihIndex
+
+
+def legacySearch(records: dict, query: tuple) -> list:
+    """
+    The comparison of db.json before the packed index, per song and per hex hash
+    """
+    spectroHash, featureHashes = query
+    scores = []
+    for name, (songHash, songFeatures) in records.items():
+        total = getHammingDistance(spectroHash, songHash) + sum(
+            getHammingDistance(feature, songFeature) for feature, songFeature in zip(featureHashes, songFeatures))
+        scores.append((name, float(similarity(total))))
+    return sorted(scores, key=lambda score: -score[1])
+
+
+def test_packRecordRoundTrip(catalogue):
+    for record in catalogue.matrix[:20]:
+        assert np.array_equal(packRecord(*hexRecord(record)), record)
+
+
+def test_searchMatchesHexComparison(catalogue, rng):
+    records = {name: hexRecord(record) for name, record in zip(catalogue.names, catalogue.matrix)}
+    for row in (0, 7, 42):
+        query = flipBits(catalogue.matrix[row], 30, rng)
+        assert catalogue.search(query) == legacySearch(records, hexRecord(query))
+
+
+def test_searchBatchMatchesSearch(catalogue, rng):
+    queries = np.stack([flipBits(catalogue.matrix[row], 50, rng) for row in range(0, 100, 9)])
+    for k in (1, 10, None):
+        assert catalogue.searchBatch(queries, k, blockRows=64) == [catalogue.search(query, k) for query in queries]
+
+
+def test_bestPositionsTiesAndEdges():
+    rows = np.arange(6)
+    total = np.array([5, 3, 3, 8, 3, 1])
+    assert bestPositions(rows, total, 3).tolist() == [5, 1, 2]
+    assert bestPositions(rows, total).tolist() == [5, 1, 2, 4, 0, 3]
+    assert bestPositions(rows, total, 0).tolist() == []
+    assert bestPositions(rows, total, 100).tolist() == [5, 1, 2, 4, 0, 3]
+
+
+def test_saveLoadAndJson(catalogue, tmp_path, rng):
+    catalogue.save(str(tmp_path / "db.idx"))
+    loaded = hashIndex.load(str(tmp_path / "db.idx"))
+    assert list(loaded.names) == list(catalogue.names)
+    assert np.array_equal(loaded.matrix, catalogue.matrix)
+
+    database = {name: {"spectrohash": spectroHash, "features": features, "duration": 60.0, "rate": 22050}
+                for name, (spectroHash, features) in
+                ((name, hexRecord(record)) for name, record in zip(catalogue.names, catalogue.matrix))}
+    (tmp_path / "db.json").write_text(json.dumps(database))
+    converted = hashIndex.fromJson(str(tmp_path / "db.json"))
+    query = flipBits(catalogue.matrix[3], 40, rng)
+    assert converted.search(query, 10) == loaded.search(query, 10) == catalogue.search(query, 10)
+
+
+def test_updatedMatchesRebuild(catalogue, rng):
+    changed = {"song_004": hexRecord(randomRecords(1, rng)[0]), "new_song": hexRecord(randomRecords(1, rng)[0])}
+    records = {name: {"spectrohash": spectroHash, "features": features, "duration": 1.0, "rate": 8000}
+               for name, (spectroHash, features) in changed.items()}
+    keep = set(catalogue.names) - {"song_009"} | {"new_song"}
+    updated = catalogue.updated(records, keep)
+
+    expected = {name: record for name, record in zip(catalogue.names, catalogue.matrix) if name in keep}
+    expected.update((name, packRecord(*hashes)) for name, hashes in changed.items())
+    assert sorted(updated.names) == sorted(expected)
+    for name, record in zip(updated.names, updated.matrix):
+        assert np.array_equal(record, expected[name])
+
+
+@pytest.mark.parametrize("substrings", [32, 64, 128])
+def test_mihMatchesLinearScan(catalogue, rng, substrings):
+    mih = mihIndex(catalogue, substrings)
+    queries = [flipBits(catalogue.matrix[row], bits, rng) for row, bits in ((0, 0), (10, 5), (25, 40), (77, 120))]
+    queries.append(randomRecords(1, rng)[0])  # far from every song, answered by the linear scan fallback
+    for query in queries:
+        for k in (1, 2, 10):
+            assert mih.search(query, k) == catalogue.search(query, k)
+
+
+def test_mihRadiusSearch(catalogue, rng):
+    mih = mihIndex(catalogue)
+    query = flipBits(catalogue.matrix[30], 20, rng)
+    linear = catalogue.search(query)
+    for radius in (0, 20, 64, 200):
+        within = [(name, score) for name, score in linear if score >= float(similarity(radius))]
+        assert mih.radiusSearch(query, radius) == within
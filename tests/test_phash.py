@@ -0,0 +1,43 @@
+import imagehash
+import numpy as np
+import pytest
+from PIL import Image
+from benchmark import KINDS, synthesizeTrack
+from helpers import createPerceptualHash
+from phash import phash, toHex
+from Spectrogram import spectrogram
+
+
+def reference(matrix: np.ndarray) -> str:
+    return str(imagehash.phash(Image.fromarray(np.asarray(matrix)), hash_size=16, highfreq_factor=4))
+
+
+@pytest.fixture(scope="module")
+def trackMatrices():
+    """
+    The spectrogram and the three features of a few seconds of every synthesized kind of track
+    """
+    rng = np.random.default_rng(0)
+    matrices = []
+    for kind in KINDS:
+        mesh, features = spectrogram().analyze(synthesizeTrack(kind, 4, 22050, rng), 22050)
+        matrices += [mesh] + list(features)
+    return matrices
+
+
+def test_phashMatchesImagehashOnFeatures(trackMatrices):
+    assert [toHex(words) for words in phash(trackMatrices)] == [reference(matrix) for matrix in trackMatrices]
+
+
+@pytest.mark.parametrize("shape", [(129, 450), (20, 37), (12, 5), (300, 16), (16, 16)])
+def test_phashMatchesImagehashOnShapes(shape):
+    rng = np.random.default_rng(shape[0] * shape[1])
+    # float32 values across the range a power spectrum spans, negative ones (mfcc) included
+    matrices = (rng.standard_normal((4,) + shape) * 10.0 ** rng.integers(-3, 6, (4, 1, 1))).astype(np.float32)
+    assert [toHex(words) for words in phash(matrices)] == [reference(matrix) for matrix in matrices]
+
+
+def test_stackListAndSingleAgree(trackMatrices):
+    stack = np.stack([matrix for matrix in trackMatrices if matrix.shape == trackMatrices[0].shape])
+    assert np.array_equal(phash(stack), phash(list(stack)))
+    assert [createPerceptualHash(matrix) for matrix in stack] == [toHex(words) for words in phash(stack)]
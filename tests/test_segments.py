@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from benchmark import synthesizeTrack
+from segments import segmentHashes, segmentIndex
+
+RATE = 22050
+
+
+@pytest.fixture(scope="module")
+def songs():
+    rng = np.random.default_rng(3)
+    return {"%s_%d" % (kind, i): synthesizeTrack(kind, 12, RATE, rng)
+            for i, kind in enumerate(("tone", "noise", "chirp", "mixed", "tone", "chirp"))}
+
+
+@pytest.fixture(scope="module")
+def index(songs, tmp_path_factory):
+    folder = tmp_path_factory.mktemp("segments")
+    for name, data in songs.items():
+        np.save(folder / (name + ".npy"), segmentHashes(data, RATE))
+    index = segmentIndex.fromFolder(str(folder))
+    index.save(str(folder / "segments.npz"))
+    return segmentIndex.load(str(folder / "segments.npz"))
+
+
+@pytest.mark.parametrize("song, start", [("noise_1", 4), ("chirp_2", 2.5), ("mixed_3", 6.25), ("tone_4", 0)])
+def test_shortClipIsFoundAtItsOffset(songs, index, song, start):
+    clip = songs[song][int(start * RATE):int((start + 4) * RATE)]
+    (name, score, offset), *_ = index.query(clip, RATE, 1, 3)
+    assert name == song
+    assert offset == pytest.approx(start, abs=0.25)
+
+
+def test_stereoClipMatchesLikeMono(songs, index):
+    clip = songs["chirp_5"][3 * RATE:8 * RATE]
+    stereo = np.repeat(clip, 2)  # interleaved, like loader.decodeWindow
+    assert index.query(stereo, RATE, 2, 1)[0][0] == index.query(clip, RATE, 1, 1)[0][0] == "chirp_5"
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from conftest import flipBits
+from hashIndex import hashIndex
+from loader import FRONT_END_FILE, writeFrontEnd
+from shards import shardCount, shardPath, shardedIndex, writeShards
+
+
+@pytest.fixture
+def dbPath(catalogue, tmp_path):
+    dbPath = str(tmp_path / "db.json")
+    catalogue.save(str(tmp_path / "db.idx"))
+    writeFrontEnd(dbPath)
+    return dbPath
+
+
+@pytest.fixture
+def sharded(catalogue, dbPath):
+    writeShards(dbPath, 3, catalogue)
+    index = shardedIndex.local(dbPath)
+    yield index
+    index.close()
+
+
+def test_writeShardsPartitionsByRow(catalogue, dbPath, tmp_path):
+    writeShards(dbPath, 4, catalogue)
+    assert shardCount(dbPath) == 4
+    for shard in range(4):
+        part = hashIndex.load(str(shardPath(dbPath, shard, 4)))
+        assert list(part.names) == list(catalogue.names[shard::4])
+        assert np.array_equal(part.matrix, catalogue.matrix[shard::4])
+
+    writeShards(dbPath, 2, catalogue)
+    assert sorted(path.name for path in tmp_path.glob("db.shard*.idx")) == ["db.shard0-of-2.idx", "db.shard1-of-2.idx"]
+
+
+def test_mergeMatchesWholeIndex(catalogue, sharded, rng):
+    # every tenth song has a duplicate, so the merge must break ties by global row like the whole index
+    queries = np.stack([flipBits(catalogue.matrix[row], bits, rng)
+                        for row, bits in ((0, 0), (10, 3), (51, 60), (333, 200))])
+    for k in (1, 2, 7, 500, None):
+        assert sharded.searchBatch(queries, k) == catalogue.searchBatch(queries, k)
+    assert sharded.search(queries[1], 5) == catalogue.search(queries[1], 5)
+
+
+def test_staleShardsAreRefused(catalogue, dbPath, tmp_path):
+    writeShards(dbPath, 2, catalogue)
+    hashIndex(catalogue.names[:-1], catalogue.matrix[:-1]).save(str(tmp_path / "db.idx"))
+    with pytest.raises(ValueError, match="older db.idx"):
+        shardedIndex.local(dbPath)
+
+
+def test_shardsOfAnOlderFeaturePipelineAreRefused(catalogue, dbPath, tmp_path):
+    writeShards(dbPath, 2, catalogue)
+    (tmp_path / FRONT_END_FILE).write_text('{"rate": null}')
+    with pytest.raises(ValueError, match="feature pipeline version 1"):
+        shardedIndex.local(dbPath)
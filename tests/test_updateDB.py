@@ -0,0 +1,153 @@
+import json
+import os
+import pytest
+import numpy as np
+from pathlib import Path
+from scipy.io import wavfile
+import updateDB
+from benchmark import synthesizeCorpus, synthesizeTrack
+from hashIndex import hashIndex
+from loader import FRONT_END_FILE, readFeatureVersion
+from Spectrogram import FEATURE_VERSION
+from shards import shardCount, shardedIndex
+
+hashFile = updateDB.hashFile
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    songs, out = tmp_path / "songs", tmp_path / "db"
+    out.mkdir()
+    paths = synthesizeCorpus(str(songs), tracks=6, seconds=4)
+    return str(songs) + "/", str(out) + "/", [path.stem for path in paths]
+
+
+def countCalls(monkeypatch, failAfter: int = None) -> list:
+    """
+    Replaces updateDB.hashFile by a wrapper recording the hashed paths, interrupted like a
+    Ctrl+C once failAfter files are hashed
+    """
+    calls = []
+
+    def counted(path, *args):
+        if failAfter is not None and len(calls) == failAfter:
+            raise KeyboardInterrupt
+        calls.append(path.stem)
+        return hashFile(path, *args)
+    monkeypatch.setattr(updateDB, "hashFile", counted)
+    return calls
+
+
+def crashOnNoise(path, *args):
+    """
+    hashFile killing its worker process like a segfault on the noise tracks
+    """
+    if path.stem.startswith("noise"):
+        os._exit(1)
+    return hashFile(path, *args)
+
+
+def assertIndexMatchesJson(out: str):
+    """
+    The index updated in place holds the records of an index converted from db.json
+    """
+    index, rebuilt = hashIndex.load(out + "db.idx"), hashIndex.fromJson(out + "db.json")
+    rows = {name: row for row, name in enumerate(rebuilt.names)}
+    assert sorted(index.names) == sorted(rows)
+    assert all((index.matrix[row] == rebuilt.matrix[rows[name]]).all() for row, name in enumerate(index.names))
+
+
+def test_interruptedIngestResumesFromThePartialFile(corpus, monkeypatch):
+    songs, out, names = corpus
+    calls = countCalls(monkeypatch, failAfter=3)
+    with pytest.raises(KeyboardInterrupt):
+        updateDB.updateDB(songs, out, "w")
+    with open(out + "db.partial.jsonl") as partialFile:
+        finished = [json.loads(line)["name"] for line in partialFile]
+    assert finished == calls and len(finished) == 3
+
+    calls = countCalls(monkeypatch)
+    updateDB.updateDB(songs, out, "w")
+    assert sorted(calls) == sorted(set(names) - set(finished))
+    assert not (Path(out) / "db.partial.jsonl").exists()
+
+    resumed = dict(updateDB.readJson(out + "db.json"))
+    updateDB.updateDB(songs, out, "w")
+    assert resumed == dict(updateDB.readJson(out + "db.json"))
+
+
+def test_incrementalUpdateHashesOnlyTheChangedFiles(corpus, monkeypatch):
+    songs, out, names = corpus
+    updateDB.updateDB(songs, out, "w")
+    rng = np.random.default_rng(7)
+    Path(songs, names[0] + ".wav").unlink()
+    Path(songs, names[1] + ".wav").touch()  # new mtime, same content
+    wavfile.write(Path(songs, names[2] + ".wav"), 22050, synthesizeTrack("noise", 4, 22050, rng))
+    wavfile.write(Path(songs, "added.wav"), 22050, synthesizeTrack("chirp", 4, 22050, rng))
+
+    calls = countCalls(monkeypatch)
+    updateDB.updateDB(songs, out, "a")
+    assert sorted(calls) == sorted([names[2], "added"])
+    d = dict(updateDB.readJson(out + "db.json"))
+    assert set(d) == set(names[1:]) | {"added"}
+
+    assertIndexMatchesJson(out)
+
+    calls = countCalls(monkeypatch)
+    updateDB.updateDB(songs, out, "a")
+    assert calls == []
+
+
+def test_interruptedIncrementalUpdateResumesIntoTheIndex(corpus, monkeypatch):
+    songs, out, names = corpus
+    updateDB.updateDB(songs, out, "w")
+    rng = np.random.default_rng(11)
+    for name in names[:2]:
+        wavfile.write(Path(songs, name + ".wav"), 22050, synthesizeTrack("noise", 4, 22050, rng))
+
+    countCalls(monkeypatch, failAfter=1)
+    with pytest.raises(KeyboardInterrupt):
+        updateDB.updateDB(songs, out, "a")
+    calls = countCalls(monkeypatch)
+    updateDB.updateDB(songs, out, "a")
+    assert len(calls) == 1
+    assertIndexMatchesJson(out)
+
+
+def test_updateWithoutShardsRecutsTheShards(corpus):
+    songs, out, names = corpus
+    updateDB.updateDB(songs, out, "w", shards=2)
+    Path(songs, names[0] + ".wav").unlink()
+    updateDB.updateDB(songs, out, "a")
+
+    sharded, index = shardedIndex.local(out + "db.json"), hashIndex.load(out + "db.idx")
+    assert shardCount(out + "db.json") == 2 and len(sharded) == len(index) == len(names) - 1
+    try:
+        assert sharded.search(index.matrix[0], 1)[0][0] == index.names[0]
+    finally:
+        sharded.close()
+
+
+def test_workerKilledNativelySkipsOnlyItsFile(corpus, monkeypatch):
+    songs, out, names = corpus
+    monkeypatch.setattr(updateDB, "hashFile", crashOnNoise)
+    updateDB.updateDB(songs, out, "w", workers=2)
+
+    crashed = {name for name in names if name.startswith("noise")}
+    assert set(dict(updateDB.readJson(out + "db.json"))) == set(names) - crashed
+    with open(out + "db.errors.json") as errorFile:
+        assert set(json.load(errorFile)) == crashed
+
+
+def test_olderFeaturePipelineIsRebuilt(corpus, monkeypatch):
+    songs, out, names = corpus
+    updateDB.updateDB(songs, out, "w")
+    Path(out, FRONT_END_FILE).write_text('{"rate": null}')  # written before the feature version was recorded
+    with pytest.raises(ValueError, match="feature pipeline version 1"):
+        hashIndex.fromPath(out + "db.json")
+
+    calls = countCalls(monkeypatch)
+    updateDB.updateDB(songs, out, "a")
+    assert sorted(calls) == sorted(names)
+    assert readFeatureVersion(out + "db.json") == FEATURE_VERSION
+    assert len(hashIndex.fromPath(out + "db.json")) == len(names)
@@ -1,44 +1,352 @@
-from helpers import createPerceptualHash
-from Spectrogram import spectrogram
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import os
+import time
+import numpy as np
+from helpers import hashAudio
+from Spectrogram import FEATURE_VERSION, spectrogram
+from landmarks import fingerprint, landmarkIndex
+from segments import segmentHashes, segmentIndex
+from hashIndex import hashIndex
+from shards import shardCount, writeShards
 import loader
 import json
+from metrics import timed
 
-def updateDB(filePath:str, fileOut:str, mode: str = "a"):
+
+def hashFile(path, landmarkFolder: str = None, segmentFolder: str = None, rate: int = None) -> dict:
+    """
+    Creates the database record of a single audio file.
+
+    Implements the following :
+
+    - Loads the first minute of the file, through the canonical front end (mono float32 at rate) if rate is given
+    - Create Spectrogram and feature hashes
+    - If landmarkFolder is given, fingerprints the landmarks of the whole file in landmarkFolder/name.npy
+    - If segmentFolder is given, hashes the overlapping windows of the whole file in segmentFolder/name.npy
+
+    ============= ==========================================
+    **Arguments**
+    path          A path to the audio file.
+    landmarkFolder A string path to the folder of the landmark files.
+    segmentFolder A string path to the folder of the window hash files.
+    rate          Canonical sample rate of the hashes, the legacy decoding at the file rate if not given.
+    ============= ==========================================
+    """
+    if landmarkFolder or segmentFolder:
+        data, fileRate, channels = loader.decodeWindow(path)
+        if rate:
+            (data, fileRate), channels = loader.canonical(data, fileRate, channels, rate), 1
+        if landmarkFolder:
+            _, _, mesh = spectrogram()._spectrogram(data, fileRate)
+            np.save(Path(landmarkFolder) / (Path(path).stem + ".npy"), fingerprint(mesh))
+        if segmentFolder:
+            np.save(Path(segmentFolder) / (Path(path).stem + ".npy"), segmentHashes(data, fileRate, channels))
+        data = data[:60 * fileRate * channels]
+    else:
+        data, fileRate = loader.loadCanonical(path, 60000, rate)
+    spectrohash, features = hashAudio(data, fileRate)
+
+    return {"spectrohash": spectrohash, "features": features, "duration": len(data) / fileRate, "rate": fileRate}
+
+
+def _readPartial(file: Path) -> dict:
+    """
+    Reads the records streamed by an interrupted run, ignoring a truncated last line.
+    """
+    records = {}
+    if file.exists():
+        with open(file) as partialFile:
+            for line in partialFile:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                records[entry["name"]] = entry["record"]
+    return records
+
+
+class _SerialExecutor():
+    """
+    Executor running every submitted call in the calling process, used when workers == 1.
+    A call only runs when completed() reaches its future, so each record is written before
+    the next file is hashed
+    """
+    def __init__(self):
+        self.calls = {}  # future -> (fn, args) not run yet
+
+    def shutdown(self, wait: bool = True):
+        """
+        Drops the calls not run yet, like ProcessPoolExecutor.shutdown
+        """
+        self.calls.clear()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.calls[future] = (fn, args)
+        return future
+
+    def completed(self, futures):
+        """
+        Runs the calls of the futures one by one, yielding every future once it is done (like as_completed)
+        """
+        for future in futures:
+            fn, args = self.calls.pop(future)
+            try:
+                future.set_result(fn(*args))
+            except Exception as error:
+                future.set_exception(error)
+            yield future
+
+
+def _writeAtomic(data: dict, file: str, indent: int = None):
+    """
+    Writes a json file through a temporary file so readers never see a partial one.
+    """
+    with open(file+".tmp", "w") as outfile:
+        json.dump(data, outfile, indent=indent)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(file+".tmp", file)
+
+
+def _scanChanges(filePath: str, fileOut: str, d: dict, landmarkFolder: str = None,
+                 segmentFolder: str = None) -> tuple:
+    """
+    Compares the folder with the manifest of the last run.
+
+    Files whose size and mtime are unchanged are trusted, the others are digested and
+    only re-processed when their content changed. Songs whose file disappeared are
+    removed from the database records d.
+
+    ============= ==========================================
+    **Arguments**
+    filePath      A string path to the input file with the database songs.
+    fileOut       A string path to the output directory holding manifest.json.
+    d             The records of the current database.
+    landmarkFolder Songs without a landmark file in this folder are hashed again.
+    segmentFolder Songs without a window hash file in this folder are hashed again.
+    ============= ==========================================
+
+    :return: the new manifest and a dictionary of the files to hash
+    """
+    manifestPath = Path(fileOut+"manifest.json")
+    oldManifest = json.loads(manifestPath.read_text()) if manifestPath.exists() else {}
+    manifest, pending = {}, {}
+
+    for audFile, path in loader.loadPath(filePath):
+        stat = os.stat(path)
+        entry = {"path": str(path), "size": stat.st_size, "mtime": stat.st_mtime}
+        old = oldManifest.get(audFile)
+        if old and audFile in d and (old["size"], old["mtime"]) == (entry["size"], entry["mtime"]):
+            entry["digest"] = old["digest"]
+        else:
+            entry["digest"] = loader.fileDigest(path)
+            if not (old and audFile in d and old["digest"] == entry["digest"]):
+                pending[audFile] = path
+        for folder in (landmarkFolder, segmentFolder):
+            if folder and not (Path(folder) / (audFile + ".npy")).exists():
+                pending[audFile] = path
+        manifest[audFile] = entry
+
+    for audFile in set(d) - set(manifest):
+        print("%s is removed" % audFile)
+        del d[audFile]
+
+    return manifest, pending
+
+
+def updateDB(filePath:str, fileOut:str, mode: str = "a", workers: int = 1, retries: int = 1,
+             landmarks: bool = False, segments: bool = False, shards: int = None, rate: int = None):
     """
     Responsible for creating the database from a folder given.
 
     Implements the following :
 
     - Loads a specific folder given in the command
-    - Create Spectrogram and feature hashes
-    - Save these hashes in a specified json file
+    - In "a" mode only new or changed files (by size, mtime and content digest, kept in
+      manifest.json) are hashed and songs whose file was removed are deleted
+    - Create Spectrogram and feature hashes, across a pool of processes if workers > 1
+    - If rate, hashes every song through the canonical front end (mono float32 resampled to rate)
+      so songs of any source rate and channel layout are comparable, recorded in frontend.json
+      with the version of the feature pipeline, a database of an other front end or feature
+      version is rebuilt with its landmark and window indexes
+    - If landmarks, fingerprint every song and build the landmark index landmarks.npz
+    - If segments, hash overlapping windows of every song and build the window index segments.npz
+    - Stream every finished record to db.partial.jsonl so an interrupted run resumes where it stopped
+    - Retry failed files then skip them, reporting their errors in db.errors.json, a worker
+      killed natively (segfault, OOM) is replaced and the files it took down are hashed again
+      one at a time so only the one killing it is skipped
+    - Atomically replace the json file and the manifest with the new hashes
+    - Update the binary index db.idx with the hashed and removed songs only, processes serving
+      the previous version keep reading it until they reload (see snapshots.py)
+    - If shards, partition db.idx into that many shard indexes (see shards.writeShards), shards
+      written by an earlier run are cut again from the new db.idx with their recorded count
 
     ============= ==========================================
     **Arguments**
     filePath      A string path to the input file with the database songs.
     fileOut       A string path to the output directory to save the json file.
-    mode          String used to write in json file.
+    mode          "a" updates the existing database incrementally, "w" rebuilds it.
+    workers       Number of processes hashing files in parallel.
+    retries       Number of times a failing file is retried before being skipped.
+    landmarks     If True the landmark index of the songs is built too.
+    segments      If True the window index of the songs is built too.
+    shards        Number of shards db.idx is partitioned into, the count of db.shards.json if not given.
+    rate          Canonical sample rate of the hashes, legacy hashes at the rate of every file if not given.
     ============= ==========================================
     """
-    d = {}
+    dbPath = Path(fileOut+"db.json")
+    partialPath = Path(fileOut+"db.partial.jsonl")
+    if dbPath.exists() and (loader.readFrontEnd(str(dbPath)) != (rate or None)
+                            or loader.readFeatureVersion(str(dbPath)) != FEATURE_VERSION):
+        print("the front end changed, rebuilding the database")
+        mode = "w"
+        # the landmark and window indexes were hashed at the old rate too
+        landmarks = landmarks or Path(fileOut+"landmarks.npz").exists()
+        segments = segments or Path(fileOut+"segments.npz").exists()
+        if partialPath.exists():
+            partialPath.unlink()
+    landmarkFolder = fileOut+"landmarks/" if landmarks else None
+    segmentFolder = fileOut+"segments/" if segments else None
+    for folder in (landmarkFolder, segmentFolder):
+        if folder:
+            Path(folder).mkdir(exist_ok=True)
+    d = dict(readJson(dbPath)) if mode == "a" and dbPath.exists() else {}
+    manifest, pending = _scanChanges(filePath, fileOut, d, landmarkFolder, segmentFolder)
+    finished = _readPartial(partialPath)
+    hashed = set(finished) & set(pending)  # songs of the interrupted run still to be packed into db.idx
+    d.update((audFile, finished[audFile]) for audFile in hashed)
+    pending = {audFile: path for audFile, path in pending.items() if audFile not in finished}
+    attempts = {audFile: 0 for audFile in pending}
+    errors = {}
+    audioSeconds, done = 0.0, 0
+    start = time.perf_counter()
 
-    for audFile, path in loader.loadPath(filePath):
-        data, rate = loader.mp3ToData(path, 60000)
-        _, _, mesh = spectrogram()._spectrogram(data, rate)
+    def submit(audFile):
+        futures[executor.submit(hashFile, pending[audFile], landmarkFolder, segmentFolder, rate)] = audFile
+
+    waiting = deque(pending)  # files not submitted yet
+    suspects = deque()  # files lost with a broken pool, hashed alone to find the one that broke it
+    futures = {}
+    executor = ProcessPoolExecutor(workers) if workers > 1 else _SerialExecutor()
+    try:
+        with open(partialPath, "a") as partialFile:
+            while waiting or suspects or futures:
+                if suspects and not futures:
+                    submit(suspects.popleft())
+                while waiting and not suspects and len(futures) < 2 * workers:
+                    submit(waiting.popleft())
+                if isinstance(executor, _SerialExecutor):
+                    ready = executor.completed(list(futures))
+                else:
+                    ready = wait(futures, return_when=FIRST_COMPLETED).done
+                for future in ready:
+                    audFile = futures.pop(future)
+                    try:
+                        record = future.result()
+                    except Exception as error:
+                        broken = isinstance(error, BrokenProcessPool)
+                        if broken:
+                            # a worker died natively (segfault, OOM kill) and the pool lost all its calls
+                            lost = list(futures.values())
+                            futures.clear()
+                            executor.shutdown(wait=False)
+                            executor = ProcessPoolExecutor(workers)
+                            if lost:  # the pool can not tell which call killed it, they run again one by one
+                                suspects.extend([audFile] + lost)
+                                break
+                        attempts[audFile] += 1
+                        if attempts[audFile] <= retries:
+                            (suspects if broken else waiting).appendleft(audFile)
+                        else:
+                            errors[audFile] = {"path": str(pending[audFile]), "error": repr(error)}
+                            print("%s failed : %r" % (audFile, error))
+                        if broken:
+                            break
+                        continue
+
+                    d[audFile] = record
+                    hashed.add(audFile)
+                    partialFile.write(json.dumps({"name": audFile, "record": record}) + "\n")
+                    partialFile.flush()
+
+                    audioSeconds += record["duration"]
+                    done += 1
+                    elapsed = time.perf_counter() - start
+                    print("%s is hashed (%s/%s, %.2f files/s, %.1f audio-s/s)"
+                          % (audFile, done, len(pending), done / elapsed, audioSeconds / elapsed))
+    finally:
+        executor.shutdown()
 
-        feats = spectrogram().spectralFeatures(data, mesh, rate)
-        features = []
-        spectrohash = createPerceptualHash(mesh)
-        for feature in feats :
-            features.append(createPerceptualHash(feature))
+    for audFile in errors:
+        d.pop(audFile, None)
+        manifest.pop(audFile, None)
 
-        d.update({audFile: {"spectrohash": spectrohash, "features": features}})
-        print("%s is hashed" % audFile)
+    indexFresh = _indexFresh(dbPath)
+    _writeAtomic(d, str(dbPath), indent=4)
+    loader.writeFrontEnd(str(dbPath), rate)
+    index = _updateIndex(dbPath, d, hashed if indexFresh else None)
+    shards = shards or shardCount(str(dbPath))  # shards of an earlier run follow the new db.idx
+    if shards:
+        writeShards(str(dbPath), shards, index)
+    _writeAtomic(manifest, fileOut+"manifest.json")
+    partialPath.unlink()
 
-    with open(fileOut+"db.json", mode) as outfile:
-        json.dump(d, outfile, indent=4)
+    for folder in (landmarkFolder, segmentFolder):
+        for file in Path(folder).glob("*.npy") if folder else ():
+            if file.stem not in d:
+                file.unlink()
+    if landmarkFolder:
+        landmarkIndex.fromFolder(landmarkFolder).save(fileOut+"landmarks.npz")
+    if segmentFolder:
+        segmentIndex.fromFolder(segmentFolder).save(fileOut+"segments.npz")
 
+    if errors:
+        with open(fileOut+"db.errors.json", "w") as errorFile:
+            json.dump(errors, errorFile, indent=4)
+        print("%s files skipped, see %sdb.errors.json" % (len(errors), fileOut))
 
+
+def _indexFresh(dbPath: Path) -> bool:
+    """
+    True if db.idx exists and was written after db.json
+    """
+    indexPath = dbPath.with_suffix(".idx")
+    return dbPath.exists() and indexPath.exists() and indexPath.stat().st_mtime >= dbPath.stat().st_mtime
+
+
+def _updateIndex(dbPath: Path, d: dict, hashed: set = None):
+    """
+    Writes the next version of db.idx from the previous one, converting db.json only
+    when there is no usable previous version
+
+    ============= ==========================================
+    **Arguments**
+    dbPath        Path of db.json, the index is saved next to it.
+    d             The records of the database just written.
+    hashed        Names of the songs hashed by this run, None to convert db.json.
+    ============= ==========================================
+
+    :return: the new index
+    """
+    indexPath = dbPath.with_suffix(".idx")
+    index = None
+    if hashed is not None:
+        try:
+            index = hashIndex.load(str(indexPath)).updated(
+                {audFile: d[audFile] for audFile in hashed if audFile in d}, set(d))
+        except (OSError, ValueError):
+            pass
+    if index is None or len(index) != len(d):
+        index = hashIndex.fromJson(str(dbPath))
+    index.save(str(indexPath))
+    return index
+
+
+@timed("readJson")
 def readJson(file):
     """
     Reads a specified json file and return its contents.
@@ -60,16 +368,29 @@ def readJson(file):
 
 
 if __name__ == '__main__':
-    import sys
+    import argparse
     import warnings
 
     warnings.filterwarnings("ignore")
 
-    if sys.argv[1] and sys.argv[2]:
-        updateDB(sys.argv[1], sys.argv[2], "w")
-    else:
-        for i in readJson("db.json"):
-            print(i)
-            print("File paths not given")
+    parser = argparse.ArgumentParser(description="Hash a folder of songs into a database")
+    parser.add_argument("filePath", help="folder containing the database songs")
+    parser.add_argument("fileOut", help="output directory of db.json (with a trailing /)")
+    parser.add_argument("--workers", type=int, default=1, help="number of hashing processes")
+    parser.add_argument("--retries", type=int, default=1, help="retries of a failing file before skipping it")
+    parser.add_argument("--incremental", action="store_true", help="only hash new or changed files")
+    parser.add_argument("--landmarks", action="store_true", help="build the landmark index too")
+    parser.add_argument("--segments", action="store_true", help="build the sliding window index too")
+    parser.add_argument("--shards", type=int, help="partition the index into this many shards")
+    parser.add_argument("--rate", type=int, help="canonical sample rate (e.g %s) of a mono front end, 0 for the "
+                        "rate of every file, the one of the database for --incremental" % loader.CANONICAL_RATE)
+    args = parser.parse_args()
+
+    rate = args.rate
+    if rate is None and args.incremental:
+        rate = loader.readFrontEnd(args.fileOut+"db.json")
+    updateDB(args.filePath, args.fileOut, "a" if args.incremental else "w",
+             workers=args.workers, retries=args.retries, landmarks=args.landmarks,
+             segments=args.segments, shards=args.shards, rate=rate or None)
 
     print("End of Script")
@@ -0,0 +1,93 @@
+from PyQt5 import QtCore
+import traceback
+
+
+class cancelledError(Exception):
+    """
+    Raised inside a task when its cancel button was pressed
+    """
+
+
+class workerSignals(QtCore.QObject):
+    """
+    Signals of a worker, emitted from the pool thread and delivered in the GUI thread
+
+    - progress : percentage done and a status message
+    - partial : results found so far
+    - result : value returned by the task
+    - error : formatted traceback of an exception raised by the task
+    - cancelled : emitted instead of result when the task was cancelled
+    - finished : always emitted last
+    """
+    progress = QtCore.pyqtSignal(int, str)
+    partial = QtCore.pyqtSignal(object)
+    result = QtCore.pyqtSignal(object)
+    error = QtCore.pyqtSignal(str)
+    cancelled = QtCore.pyqtSignal()
+    finished = QtCore.pyqtSignal()
+
+
+class worker(QtCore.QRunnable):
+    """
+    Runs a task on a QThreadPool thread implements the following :
+
+    - Calls task(worker, *args) so the task can report progress and partial results
+    - Lets the GUI cancel the task, which stops at its next checkCancelled()
+    - Reports the returned value or the raised error through signals
+    """
+    def __init__(self, task, *args):
+        """
+        Class Initializer
+
+        Parameters
+        -----------
+        - task : function called with the worker followed by args
+        - args : arguments of the task
+        """
+        super(worker, self).__init__()
+        self.task = task
+        self.args = args
+        self.signals = workerSignals()
+        self._cancelled = False
+
+    def cancel(self):
+        """
+        Asks the task to stop at its next checkCancelled()
+        """
+        self._cancelled = True
+
+    def checkCancelled(self):
+        """
+        Raises cancelledError if the task was cancelled, called by the task between its steps
+        """
+        if self._cancelled:
+            raise cancelledError()
+
+    def progress(self, percent: int, message: str):
+        """
+        Reports the progress of the task, raising cancelledError if it was cancelled
+        """
+        self.checkCancelled()
+        self.signals.progress.emit(int(percent), message)
+
+    def partial(self, results):
+        """
+        Reports the results found so far, raising cancelledError if the task was cancelled
+        """
+        self.checkCancelled()
+        self.signals.partial.emit(results)
+
+    def run(self):
+        """
+        Runs the task on the pool thread
+        """
+        try:
+            result = self.task(self, *self.args)
+        except cancelledError:
+            self.signals.cancelled.emit()
+        except Exception:
+            self.signals.error.emit(traceback.format_exc())
+        else:
+            self.signals.result.emit(result)
+        finally:
+            self.signals.finished.emit()